@@ -0,0 +1,296 @@
+"""Command line interface to tiling, training data selection, training, testing, parcel import, planning, clustering
+and the cached pipeline of :mod:'pipeline'
+
+Usage: python cli.py [--config settings.json] [--data-path data] <subcommand> [options]
+
+Settings are given as options, or in a JSON config file with global settings at the top level and settings of each
+subcommand in a section named after it, e.g. {"data_path": "data", "train": {"depth": 4, "epochs": 50}}. Options
+override the config file.
+
+TensorFlow, GDAL, sklearn, psycopg2 and sentinelsat are only imported by the subcommands using them, so startup and
+trivial subcommands are fast. The cold start time is measured by the "startup" subcommand.
+"""
+import argparse
+import ast
+import json
+import os
+import subprocess
+import sys
+import time
+
+# Maximum cold start time (seconds) of "python cli.py --help", see :func:'cli.startup_time()'
+startup_budget = 0.5
+
+# Modules that must not be imported before a subcommand is run
+heavy_modules = ["tensorflow", "gdal", "osgeo", "ogr", "sklearn", "sentinelsat", "psycopg2", "pyarrow", "matplotlib",
+                 "numpy"]
+
+
+def parse_value(text):
+    """Interpret an option value as a Python literal, or else as a string"""
+    try:
+        return ast.literal_eval(text)
+    except (ValueError, SyntaxError):
+        return text
+
+
+def parse_settings(items):
+    """Interpret a list of "key=value" options, see :func:'cli.parse_value()'"""
+    settings = {}
+    for item in items or []:
+        key, sep, value = item.partition("=")
+        if not sep:
+            raise ValueError(f"Expected key=value: {item}")
+        settings[key.strip().replace("-", "_")] = parse_value(value)
+    return settings
+
+
+def _training_data(args):
+    """Import :mod:'training_data', with the data path of the options"""
+    import training_data
+    if args.data_path:
+        training_data.data_path = args.data_path
+    return training_data
+
+
+def cmd_tile(args):
+    training_data = _training_data(args)
+    if args.labels == "ar5":
+        training_data.generate_training_data_ar5(args.image_sets, args.patch_sz, args.version)
+    else:
+        training_data.generate_training_data_ldir(args.image_sets, args.patch_sz, args.version)
+
+
+def cmd_mix(args):
+    training_data = _training_data(args)
+    training_data.mix_training_data(args.training_path, training_data.label_names[args.labels])
+
+
+def _cnn_settings(args, **settings):
+    """Keyword arguments of :func:'cnn.main()' from options, config file section and --set"""
+    import inspect
+    import cnn
+    names = set(inspect.signature(cnn.main).parameters)
+    for key, value in vars(args).items():
+        if key in names and value is not None:
+            settings.setdefault(key, value)
+    settings.update(parse_settings(args.set))
+    unknown = set(settings) - names
+    if unknown:
+        raise ValueError(f"Unknown settings: {', '.join(sorted(unknown))}")
+    return cnn, settings
+
+
+def cmd_train(args):
+    cnn, settings = _cnn_settings(args, do_test=False)
+    cnn.main(**settings)
+
+
+def cmd_test(args):
+    cnn, settings = _cnn_settings(args, do_train=False)
+    cnn.main(**settings)
+
+
+def cmd_import(args):
+    layers = [tuple(layer.split(":", 1)) if ":" in layer else (layer, None) for layer in args.layers]
+    if args.parquet:
+        import parcel_store
+        print(parcel_store.import_gdb(args.filename, layers, args.parquet))
+    else:
+        dsn = args.dsn
+        if not dsn:
+            if args.backend == "sqlite":
+                raise ValueError("--dsn (SQLite database file) is required with --backend sqlite")
+            dsn = "host=beistet port=5433 dbname=LDir user=postgres password=1234"
+        import import_ldir
+        print(import_ldir.bulk_import(args.filename, layers, dsn, args.backend))
+
+
+def cmd_plan(args):
+    import tile_plan
+    training_data = _training_data(args)
+    catalog = tile_plan.ProductCatalog(args.catalog or os.path.join(training_data.data_path, "catalog.sqlite"))
+    response_path = args.responses or os.path.join(training_data.data_path, "responses")
+    catalog.load_directory(response_path)
+    if args.store:
+        parcels = tile_plan.parcels_from_store(args.store)
+    else:
+        parcels = tile_plan.parcels_from_db(args.dsn)
+    catalog.set_plan(tile_plan.plan_tiles(parcels))
+    if args.query_hub:
+        import sentinelsat
+        api = sentinelsat.SentinelAPI(args.user, args.password, args.hub)
+        catalog.query_hub(api, response_path, args.max_cloud)
+
+    for tile, products in catalog.planned_products(args.max_cloud).items():
+        print(tile)
+        for title, datatake, cloud in products:
+            print("   ", datatake, cloud, title)
+
+
+def cmd_cluster(args):
+    import cluster_test
+    training_data = _training_data(args)
+    checkpoint_fn = args.checkpoint or os.path.join(training_data.data_path, "cluster_checkpoint.pkl")
+    cluster_test.incremental_cluster(args.image_sets, checkpoint_fn, args.n_clusters,
+                                     data_path=training_data.data_path)
+    if args.apply_dir:
+        print(cluster_test.apply_cluster_model(checkpoint_fn, args.image_sets, args.apply_dir, args.workers,
+                                               data_path=training_data.data_path))
+
+
+def cmd_pipeline(args):
+    import pipeline
+    training_data = _training_data(args)
+    stages = pipeline.build_pipeline(args.image_sets, args.run_name, args.labels, args.patch_sz, args.version,
+                                     parse_settings(args.set), args.predict_image_sets or (),
+                                     training_data.data_path, args.run_dir)
+    pipeline.print_report(pipeline.run_pipeline(stages, os.path.join(args.run_dir, "pipeline"), args.workers,
+                                                args.force or ()))
+
+
+def startup_time(argv=("--help",), n_runs=5):
+    """Median wall time (seconds) of running this module in a new interpreter, e.g. "python cli.py --help" """
+    times = []
+    for i in range(n_runs):
+        t0 = time.perf_counter()
+        subprocess.run([sys.executable, os.path.abspath(__file__)] + list(argv), stdout=subprocess.DEVNULL,
+                       check=True)
+        times.append(time.perf_counter() - t0)
+    return sorted(times)[len(times) // 2]
+
+
+def cmd_startup(args):
+    # Heavy modules imported when the parser is built
+    code = f"import sys; sys.path.insert(0, {os.path.dirname(os.path.abspath(__file__))!r}); import cli; " \
+           f"cli.build_parser(); print(' '.join(m for m in cli.heavy_modules if m in sys.modules))"
+    imported = subprocess.run([sys.executable, "-c", code], stdout=subprocess.PIPE, check=True,
+                              universal_newlines=True).stdout.split()
+    t0 = time.perf_counter()
+    for i in range(args.runs):
+        subprocess.run([sys.executable, "-c", "pass"], check=True)
+    interpreter = (time.perf_counter() - t0) / args.runs
+    startup = startup_time(("--help",), args.runs)
+    print(f"interpreter: {interpreter * 1000:.0f} ms, cli --help: {startup * 1000:.0f} ms, "
+          f"budget: {args.budget * 1000:.0f} ms, heavy imports: {', '.join(imported) or 'none'}")
+    if startup > args.budget or imported:
+        sys.exit(1)
+
+
+def build_parser():
+    """Command line parser with one subparser for each subcommand"""
+    parser = argparse.ArgumentParser(description="Sentinel 2 CNN")
+    parser.add_argument("--config", help="JSON settings file")
+    parser.add_argument("--data-path", help="Directory of satelite images and training data")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    sub = subparsers.add_parser("tile", help="cut satelite images into training patches")
+    sub.add_argument("image_sets", nargs="+", help="Sentinel 2 product names")
+    sub.add_argument("--labels", choices=["ar5", "ldir"], default="ar5")
+    sub.add_argument("--patch-sz", type=int, default=128)
+    sub.add_argument("--version", help="version of the label layer, default from feature count and extent")
+    sub.set_defaults(func=cmd_tile)
+
+    sub = subparsers.add_parser("mix", help="select training patches and split into training, validation and test")
+    sub.add_argument("--training-path", help="root of training data, default <data path>/training")
+    sub.add_argument("--labels", choices=["ar5", "ldir"], default="ar5")
+    sub.set_defaults(func=cmd_mix)
+
+    for name, func, help_text in (("train", cmd_train, "train a model"),
+                                  ("test", cmd_test, "test a trained model and classify satelite images")):
+        sub = subparsers.add_parser(name, help=help_text)
+        sub.add_argument("--depth", type=int)
+        sub.add_argument("--capacity", type=int)
+        sub.add_argument("--batch-size", type=int)
+        sub.add_argument("--epochs", type=int)
+        sub.add_argument("--drop-rate", type=float)
+        sub.add_argument("--optimizer", choices=["adam", "adagrad", "SGD"])
+        sub.add_argument("--block-type", choices=["standard", "separable"])
+        sub.add_argument("--upsample", choices=["transpose", "bilinear"])
+        sub.add_argument("--width", type=float)
+        sub.add_argument("--local-workers", type=int)
+        sub.add_argument("--run-dir")
+        sub.add_argument("--predict-image-sets", nargs="*")
+        sub.add_argument("--set", action="append", metavar="KEY=VALUE",
+                         help="any keyword argument of cnn.main(), value as Python literal")
+        sub.set_defaults(func=func)
+
+    sub = subparsers.add_parser("import", help="import LDir parcel layers to PostgreSQL, SQLite or GeoParquet")
+    sub.add_argument("filename", help="vector data source, e.g. FileGDB")
+    sub.add_argument("layers", nargs="+", help="layer name and default product, e.g. Gras_fra_PT:Gras")
+    sub.add_argument("--dsn", help="psycopg2 connection string, default the LDir database, or SQLite database file "
+                                   "(required with --backend sqlite)")
+    sub.add_argument("--backend", choices=["pg", "sqlite"], default="pg")
+    sub.add_argument("--parquet", help="write GeoParquet to this directory instead of a database")
+    sub.set_defaults(func=cmd_import)
+
+    sub = subparsers.add_parser("plan", help="plan tiles and dates from parcels and list catalogued products")
+    sub.add_argument("--dsn", default="host=beistet port=5433 dbname=LDir user=postgres password=1234")
+    sub.add_argument("--store", help="read parcels from a GeoParquet dataset instead of the database")
+    sub.add_argument("--catalog", help="catalog database, default <data path>/catalog.sqlite")
+    sub.add_argument("--responses", help="saved hub query responses, default <data path>/responses")
+    sub.add_argument("--max-cloud", type=float, default=30)
+    sub.add_argument("--query-hub", action="store_true", help="update the catalog from the Copernicus hub")
+    sub.add_argument("--user")
+    sub.add_argument("--password")
+    sub.add_argument("--hub", default="https://scihub.copernicus.eu/dhus")
+    sub.set_defaults(func=cmd_plan)
+
+    sub = subparsers.add_parser("cluster", help="fit and apply an incremental k-means pixel clustering")
+    sub.add_argument("image_sets", nargs="+", help="Sentinel 2 product names")
+    sub.add_argument("--checkpoint", help="model checkpoint, default <data path>/cluster_checkpoint.pkl")
+    sub.add_argument("--n-clusters", type=int, default=16)
+    sub.add_argument("--apply-dir", help="classify the images and write the results to this directory")
+    sub.add_argument("--workers", type=int, default=4)
+    sub.set_defaults(func=cmd_cluster)
+
+    sub = subparsers.add_parser("pipeline", help="run the stale stages from satelite images to predictions")
+    sub.add_argument("image_sets", nargs="+", help="Sentinel 2 products used for training data")
+    sub.add_argument("--run-name", required=True, help="directory of the model in the run directory")
+    sub.add_argument("--run-dir", default="run")
+    sub.add_argument("--labels", choices=["ar5", "ldir"], default="ar5")
+    sub.add_argument("--patch-sz", type=int, default=128)
+    sub.add_argument("--version", help="version of the label layer, changing it reruns tiling")
+    sub.add_argument("--predict-image-sets", nargs="*")
+    sub.add_argument("--workers", type=int, default=2, help="number of stages run in parallel")
+    sub.add_argument("--force", nargs="*", help="stages run even if up to date, e.g. mix")
+    sub.add_argument("--set", action="append", metavar="KEY=VALUE",
+                     help="any keyword argument of cnn.main(), value as Python literal")
+    sub.set_defaults(func=cmd_pipeline)
+
+    sub = subparsers.add_parser("startup", help="measure the cold start time against the budget")
+    sub.add_argument("--runs", type=int, default=5)
+    sub.add_argument("--budget", type=float, default=startup_budget, help="seconds")
+    sub.set_defaults(func=cmd_startup)
+    return parser
+
+
+def main(argv=None):
+    parser = build_parser()
+    argv = sys.argv[1:] if argv is None else argv
+
+    # Config file settings as defaults, overridden by options
+    pre = argparse.ArgumentParser(add_help=False)
+    pre.add_argument("--config")
+    config_args = pre.parse_known_args(argv)[0]
+    if config_args.config:
+        with open(config_args.config) as file:
+            config = json.load(file)
+        subparsers = next(action for action in parser._actions if isinstance(action, argparse._SubParsersAction))
+        global_config = {key: value for key, value in config.items() if key not in subparsers.choices}
+        parser.set_defaults(**global_config)
+        for name, sub in subparsers.choices.items():
+            # Global settings of the subcommand's own options too, otherwise its defaults replace them
+            dests = {action.dest for action in sub._actions}
+            sub.set_defaults(**{key: value for key, value in global_config.items() if key in dests})
+            sub.set_defaults(**config.get(name, {}))
+
+    args = parser.parse_args(argv)
+    t0 = time.perf_counter()
+    args.func(args)
+    print(f"{args.command}: {time.perf_counter() - t0:.1f} s", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -6,12 +6,15 @@ Created on Wed Mar 27 10:18:49 2019
 """
 
 import os
+import pickle
+import multiprocessing
 import gdal
 import numpy as np
 import matplotlib as mpl
 import matplotlib.pyplot as plt
 import matplotlib.gridspec as gridspec
 import sklearn.mixture as mix
+import sklearn.cluster as cluster
 import training_data
 
 def plot_ellipses(ax, weights, means, covars):
@@ -119,3 +122,181 @@ def gmm_cluster():
     #ax.set_zlabel('B Label')
 
     # plt.show()
+
+
+def pixel_blocks(image_set, channels=None, block_rows=512, start_row=0):
+    """Stream pixel feature vectors from an image set in horizontal blocks
+
+    10m channels are used at full resolution, 20m channels are upsampled to the 10m grid by pixel repetition.
+
+    Parameters
+    ----------
+    image_set: training_data.ImageSet
+    channels: list(str)
+        Channels to use, default all 10m and 20m channels
+    block_rows: int
+        Number of 10m rows in each block (must be even)
+    start_row: int
+        First 10m row to read, used when resuming from a checkpoint
+
+    Yields
+    ------
+    row: int
+        First 10m row of the block
+    X: (rows * cols, n_channels) ndarray
+        Pixel feature vectors
+    shape: (rows, cols)
+        Shape of the block
+    """
+    if channels is None:
+        channels = training_data.ImageSet.ch10m + training_data.ImageSet.ch20m
+    ch10m = [ch for ch in channels if ch in training_data.ImageSet.ch10m]
+    ch20m = [ch for ch in channels if ch in training_data.ImageSet.ch20m]
+
+    ds_10m, cols, rows, xform, proj = training_data.image_set_open(
+        [image_set.get_channel_image_filename(ch) for ch in ch10m])
+    ds_20m, cols_20m, rows_20m, xform_20m, proj_20m = training_data.image_set_open(
+        [image_set.get_channel_image_filename(ch) for ch in ch20m])
+    if not ds_10m:
+        # Only 20m channels, work on the 10m grid anyway
+        cols, rows = cols_20m * 2, rows_20m * 2
+
+    for row in range(start_row, rows, block_rows):
+        n_rows = min(block_rows, rows - row)
+        bands = training_data.image_set_read(ds_10m, 0, row, cols, n_rows)
+        for band in training_data.image_set_read(ds_20m, 0, row // 2, cols // 2, (n_rows + 1) // 2):
+            band = np.repeat(np.repeat(band, 2, axis=0), 2, axis=1)
+            bands.append(band[:n_rows, :cols])
+        X = np.concatenate([b.reshape((-1, 1)) for b in bands], axis=1).astype("f4")
+        X /= 2 ** 16 - 1
+        yield row, X, (n_rows, cols)
+
+
+def save_cluster_checkpoint(checkpoint_fn, state):
+    """Atomically write clustering state to file"""
+    tmp_fn = checkpoint_fn + ".tmp"
+    with open(tmp_fn, "wb") as file:
+        pickle.dump(state, file)
+    os.replace(tmp_fn, checkpoint_fn)
+
+
+def load_cluster_checkpoint(checkpoint_fn):
+    """Read clustering state written by :func:'cluster_test.save_cluster_checkpoint()'"""
+    with open(checkpoint_fn, "rb") as file:
+        return pickle.load(file)
+
+
+def incremental_cluster(image_set_names, checkpoint_fn, n_clusters=16, channels=None, block_rows=512,
+                        sample_frac=0.05, checkpoint_every=10, data_path=training_data.data_path, seed=0):
+    """Fit a mini-batch k-means model by streaming pixel batches from many Sentinel 2 products
+
+    Only one block of one product is in memory at a time, so the amount of data is limited by disk space only.
+    The model state and the read position is checkpointed regularly, calling the function again with the same
+    checkpoint file continues where the previous run stopped.
+
+    Parameters
+    ----------
+    image_set_names: list(str)
+        Names of Sentinel 2 products, see :class:'training_data.ImageSet'
+    checkpoint_fn: str (path)
+        Checkpoint file
+    n_clusters: int
+        Number of clusters, must match the checkpoint when continuing
+    channels: list(str)
+        Channels to use, see :func:'cluster_test.pixel_blocks()'
+    block_rows: int
+        Rows read from each product in every batch
+    sample_frac: float
+        Fraction of the valid pixels in each block used for fitting
+    checkpoint_every: int
+        Number of batches between each checkpoint
+    data_path: str (path)
+        Directory where Sentinel 2 products are stored
+
+    Returns
+    -------
+    sklearn.cluster.MiniBatchKMeans
+    """
+    if os.path.exists(checkpoint_fn):
+        state = load_cluster_checkpoint(checkpoint_fn)
+        if state["model"].n_clusters != n_clusters:
+            raise ValueError(f"Checkpoint {checkpoint_fn} has {state['model'].n_clusters} clusters, not {n_clusters}")
+    else:
+        state = {
+            "model": cluster.MiniBatchKMeans(n_clusters=n_clusters, random_state=seed),
+            "channels": channels,
+            "done": [],
+            "current": None,
+            "next_row": 0,
+            "n_batches": 0,
+        }
+    model = state["model"]
+    rng = np.random.default_rng(seed + state["n_batches"])
+
+    for image_set_name in image_set_names:
+        if image_set_name in state["done"]:
+            continue
+        start_row = state["next_row"] if state["current"] == image_set_name else 0
+        state["current"] = image_set_name
+
+        image_set = training_data.ImageSet(data_path, image_set_name)
+        for row, X, shape in pixel_blocks(image_set, state["channels"], block_rows, start_row):
+            # Skip nodata pixels
+            X = X[np.any(X > 0, axis=1)]
+            X = X[rng.random(X.shape[0]) < sample_frac]
+            state["next_row"] = row + shape[0]
+            if X.shape[0] >= n_clusters:
+                model.partial_fit(X)
+                state["n_batches"] += 1
+                if state["n_batches"] % checkpoint_every == 0:
+                    save_cluster_checkpoint(checkpoint_fn, state)
+
+        state["done"].append(image_set_name)
+        state["current"] = None
+        state["next_row"] = 0
+        save_cluster_checkpoint(checkpoint_fn, state)
+
+    return model
+
+
+def _apply_cluster_model(args):
+    """Worker for :func:'cluster_test.apply_cluster_model()'"""
+    checkpoint_fn, data_path, image_set_name, out_dir, block_rows = args
+    state = load_cluster_checkpoint(checkpoint_fn)
+    image_set = training_data.ImageSet(data_path, image_set_name)
+
+    ds_10m, cols, rows, xform, proj = training_data.image_set_open(
+        [image_set.get_channel_image_filename(ch) for ch in training_data.ImageSet.ch10m])
+
+    out_fn = os.path.join(out_dir, image_set_name + "_clustered.tif")
+    out_ds = gdal.GetDriverByName('GTiff').Create(out_fn, cols, rows, 1, gdal.GDT_Byte,
+                                                  ['COMPRESS=LZW', 'PREDICTOR=2', 'TILED=YES'])
+    out_ds.SetGeoTransform(xform)
+    out_ds.SetProjection(proj)
+    out_band = out_ds.GetRasterBand(1)
+    out_band.SetNoDataValue(255)
+
+    for row, X, shape in pixel_blocks(image_set, state["channels"], block_rows):
+        prediction = state["model"].predict(X).astype("B")
+        prediction[~np.any(X > 0, axis=1)] = 255
+        out_band.WriteArray(prediction.reshape(shape), 0, row)
+    out_ds = None
+    return out_fn
+
+
+def apply_cluster_model(checkpoint_fn, image_set_names, out_dir, workers=4, block_rows=512,
+                        data_path=training_data.data_path):
+    """Classify Sentinel 2 products with a model fitted by :func:'cluster_test.incremental_cluster()'
+
+    Each product is processed block by block in a separate process and written to
+    "<out_dir>/<image set name>_clustered.tif". Nodata pixels are given the value 255.
+
+    Returns
+    -------
+    list(str)
+        Output filenames
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    args = [(checkpoint_fn, data_path, image_set_name, out_dir, block_rows) for image_set_name in image_set_names]
+    with multiprocessing.Pool(workers) as pool:
+        return pool.map(_apply_cluster_model, args)
@@ -8,7 +8,19 @@ Created on Fri Mar 29 08:53:15 2019
 """
 
 import ast
+import glob
+import json
+import multiprocessing
 import os
+import queue
+import re
+import resource
+import shutil
+import time
+import subprocess
+import sys
+import threading
+import random as rn
 import numpy as np
 import tensorflow as tf
 import gdal
@@ -19,15 +31,237 @@ import training_data
 # tf.keras.backend.set_session(tf_debug.LocalCLIDebugWrapperSession(tf.Session()))
 
 
-def cnn_block(x, channels, block_name, use_bn, activation):
-    """Create bn-conv2D-bn-conv2D block"""
+# Names and colors of AR5 categories, see :func:'training_data.generate_training_data_ar5()'
+category_names = ["Ukjent", "Barskog", "Loevskog", "Skog, blandet eller ukjent", "Jorddekt åpen mark", "Dyrket",
+                  "Blokkmark", "Fjell i dagen", "Myr", "Sne/is/bre", "Vann",
+                  "Menneskepaavirket eller ukjent åpen mark", "Vei/jernbane/transport", "Bebygd"]
+category_colors = [(0, 0, 0, 0), (0, 90, 0, 255), (80, 170, 60, 255), (40, 130, 40, 255), (200, 230, 150, 255),
+                   (255, 210, 0, 255), (170, 170, 170, 255), (120, 120, 120, 255), (150, 100, 200, 255),
+                   (255, 255, 255, 255), (0, 100, 255, 255), (220, 200, 160, 255), (200, 0, 0, 255),
+                   (255, 100, 100, 255)]
+
+# Names and colors of the categories of each label set, see :data:'training_data.label_names'
+label_categories = {
+    "AR5": (category_names, category_colors),
+    # See :func:'training_data.generate_training_data_ldir()'
+    "LDir": (["Ukjent", "Gress", "Korn"], [(0, 0, 0, 0), (120, 200, 80, 255), (255, 210, 0, 255)]),
+}
+
+
+def patch_tile(filename):
+    """MGRS tile code of a training data patch, from the satelite image name in the file name"""
+    re_match = re.search(r"_T(\d{1,2}[C-X][A-HJ-NP-Z][A-HJ-NP-V])_", os.path.basename(filename))
+    if not re_match:
+        raise ValueError(f"No MGRS tile in file name: {filename}")
+    return re_match.group(1)
+
+
+class PredictionMosaic:
+    """Predicted categories of one MGRS tile, in one tiled GeoTIFF
+
+    The image covers the area of the Sentinel 2 tile (109.8x109.8km at 10m) and is written incrementally, one
+    patch at a time. Unpredicted pixels are nodata (255). Overviews are built when the mosaic is closed. An existing
+    mosaic is opened for update, so predictions can be added in several runs.
+
+    Parameters
+    ----------
+    filename: str (path)
+    tile: str
+        MGRS tile code
+    proj: str
+        WKT description of world coordinate system
+    ground_res: int
+        Pixel size (m)
+    label_name: str
+        Label set of the categories, "AR5" or "LDir", for the category names and colors of the legend
+    """
+    nodata = 255
+
+    def __init__(self, filename, tile, proj, ground_res=10, label_name="AR5"):
+        mgrs = training_data.MGRS(tile)
+        self.xform = (mgrs.e, ground_res, 0, mgrs.n + 100000, 0, -ground_res)
+        self.filename = filename
+        self.ds = gdal.Open(filename, gdal.GA_Update) if os.path.exists(filename) else None
+        if not self.ds:
+            size = (100000 + training_data.tile_overlap) // ground_res
+            self.ds = gdal.GetDriverByName('GTiff').Create(filename, size, size, 1, gdal.GDT_Byte,
+                                                           ['TILED=YES', 'BLOCKXSIZE=256', 'BLOCKYSIZE=256',
+                                                            'COMPRESS=LZW', 'PREDICTOR=2', 'SPARSE_OK=TRUE'])
+            self.ds.SetGeoTransform(self.xform)
+            self.ds.SetProjection(proj)
+            band = self.ds.GetRasterBand(1)
+            band.SetNoDataValue(self.nodata)
+            names, colors = label_categories[label_name]
+            band.SetCategoryNames(names)
+            color_table = gdal.ColorTable()
+            for cat, color in enumerate(colors):
+                color_table.SetColorEntry(cat, color)
+            band.SetColorTable(color_table)
+            band.SetColorInterpretation(gdal.GCI_PaletteIndex)
+
+    def write(self, array, xform):
+        """Write predicted categories of a patch
+
+        Parameters
+        ----------
+        array: ndarray(rows, cols)
+            Categories
+        xform: [x0, x_scale, 0, y0, 0, y_scale]
+            Transform of the patch, same pixel size as the mosaic
+        """
+        xoff = int(round((xform[0] - self.xform[0]) / self.xform[1]))
+        yoff = int(round((xform[3] - self.xform[3]) / self.xform[5]))
+        # Clip to mosaic
+        x0, y0 = max(xoff, 0), max(yoff, 0)
+        x1 = min(xoff + array.shape[1], self.ds.RasterXSize)
+        y1 = min(yoff + array.shape[0], self.ds.RasterYSize)
+        if x0 < x1 and y0 < y1:
+            self.ds.GetRasterBand(1).WriteArray(array[y0 - yoff:y1 - yoff, x0 - xoff:x1 - xoff], x0, y0)
+
+    def read(self, xoff=0, yoff=0, xsize=None, ysize=None):
+        """Read predicted categories, default the whole tile"""
+        self.ds.FlushCache()
+        return self.ds.GetRasterBand(1).ReadAsArray(xoff, yoff, xsize, ysize)
+
+    def close(self, overviews=(2, 4, 8, 16, 32)):
+        """Build overviews (most frequent category) and close the file"""
+        if overviews:
+            self.ds.BuildOverviews("MODE", list(overviews))
+        self.ds = None
+
+
+# Convolution layer of each block type, see :func:'cnn.cnn_block()'
+block_conv_layers = {
+    "standard": tf.keras.layers.Conv2D,
+    "separable": tf.keras.layers.SeparableConv2D,
+}
+
+
+class RecomputeBlock(tf.keras.layers.Layer):
+    """bn-conv2D-bn-conv2D block that doesn't keep its inner activations for backpropagation
+
+    The activations are recomputed from the block input when gradients are computed, trading compute for memory.
+    """
+    def __init__(self, channels, use_bn, activation, block_type="standard", **kwargs):
+        super().__init__(**kwargs)
+        self.channels = channels
+        self.use_bn = use_bn
+        self.activation = activation
+        self.block_type = block_type
+        self.block_layers = []
+        for i in (1, 2):
+            if use_bn:
+                self.block_layers.append(tf.keras.layers.BatchNormalization(name=f"{self.name}_norm{i}",
+                                                                            center=False, scale=False))
+            self.block_layers.append(block_conv_layers[block_type](channels, (3, 3), padding="same",
+                                                                   name=f"{self.name}_conv{i}",
+                                                                   activation=activation,
+                                                                   data_format="channels_last"))
+
+    def call(self, x, training=None):
+        calls = []
+
+        def block(x):
+            # Only the first (forward) call updates the batch normalization moving statistics, the recomputation in
+            # backpropagation normalizes with the same batch statistics without updating them
+            update = not calls
+            calls.append(True)
+            for layer in self.block_layers:
+                if not isinstance(layer, tf.keras.layers.BatchNormalization):
+                    x = layer(x)
+                elif update or not training:
+                    x = layer(x, training=training)
+                else:
+                    mean, variance = tf.nn.moments(x, axes=[0, 1, 2])
+                    x = tf.nn.batch_normalization(x, mean, variance, layer.beta, layer.gamma, layer.epsilon)
+            return x
+        if training:
+            return tf.recompute_grad(block)(x)
+        return block(x)
+
+    def get_config(self):
+        config = super().get_config()
+        config.update({"channels": self.channels, "use_bn": self.use_bn, "activation": self.activation,
+                       "block_type": self.block_type})
+        return config
+
+
+class AccumulatingModel(tf.keras.Model):
+    """Model accumulating gradients over micro batches before each weight update
+
+    Each batch is split in micro_batches parts processed one at a time, so only the activations of one part are
+    kept in memory, while the weight updates are the same as for the whole batch.
+    """
+    def __init__(self, *args, micro_batches=1, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.micro_batches = micro_batches
+
+    def train_step(self, data):
+        if self.micro_batches <= 1:
+            return super().train_step(data)
+        x, y = data[:2]
+        batch_sz = tf.shape(y)[0]
+        # Never more micro batches than samples, and boundaries spread evenly, so no micro batch is empty
+        n_micro = tf.minimum(self.micro_batches, batch_sz)
+        grads = [tf.zeros_like(v) for v in self.trainable_variables]
+        for k in tf.range(n_micro):
+            start = k * batch_sz // n_micro
+            end = (k + 1) * batch_sz // n_micro
+            micro_x = tf.nest.map_structure(lambda t: t[start:end], x)
+            micro_y = y[start:end]
+            with tf.GradientTape() as tape:
+                pred = self(micro_x, training=True)
+                # Weighted by the size of the micro batch, so the sum is the mean loss of the batch
+                loss = self.compiled_loss(micro_y, pred, regularization_losses=self.losses) * \
+                    tf.cast(end - start, tf.float32) / tf.cast(batch_sz, tf.float32)
+            micro_grads = tape.gradient(loss, self.trainable_variables)
+            grads = [g if mg is None else g + mg for g, mg in zip(grads, micro_grads)]
+            self.compiled_metrics.update_state(micro_y, pred)
+        self.optimizer.apply_gradients(zip(grads, self.trainable_variables))
+        return {m.name: m.result() for m in self.metrics}
+
+    def get_config(self):
+        config = super().get_config()
+        config["micro_batches"] = self.micro_batches
+        return config
+
+    @classmethod
+    def from_config(cls, config, custom_objects=None):
+        # The functional model is rebuilt from inputs and outputs only, so micro_batches is set afterwards
+        config = dict(config)
+        micro_batches = config.pop("micro_batches", 1)
+        model = super().from_config(config, custom_objects)
+        model.micro_batches = micro_batches
+        return model
+
+
+# Custom layers and models, for loading saved models
+custom_objects = {"RecomputeBlock": RecomputeBlock, "AccumulatingModel": AccumulatingModel}
+
+
+def build_model(inputs, outputs, micro_batches=1):
+    """Create model, accumulating gradients over micro batches if micro_batches > 1"""
+    if micro_batches > 1:
+        return AccumulatingModel(inputs=inputs, outputs=outputs, micro_batches=micro_batches)
+    return tf.keras.models.Model(inputs=inputs, outputs=outputs)
+
+
+def cnn_block(x, channels, block_name, use_bn, activation, recompute=False, block_type="standard"):
+    """Create bn-conv2D-bn-conv2D block, recomputing activations in backpropagation if recompute
+
+    block_type "standard" uses full 3x3 convolutions, "separable" depthwise-separable 3x3 convolutions
+    """
+
+    if recompute:
+        return RecomputeBlock(channels, use_bn, activation, block_type, name=block_name)(x)
+    conv_layer = block_conv_layers[block_type]
 
     if use_bn:
         # Batch normalization without learned gamma - beta parameters (as there is a linear transform in the next stage)
         x = tf.keras.layers.BatchNormalization(name=block_name + "_norm1", center=False, scale=False)(x)
 
     # 3x3 convolution layer
-    x = tf.keras.layers.Conv2D(channels, (3, 3), padding="same",
+    x = conv_layer(channels, (3, 3), padding="same",
                                    name=block_name+"_conv1",
                                    activation=activation,
                                    data_format="channels_last")(x)
@@ -37,7 +271,7 @@ def cnn_block(x, channels, block_name, use_bn, activation):
         x = tf.keras.layers.BatchNormalization(name=block_name + "_norm2", center=False, scale=False)(x)
 
     # 3x3 convolution layer
-    x = tf.keras.layers.Conv2D(channels, (3, 3), padding="same",
+    x = conv_layer(channels, (3, 3), padding="same",
                                    name=block_name+"_conv2",
                                    activation=activation,
                                    data_format="channels_last")(x)
@@ -45,9 +279,29 @@ def cnn_block(x, channels, block_name, use_bn, activation):
     return x
 
 
+def upsample_block(x, channels, block_name, activation, upsample="transpose"):
+    """Double resolution, with a transposed 3x3 convolution ("transpose") or bilinear interpolation followed by a
+    1x1 convolution ("bilinear")"""
+    if upsample == "transpose":
+        return tf.keras.layers.Conv2DTranspose(channels, (3, 3), strides=(2, 2),
+                                               name=block_name+"_upconv", activation=activation, padding='same')(x)
+    if upsample == "bilinear":
+        x = tf.keras.layers.UpSampling2D((2, 2), interpolation="bilinear", name=block_name+"_upsample")(x)
+        return tf.keras.layers.Conv2D(channels, (1, 1), padding="same", name=block_name+"_upconv",
+                                      activation=activation, data_format="channels_last")(x)
+    raise ValueError("illegal upsampling: " + upsample)
+
+
 def unet_model(patch_height, patch_width, n_input_ch, n_output_cat, depth, n_features=32,
-               use_bn=True, dropout=0.0, activation="relu"):
-    """Create unet model"""
+               use_bn=True, dropout=0.0, activation="relu", recompute=False, micro_batches=1,
+               block_type="standard", upsample="transpose", width=1.0):
+    """Create unet model
+
+    recompute and micro_batches reduce training memory, see :class:'cnn.RecomputeBlock' and
+    :class:'cnn.AccumulatingModel'. block_type and upsample select lighter layers, see :func:'cnn.cnn_block()' and
+    :func:'cnn.upsample_block()', and width scales the number of features of all layers.
+    """
+    n_features = max(int(round(n_features * width)), 1)
 
     # Input tensor
     x = input = tf.keras.layers.Input((patch_height, patch_width, n_input_ch))
@@ -57,7 +311,7 @@ def unet_model(patch_height, patch_width, n_input_ch, n_output_cat, depth, n_fea
     for i in range(1, depth):
         block_name = "block_down" + str(i)
         # Convolution - normalize block
-        block = cnn_block(x, n_features * 2 ** (i-1), block_name, use_bn, activation)
+        block = cnn_block(x, n_features * 2 ** (i-1), block_name, use_bn, activation, recompute, block_type)
         # Save output for upsampling stage
         block_down.append(block)
         # Downsample
@@ -65,22 +319,20 @@ def unet_model(patch_height, patch_width, n_input_ch, n_output_cat, depth, n_fea
                                              data_format="channels_last")(block)
 
     # Final downsampled block
-    x = cnn_block(x, n_features * 2 ** (depth-1), "block_bottom", use_bn, activation)
+    x = cnn_block(x, n_features * 2 ** (depth-1), "block_bottom", use_bn, activation, recompute, block_type)
 
     # Upsample
     for i in reversed(range(1, depth)):
         block_name = "block_up" + str(i)
         # Upsample
-        up =  tf.keras.layers.Conv2DTranspose(n_features * 2**(i-1), (3, 3), strides=(2, 2),
-                                              name=block_name+"_upconv", activation=activation, padding='same') (x)
-        # up = tf.keras.layers.UpSampling2D((2,2), name=block_name+"_upsample")(x)
+        up = upsample_block(x, n_features * 2**(i-1), block_name, activation, upsample)
         # Add input from downsampling stage
         cnct = tf.keras.layers.concatenate([up, block_down[i-1]], name=block_name+"_concat")
         # Dropout
         if dropout > 0:
             cnct = tf.keras.layers.Dropout(dropout, name=block_name+"_drop")(cnct)
         # Convolution block
-        x = cnn_block(cnct, n_features * 2 ** (i-1), block_name, False, activation)
+        x = cnn_block(cnct, n_features * 2 ** (i-1), block_name, False, activation, recompute, block_type)
 
     # Output layers with 1x1 "convolution"
     # Dropout
@@ -96,12 +348,19 @@ def unet_model(patch_height, patch_width, n_input_ch, n_output_cat, depth, n_fea
                                     data_format="channels_last")(x)
 
     # model
-    model = tf.keras.models.Model(inputs=input, outputs=output)
+    model = build_model(input, output, micro_batches)
     return model
 
 def unet_model2(patch_height, patch_width, n_input_ch_10, n_input_ch_20, n_output_cat, depth, n_features=32,
-               use_bn=True, dropout=0.0, activation="relu"):
-    """Create unet model with dual resolution input"""
+               use_bn=True, dropout=0.0, activation="relu", recompute=False, micro_batches=1,
+               block_type="standard", upsample="transpose", width=1.0):
+    """Create unet model with dual resolution input
+
+    recompute and micro_batches reduce training memory, see :class:'cnn.RecomputeBlock' and
+    :class:'cnn.AccumulatingModel'. block_type and upsample select lighter layers, see :func:'cnn.cnn_block()' and
+    :func:'cnn.upsample_block()', and width scales the number of features of all layers.
+    """
+    n_features = max(int(round(n_features * width)), 1)
 
     # Input tensor1
     input10 = tf.keras.layers.Input((patch_height, patch_width, n_input_ch_10))
@@ -113,7 +372,7 @@ def unet_model2(patch_height, patch_width, n_input_ch_10, n_input_ch_20, n_outpu
     # First downsample block
     block_name = "input10_block_down1"
     # Convolution - normalize block
-    block = cnn_block(input10, n_features, block_name, use_bn, activation)
+    block = cnn_block(input10, n_features, block_name, use_bn, activation, recompute, block_type)
     # Save output for upsampling stage
     block_down.append(block)
     # Downsample
@@ -122,7 +381,7 @@ def unet_model2(patch_height, patch_width, n_input_ch_10, n_input_ch_20, n_outpu
 
     # Half resolution input
     block_name = "input20_block_down1"
-    x20 = cnn_block(input20, n_features, block_name, use_bn, activation)
+    x20 = cnn_block(input20, n_features, block_name, use_bn, activation, recompute, block_type)
 
     # Concatenate the two input paths
     x = tf.keras.layers.concatenate([x10, x20], name="input_concat")
@@ -131,7 +390,7 @@ def unet_model2(patch_height, patch_width, n_input_ch_10, n_input_ch_20, n_outpu
     for i in range(2, depth):
         block_name = "block_down" + str(i)
         # Convolution - normalize block
-        block = cnn_block(x, n_features * 2 ** (i-1), block_name, use_bn, activation)
+        block = cnn_block(x, n_features * 2 ** (i-1), block_name, use_bn, activation, recompute, block_type)
         # Save output for upsampling stage
         block_down.append(block)
         # Downsample
@@ -139,27 +398,24 @@ def unet_model2(patch_height, patch_width, n_input_ch_10, n_input_ch_20, n_outpu
                                              data_format="channels_last")(block)
 
     # Final downsampled block
-    x = cnn_block(x, n_features * 2 ** (depth-1), "block_bottom", use_bn, activation)
+    x = cnn_block(x, n_features * 2 ** (depth-1), "block_bottom", use_bn, activation, recompute, block_type)
 
     # Upsample branch
     for i in reversed(range(2, depth)):
         block_name = "block_up" + str(i)
         # Upsample
-        up =  tf.keras.layers.Conv2DTranspose(n_features * 2**(i-1), (3, 3), strides=(2, 2),
-                                              name=block_name+"_upconv", activation=activation, padding='same') (x)
-        # up = tf.keras.layers.UpSampling2D((2,2), name=block_name+"_upsample")(x)
+        up = upsample_block(x, n_features * 2**(i-1), block_name, activation, upsample)
         # Add input from downsampling stage
         cnct = tf.keras.layers.concatenate([up, block_down[i-1]], name=block_name+"_concat")
         # Dropout
         if dropout > 0:
             cnct = tf.keras.layers.Dropout(dropout, name=block_name+"_drop")(cnct)
         # Convolution block
-        x = cnn_block(cnct, n_features * 2 ** (i-1), block_name, False, activation)
+        x = cnn_block(cnct, n_features * 2 ** (i-1), block_name, False, activation, recompute, block_type)
 
     block_name = "block_up1"
     # Last upsample
-    up =  tf.keras.layers.Conv2DTranspose(n_features, (3, 3), strides=(2, 2),
-                                              name=block_name+"_upconv", activation=activation, padding='same') (x)
+    up = upsample_block(x, n_features, block_name, activation, upsample)
 
     # Add input from downsampling stage
     cnct = tf.keras.layers.concatenate([up, block_down[0]], name=block_name+"_concat")
@@ -167,7 +423,7 @@ def unet_model2(patch_height, patch_width, n_input_ch_10, n_input_ch_20, n_outpu
     if dropout > 0:
         cnct = tf.keras.layers.Dropout(dropout, name=block_name+"_drop")(cnct)
     # Convolution block
-    x = cnn_block(cnct, n_features, block_name, False, activation)
+    x = cnn_block(cnct, n_features, block_name, False, activation, recompute, block_type)
 
     # Output layers with 1x1 "convolution"
     # Dropout
@@ -183,7 +439,7 @@ def unet_model2(patch_height, patch_width, n_input_ch_10, n_input_ch_20, n_outpu
                                     data_format="channels_last")(x)
 
     # model
-    model = tf.keras.models.Model(inputs=(input10, input20), outputs=output)
+    model = build_model((input10, input20), output, micro_batches)
     return model
 
 
@@ -219,129 +475,1237 @@ class TrainingData:
         self.xform = ds.GetGeoTransform()
         self.proj = ds.GetProjection()
 
-def main():
-    # parameters
-
-    # Number of output categories
-    n_cat = 14
-    # Number of input channels
-    n_ch_10 = 4
-    n_ch_20 = 6
-
-    # Depth of unet (number of bn-conv-relu-bn-conv-relu blocks)
-    # 3 = 0.7720, 4 = 0.77209
-    depth = 3
-    # Minibatch size
-    batch_size = 70
-    # No epochs
-    epochs = 100
-    # Dropout rate
-        #0.2 = 0.7720
-    drop_rate = 0.50
-    # Activation function
-    activation="relu"
-    # Capacity (number of features in first feature layer)
-    capacity = 32
-    #Optimizer algorithm. So far supported algs are: 'adam', 'adagrad', 'SGD'
-        #So far adam gives best result (adam = 0.7720, adagrad = 0.7428, SGD = 0.72813)
-    optimizer = 'adam'
-
-    # use batch normalization
-    use_bn = True
-    # Do training
-    do_train = True
-    # Do testing
-    do_test = True
+def _conv_flops(layer, height, width, in_ch):
+    """Multiply-add operations (x2) of a convolution layer on an input of height x width x in_ch"""
+    if isinstance(layer, tf.keras.layers.Conv2DTranspose):
+        k_h, k_w = layer.kernel_size
+        return 2 * height * width * k_h * k_w * in_ch * layer.filters
+    if isinstance(layer, tf.keras.layers.SeparableConv2D):
+        k_h, k_w = layer.kernel_size
+        out_h, out_w = height // layer.strides[0], width // layer.strides[1]
+        depthwise = 2 * out_h * out_w * k_h * k_w * in_ch * layer.depth_multiplier
+        return depthwise + 2 * out_h * out_w * in_ch * layer.depth_multiplier * layer.filters
+    if isinstance(layer, tf.keras.layers.Conv2D):
+        k_h, k_w = layer.kernel_size
+        out_h, out_w = height // layer.strides[0], width // layer.strides[1]
+        return 2 * out_h * out_w * k_h * k_w * in_ch * layer.filters
+    return 0
+
+
+def model_report(model, batch_size=1, n_runs=10):
+    """Size and speed of a model
+
+    Parameters
+    ----------
+    model: tf.keras.Model
+    batch_size: int
+        Number of patches in each latency measurement
+    n_runs: int
+        Number of latency measurements, the median is reported
+
+    Returns
+    -------
+    dict
+        "params": number of parameters, "flops": floating point operations of convolutions per patch (analytic),
+        "latency_ms": measured CPU inference time per patch
+    """
+    flops = 0
+    for layer in model.layers:
+        if isinstance(layer, RecomputeBlock):
+            height, width, in_ch = layer.input_shape[1:]
+            for block_layer in layer.block_layers:
+                flops += _conv_flops(block_layer, height, width, in_ch)
+                in_ch = getattr(block_layer, "filters", in_ch)
+        elif isinstance(layer, (tf.keras.layers.Conv2D, tf.keras.layers.SeparableConv2D)):
+            height, width, in_ch = layer.input_shape[1:]
+            flops += _conv_flops(layer, height, width, in_ch)
+
+    # CPU latency
+    inputs = [np.random.rand(batch_size, *shape[1:]).astype('f4') for shape in
+              (t.shape.as_list() for t in model.inputs)]
+    with tf.device("/CPU:0"):
+        model.predict_on_batch(inputs)
+        times = []
+        for _ in range(n_runs):
+            t0 = time.perf_counter()
+            model.predict_on_batch(inputs)
+            times.append(time.perf_counter() - t0)
+    return {"params": model.count_params(), "flops": flops,
+            "latency_ms": float(np.median(times)) * 1000 / batch_size}
+
+
+def read_data_set(set_fn, shard_index=0, num_shards=1):
+    """Read a split of the training data, see :func:'training_data.mix_training_data()'
+
+    Parameters
+    ----------
+    set_fn: str (path)
+        File with one :class:'cnn.TrainingData' line per sample
+    shard_index, num_shards: int
+        Read only every num_shards line, starting at shard_index
+
+    Returns
+    -------
+    x: (ndarray(n, 128, 128, n_channels_10), ndarray(n, 64, 64, n_channels_20))
+        10m and 20m images
+    y: ndarray(n, 128, 128, 1)
+        Target categorical images
+    samples: list(TrainingData)
+    """
+    with open(set_fn, "r") as file:
+        lines = [line.strip() for line in file if line.strip()]
+    samples = [TrainingData(line) for line in lines[shard_index::num_shards]]
+    x = (np.concatenate([np.expand_dims(td.X10, 0) for td in samples], 0),
+         np.concatenate([np.expand_dims(td.X20, 0) for td in samples], 0))
+    y = np.concatenate([np.expand_dims(td.Y, 0) for td in samples], 0)
+    return x, y, samples
+
+
+def create_model(patch_height, patch_width, n_ch_10, n_ch_20, n_cat, depth, capacity=32, use_bn=True,
+                 drop_rate=0.0, activation="relu", optimizer="adam", recompute=False, micro_batches=1,
+                 block_type="standard", upsample="transpose", width=1.0, report=True):
+    """Create and compile a dual resolution unet model, see :func:'cnn.unet_model2()'
+
+    Parameters, FLOPs and latency are printed if report, see :func:'cnn.model_report()'
+    """
+    model = unet_model2(patch_height, patch_width, n_ch_10, n_ch_20, n_cat, depth, n_features=capacity,
+                        use_bn=use_bn, dropout=drop_rate, activation=activation, recompute=recompute,
+                        micro_batches=micro_batches, block_type=block_type, upsample=upsample, width=width)
+    if optimizer == 'adagrad':
+        opz=tf.keras.optimizers.Adagrad()
+    elif optimizer == 'adam':
+        opz=tf.keras.optimizers.Adam()
+    elif optimizer == 'SGD':
+        opz=tf.keras.optimizers.SGD()
+    else:
+        raise ValueError('illegal optimizer chosen: '+ optimizer)
+
+    model.compile(optimizer=opz, loss='sparse_categorical_crossentropy',
+                  metrics=['accuracy'])
+    if report:
+        model.report = model_report(model)
+        print(", ".join(f"{key}: {value:.4g}" for key, value in model.report.items()))
+    return model
+
+
+def cluster_task():
+    """This process' task in a multi worker cluster, from the TF_CONFIG environment variable
+
+    Returns
+    -------
+    num_workers: int
+        Number of processes in the cluster, 1 if not distributed
+    task_index: int
+        Index of this process (chief first)
+    is_chief: bool
+        True for the process responsible for checkpoints, logs and testing
+    """
+    tf_config = json.loads(os.environ.get("TF_CONFIG", "{}"))
+    cluster = tf_config.get("cluster", {})
+    task = tf_config.get("task", {})
+    n_chief = len(cluster.get("chief", []))
+    num_workers = max(n_chief + len(cluster.get("worker", [])), 1)
+    task_type = task.get("type", "worker")
+    task_index = task.get("index", 0) + (n_chief if task_type == "worker" else 0)
+    return num_workers, task_index, task_index == 0
+
+
+def distributed_data_set(strategy, set_fn, global_batch_size):
+    """Distributed dataset where each worker reads its own shard of a split
+
+    Parameters
+    ----------
+    strategy: tf.distribute.Strategy
+    set_fn: str (path)
+        See :func:'cnn.read_data_set()'
+    global_batch_size: int
+        Batch size summed over all workers
+
+    Returns
+    -------
+    dataset: tf.distribute.DistributedDataset
+        Repeated and shuffled (x, y) batches
+    steps: int
+        Number of steps in one pass over the split
+    """
+    def dataset_fn(input_context):
+        x, y, samples = read_data_set(set_fn, input_context.input_pipeline_id, input_context.num_input_pipelines)
+        batch_size = input_context.get_per_replica_batch_size(global_batch_size)
+        return tf.data.Dataset.from_tensor_slices((x, y)).shuffle(len(y)).repeat().batch(batch_size)
+
+    with open(set_fn, "r") as file:
+        n_samples = sum(1 for line in file if line.strip())
+    distribute = getattr(strategy, "distribute_datasets_from_function", None) or \
+        strategy.experimental_distribute_datasets_from_function
+    return distribute(dataset_fn), max(n_samples // global_batch_size, 1)
+
+
+def save_weights(weights, filename):
+    """Write model weights (list of ndarray) as a numpy .npz file, atomically"""
+    tmp_fn = filename + ".tmp"
+    with open(tmp_fn, "wb") as file:
+        np.savez(file, *weights)
+    os.replace(tmp_fn, filename)
+
+
+def load_weights(filename):
+    """Read model weights written by :func:'cnn.save_weights()'"""
+    with np.load(filename) as data:
+        return [data[f"arr_{i}"] for i in range(len(data.files))]
+
+
+def _validation_worker(model_json, valid_fn, subsample, full_every, use_gpu, tasks, results):
+    """Evaluate weight snapshots in a separate process, see :class:'cnn.BackgroundValidation'"""
+    if not use_gpu:
+        tf.config.set_visible_devices([], "GPU")
+    model = tf.keras.models.model_from_json(model_json, custom_objects=custom_objects)
+    model.compile(loss='sparse_categorical_crossentropy', metrics=['accuracy'])
+    valid_x, valid_y, valid_set = read_data_set(valid_fn)
+    # Fixed subsample, so that the results of different epochs are comparable
+    sub = np.sort(np.random.RandomState(0).permutation(len(valid_y))[:subsample]) if subsample else None
+    last_full = -1
+
+    done = False
+    while not done:
+        # Only the latest snapshot is validated, older waiting snapshots are skipped
+        pending = [tasks.get()]
+        while not tasks.empty():
+            pending.append(tasks.get())
+        if pending[-1] is None:
+            done = True
+            pending.pop()
+        for epoch, weights_fn in pending[:-1]:
+            results.put((epoch, weights_fn, None))
+        if not pending:
+            continue
+
+        epoch, weights_fn = pending[-1]
+        model.set_weights(load_weights(weights_fn))
+        logs = {}
+        if sub is not None:
+            loss, acc = model.evaluate([x_part[sub] for x_part in valid_x], valid_y[sub], verbose=0)
+            logs.update(val_loss=loss, val_accuracy=acc)
+        if sub is None or (full_every and epoch - last_full >= full_every):
+            loss, acc = model.evaluate(valid_x, valid_y, verbose=0)
+            prefix = "val_" if sub is None else "val_full_"
+            logs.update({prefix + "loss": loss, prefix + "accuracy": acc})
+            last_full = epoch
+        results.put((epoch, weights_fn, logs))
+    results.put(None)
+
+
+class BackgroundValidation(tf.keras.callbacks.Callback):
+    """Asynchronous checkpoints and validation, so training doesn't wait for either
+
+    The weights are copied to memory at the end of each epoch and written by a background thread. A separate
+    process validates the latest written snapshot, and its results are received in later epochs for early stopping
+    and for keeping the best snapshot. When training ends, the best weights are loaded and the model is saved.
+
+    Parameters
+    ----------
+    checkpoint_fn: str (path)
+        The best model is saved here when training ends
+    valid_fn: str (path)
+        Validation split, see :func:'cnn.read_data_set()'
+    monitor: str
+        "val_loss" or "val_accuracy", of the subsample if subsample, otherwise of the full split
+    patience: int
+        Stop training when the monitored value hasn't improved for this number of validated epochs, 0 = never
+    subsample: int
+        Validate a fixed subsample of this number of samples every epoch, None = full split every epoch
+    full_every: int
+        Also validate the full split every full_every epochs when subsampling, 0 = never
+    use_gpu: bool
+        Run validation on GPU, default on CPU to leave the GPU to training
+    """
+    def __init__(self, checkpoint_fn, valid_fn, monitor="val_loss", patience=10, subsample=None, full_every=5,
+                 use_gpu=False):
+        super().__init__()
+        self.checkpoint_fn = checkpoint_fn
+        self.valid_fn = valid_fn
+        self.monitor = monitor
+        self.patience = patience
+        self.subsample = subsample
+        self.full_every = full_every
+        self.use_gpu = use_gpu
+        self.snapshot_dir = os.path.join(os.path.dirname(checkpoint_fn), "snapshots")
+        self.best_fn = os.path.join(self.snapshot_dir, "best.npz")
+        self.history = []
+
+    def on_train_begin(self, logs=None):
+        os.makedirs(self.snapshot_dir, exist_ok=True)
+        if os.path.exists(self.best_fn):
+            os.remove(self.best_fn)
+        self.best = None
+        self.best_epoch = -1
+        self.last_epoch = -1
+        self.failed = False
+        ctx = multiprocessing.get_context("spawn")
+        self.tasks = ctx.Queue()
+        self.results = ctx.Queue()
+        self.process = ctx.Process(target=_validation_worker,
+                                   args=(self.model.to_json(), self.valid_fn, self.subsample, self.full_every,
+                                         self.use_gpu, self.tasks, self.results), daemon=True)
+        self.process.start()
+
+        # At most two snapshots in memory waiting to be written
+        self.snapshots = queue.Queue(2)
+        self.writer = threading.Thread(target=self._write_snapshots, daemon=True)
+        self.writer.start()
+
+    def _write_snapshots(self):
+        while True:
+            item = self.snapshots.get()
+            if item is None:
+                break
+            epoch, weights = item
+            weights_fn = os.path.join(self.snapshot_dir, f"epoch{epoch:03}.npz")
+            save_weights(weights, weights_fn)
+            self.tasks.put((epoch, weights_fn))
+
+    def _receive(self, block=False):
+        """Handle validation results, returns False when the validation process has finished or died"""
+        while True:
+            try:
+                result = self.results.get(timeout=1.0) if block else self.results.get_nowait()
+            except queue.Empty:
+                if self.process.is_alive():
+                    if block:
+                        continue
+                    return True
+                # Exited without the final None, e.g. unreadable validation split, out of memory
+                print(f"\nValidation process died, exit code {self.process.exitcode}")
+                self.failed = True
+                self.model.stop_training = True
+                return False
+            if result is None:
+                return False
+            epoch, weights_fn, logs = result
+            if logs is None:
+                os.remove(weights_fn)
+                continue
+            print(f"\nValidation epoch {epoch + 1}: " + ", ".join(f"{key}: {value:.4f}" for key, value in logs.items()))
+            self.history.append(dict(logs, epoch=epoch))
+            value = logs[self.monitor]
+            improved = self.best is None or (value > self.best if "acc" in self.monitor else value < self.best)
+            if improved:
+                self.best = value
+                self.best_epoch = epoch
+                os.replace(weights_fn, self.best_fn)
+            else:
+                os.remove(weights_fn)
+            if self.patience and epoch - self.best_epoch >= self.patience:
+                self.model.stop_training = True
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.snapshots.put((epoch, [np.copy(w) for w in self.model.get_weights()]))
+        self.last_epoch = epoch
+        if not self.failed:
+            self._receive()
+
+    def on_train_end(self, logs=None):
+        self.snapshots.put(None)
+        self.writer.join()
+        self.tasks.put(None)
+        if not self.failed:
+            self._receive(block=True)
+        self.process.join()
+
+        with open(os.path.join(os.path.dirname(self.checkpoint_fn), "validation.json"), "w") as file:
+            json.dump(self.history, file)
+        # Best validated weights, or the current weights if none were validated
+        if os.path.exists(self.best_fn):
+            self.model.set_weights(load_weights(self.best_fn))
+        self.model.save(self.checkpoint_fn)
+        if self.failed:
+            raise Exception(f"Validation process failed (exit code {self.process.exitcode}), "
+                            f"saved {'best validated' if self.best is not None else 'current'} weights")
+
+
+def cache_soft_targets(teacher, set_fn, cache_fn, batch_size=32, teacher_fn=None):
+    """Predict class probabilities of a split with a teacher model, and store them quantized to 8 bits
+
+    The cache is reused as long as it is newer than the split file and the saved teacher model.
+
+    Parameters
+    ----------
+    teacher: tf.keras.Model
+    set_fn: str (path)
+        See :func:'cnn.read_data_set()'
+    cache_fn: str (path)
+        Numpy file of uint8 probabilities (n, rows, cols, n_cat), probability = value / 255
+    batch_size: int
+    teacher_fn: str (path)
+        Saved teacher model
+
+    Returns
+    -------
+    ndarray(uint8)
+        Memory mapped soft targets
+    """
+    sources = [set_fn] + ([teacher_fn] if teacher_fn else [])
+    if not os.path.exists(cache_fn) or \
+            os.path.getmtime(cache_fn) < max(os.path.getmtime(fn) for fn in sources):
+        x, y, samples = read_data_set(set_fn)
+        os.makedirs(os.path.dirname(cache_fn), exist_ok=True)
+        tmp_fn = cache_fn + ".tmp.npy"
+        soft = np.lib.format.open_memmap(tmp_fn, mode="w+", dtype="B",
+                                         shape=y.shape[:3] + (teacher.output_shape[-1],))
+        for i in range(0, len(y), batch_size):
+            prob = teacher.predict_on_batch([x_part[i:i + batch_size] for x_part in x])
+            soft[i:i + batch_size] = np.round(np.asarray(prob) * 255)
+        soft.flush()
+        del soft
+        os.replace(tmp_fn, cache_fn)
+    return np.load(cache_fn, mmap_mode="r")
+
+
+class DistillationSequence(tf.keras.utils.Sequence):
+    """Batches of input images and combined hard and soft targets
+
+    The targets are the hard category followed by the dequantized teacher probabilities in the last axis,
+    see :func:'cnn.distillation_loss()'
+    """
+    def __init__(self, x, y, soft, batch_size, shuffle=True):
+        self.x = x
+        self.y = y
+        self.soft = soft
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.order = np.arange(len(y))
+        self.on_epoch_end()
+
+    def __len__(self):
+        return int(np.ceil(len(self.y) / self.batch_size))
+
+    def __getitem__(self, ix):
+        # Sorted, for sequential reads from the memory map
+        batch = np.sort(self.order[ix * self.batch_size:(ix + 1) * self.batch_size])
+        soft = self.soft[batch].astype('f4') + 0.5 / 255
+        soft /= soft.sum(axis=-1, keepdims=True)
+        return [x_part[batch] for x_part in self.x], np.concatenate([self.y[batch].astype('f4'), soft], -1)
+
+    def on_epoch_end(self):
+        if self.shuffle:
+            np.random.shuffle(self.order)
+
+
+def distillation_loss(alpha=0.5):
+    """Loss mixing cross entropy with hard targets and Kullback-Leibler divergence from teacher probabilities
+
+    Parameters
+    ----------
+    alpha: float
+        Weight of the soft targets, 1 - alpha is the weight of the hard targets
+    """
+    def loss(y_true, y_pred):
+        hard = y_true[..., 0]
+        soft = y_true[..., 1:]
+        y_pred = tf.clip_by_value(y_pred, 1e-7, 1.0)
+        ce = tf.keras.losses.sparse_categorical_crossentropy(hard, y_pred)
+        kl = tf.reduce_sum(soft * (tf.math.log(tf.clip_by_value(soft, 1e-7, 1.0)) - tf.math.log(y_pred)), axis=-1)
+        return alpha * kl + (1 - alpha) * ce
+    return loss
+
+
+def hard_accuracy(y_true, y_pred):
+    """Accuracy against the hard targets of combined distillation targets"""
+    return tf.keras.metrics.sparse_categorical_accuracy(y_true[..., :1], y_pred)
+
+
+def distill(teacher_fn, student_fn, student_config, alpha=0.5, batch_size=70, epochs=100,
+            cache_path=None):
+    """Train a small student model from a trained teacher model
+
+    Soft targets of the teacher are computed once for the training and validation splits and cached (see
+    :func:'cnn.cache_soft_targets()'). The student is trained on a mix of soft and hard targets, and compared
+    with the teacher on the test split.
+
+    Parameters
+    ----------
+    teacher_fn, student_fn: str (path)
+        Saved teacher model, and where to save the best student model
+    student_config: dict
+        Keyword arguments of :func:'cnn.create_model()', e.g. depth, capacity, block_type, width
+    alpha: float
+        Weight of soft targets, see :func:'cnn.distillation_loss()'
+    batch_size, epochs: int
+    cache_path: str (path)
+        Directory of soft target caches, default "soft_targets" next to the teacher model
+
+    Returns
+    -------
+    dict
+        Test accuracy of teacher and student, accuracy gap and speedup (teacher latency / student latency)
+    """
+    teacher = tf.keras.models.load_model(teacher_fn, custom_objects=custom_objects)
+    cache_path = cache_path or os.path.join(os.path.dirname(teacher_fn), "soft_targets")
+    train_fn = os.path.join(training_data.data_path, "train_set.txt")
+    valid_fn = os.path.join(training_data.data_path, "valid_set.txt")
+    test_fn = os.path.join(training_data.data_path, "test_set.txt")
+
+    train_soft = cache_soft_targets(teacher, train_fn, os.path.join(cache_path, "train.npy"), teacher_fn=teacher_fn)
+    valid_soft = cache_soft_targets(teacher, valid_fn, os.path.join(cache_path, "valid.npy"), teacher_fn=teacher_fn)
+    train_x, train_y, train_set = read_data_set(train_fn)
+    valid_x, valid_y, valid_set = read_data_set(valid_fn)
+
+    # Student model
+    patch_sz = train_x[0].shape[1]
+    student = create_model(patch_sz, patch_sz, train_x[0].shape[3], train_x[1].shape[3], teacher.output_shape[-1],
+                           **student_config)
+    student.compile(optimizer=student.optimizer, loss=distillation_loss(alpha), metrics=[hard_accuracy])
+    os.makedirs(os.path.dirname(student_fn), exist_ok=True)
+    cb = [tf.keras.callbacks.ModelCheckpoint(student_fn, monitor='val_hard_accuracy', mode='max', verbose=1,
+                                             save_best_only=True),
+          tf.keras.callbacks.EarlyStopping(monitor="val_loss", patience=10)]
+    student.fit(DistillationSequence(train_x, train_y, train_soft, batch_size), callbacks=cb,
+                validation_data=DistillationSequence(valid_x, valid_y, valid_soft, batch_size, shuffle=False),
+                epochs=epochs)
+
+    # Compare on test split, the saved student is compiled with the distillation loss
+    student = tf.keras.models.load_model(student_fn, compile=False, custom_objects=custom_objects)
+    test_x, test_y, test_set = read_data_set(test_fn)
+    result = {}
+    for name, model in (("teacher", teacher), ("student", student)):
+        pred = np.argmax(model.predict(test_x, batch_size=batch_size), axis=-1)
+        result[name + "_accuracy"] = float(np.mean(pred == test_y[..., 0]))
+        result[name + "_latency_ms"] = model_report(model)["latency_ms"]
+    result["accuracy_gap"] = result["teacher_accuracy"] - result["student_accuracy"]
+    result["speedup"] = result["teacher_latency_ms"] / result["student_latency_ms"]
+    print(", ".join(f"{key}: {value:.4g}" for key, value in result.items()))
+    return result
+
+
+def learning_rate_schedule(schedule, steps):
+    """Learning rate schedule for fine-tuning
+
+    Parameters
+    ----------
+    schedule: (str, float, ...)
+        ("constant", lr), ("cosine", lr, final fraction of lr) or ("exponential", lr, decay rate per epoch)
+    steps: int
+        Number of training steps, or steps per epoch for "exponential"
+
+    Returns
+    -------
+    float or tf.keras.optimizers.schedules.LearningRateSchedule
+    """
+    kind, lr = schedule[:2]
+    if kind == "constant":
+        return lr
+    if kind == "cosine":
+        return tf.keras.optimizers.schedules.CosineDecay(lr, steps, alpha=schedule[2] if len(schedule) > 2 else 0.0)
+    if kind == "exponential":
+        return tf.keras.optimizers.schedules.ExponentialDecay(lr, steps, schedule[2] if len(schedule) > 2 else 0.5)
+    raise ValueError("illegal learning rate schedule: " + kind)
+
+
+def _read_lines(filename):
+    with open(filename, "r") as file:
+        return [line.strip() for line in file if line.strip()]
+
+
+def latest_version(versions_dir):
+    """Directory of the latest model version, None if there are no versions, see :func:'cnn.fine_tune()'"""
+    versions = sorted(glob.glob(os.path.join(versions_dir, "v[0-9][0-9][0-9]")))
+    return versions[-1] if versions else None
+
+
+def _publish_version(tmp_dir, version):
+    """Rename a version built in tmp_dir into place, only complete versions are found by :func:'cnn.latest_version()'"""
+    for fn in ("model.hdf5", "meta.json", "seen_set.txt"):
+        if not os.path.exists(os.path.join(tmp_dir, fn)):
+            raise Exception(f"Incomplete model version {version}, missing {fn} in {tmp_dir}")
+    os.rename(tmp_dir, version)
+    return version
+
+
+def _version_tmp_dir(version):
+    """Empty temporary directory of a version being built, left overs of an interrupted run are removed"""
+    tmp_dir = version + ".tmp"
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+    return tmp_dir
+
+
+def fine_tune(model_fn, versions_dir, new_samples=None, replay_sz=1000, epochs=5, batch_size=70,
+              schedule=("cosine", 1e-4, 0.01), training_path=None, label_name="AR5"):
+    """Continue training a model on new training patches, mixed with a replay sample of the patches seen before
+
+    Each fine-tuned model is stored as a new version "v<nnn>" in versions_dir, with the patches it was trained on
+    (train_set.txt), all patches seen by it and its predecessors (seen_set.txt) and meta.json. The first version
+    "v000" is the model in model_fn, with the training split in data_path as seen patches. The validation split in
+    data_path is used for checkpoints, and patches of the validation and test splits are never trained on.
+
+    Parameters
+    ----------
+    model_fn: str (path)
+        Trained model, used if there are no versions
+    versions_dir: str (path)
+    new_samples: list((str, str, str))
+        New patches, default all patches of :func:'training_data.select_training_data()' not seen before
+    replay_sz: int
+        Number of previously seen patches mixed into the training data
+    epochs, batch_size: int
+    schedule: tuple
+        Learning rate schedule, see :func:'cnn.learning_rate_schedule()'
+    training_path, label_name: str
+        See :func:'training_data.select_training_data()'
+
+    Returns
+    -------
+    str (path)
+        Directory of the new version, or of the latest version if there are no new patches
+    """
+    valid_fn = os.path.join(training_data.data_path, "valid_set.txt")
+    test_fn = os.path.join(training_data.data_path, "test_set.txt")
+
+    parent = latest_version(versions_dir)
+    if not parent:
+        # Initial version from the model trained on the full training split
+        parent = os.path.join(versions_dir, "v000")
+        tmp_dir = _version_tmp_dir(parent)
+        model = tf.keras.models.load_model(model_fn, custom_objects=custom_objects)
+        model.save(os.path.join(tmp_dir, "model.hdf5"))
+        train_set = _read_lines(os.path.join(training_data.data_path, "train_set.txt"))
+        training_data.write_data_set([ast.literal_eval(line) for line in train_set],
+                                     os.path.join(tmp_dir, "train_set.txt"))
+        training_data.write_data_set([ast.literal_eval(line) for line in train_set],
+                                     os.path.join(tmp_dir, "seen_set.txt"))
+        with open(os.path.join(tmp_dir, "meta.json"), "w") as file:
+            json.dump({"parent": None, "source": model_fn, "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                       "n_new": len(train_set), "n_replay": 0}, file, indent=2)
+        _publish_version(tmp_dir, parent)
+
+    # New patches, not seen before and not in the validation and test splits
+    seen = [ast.literal_eval(line) for line in _read_lines(os.path.join(parent, "seen_set.txt"))]
+    excluded = set(seen) | {ast.literal_eval(line) for line in _read_lines(valid_fn) + _read_lines(test_fn)}
+    if new_samples is None:
+        new_samples = training_data.select_training_data(training_path, label_name)
+    new_samples = [sample for sample in dict.fromkeys(tuple(sample) for sample in new_samples)
+                   if sample not in excluded]
+    if not new_samples:
+        print("No new training patches")
+        return parent
+
+    replay = rn.sample(seen, min(replay_sz, len(seen)))
+    version = os.path.join(versions_dir, f"v{int(os.path.basename(parent)[1:]) + 1:03}")
+    # Built in a temporary directory, renamed into place when complete
+    tmp_dir = _version_tmp_dir(version)
+    train_fn = os.path.join(tmp_dir, "train_set.txt")
+    training_data.write_data_set(new_samples + replay, train_fn)
+    training_data.write_data_set(seen + new_samples, os.path.join(tmp_dir, "seen_set.txt"))
+
+    # Fine-tune from the parent version, with a fresh optimizer and the learning rate schedule
+    model = tf.keras.models.load_model(os.path.join(parent, "model.hdf5"), custom_objects=custom_objects)
+    train_x, train_y, train_set = read_data_set(train_fn)
+    valid_x, valid_y, valid_set = read_data_set(valid_fn)
+    steps = int(np.ceil(len(train_y) / batch_size))
+    lr = learning_rate_schedule(schedule, steps * epochs if schedule[0] == "cosine" else steps)
+    model.compile(optimizer=tf.keras.optimizers.Adam(lr), loss='sparse_categorical_crossentropy',
+                  metrics=['accuracy'])
+    parent_loss, parent_acc = model.evaluate(valid_x, valid_y, batch_size=batch_size, verbose=0)
+
+    version_fn = os.path.join(tmp_dir, "model.hdf5")
+    t0 = time.time()
+    history = model.fit(train_x, train_y, batch_size=batch_size, epochs=epochs, validation_data=(valid_x, valid_y),
+                        callbacks=[tf.keras.callbacks.ModelCheckpoint(version_fn, monitor='val_accuracy', mode='max',
+                                                                      verbose=1, save_best_only=True)])
+
+    with open(os.path.join(tmp_dir, "meta.json"), "w") as file:
+        json.dump({"parent": os.path.basename(parent), "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                   "n_new": len(new_samples), "n_replay": len(replay), "epochs": epochs, "batch_size": batch_size,
+                   "schedule": list(schedule), "train_seconds": time.time() - t0,
+                   "parent_val_accuracy": parent_acc, "val_accuracy": max(history.history["val_accuracy"])},
+                  file, indent=2)
+    return _publish_version(tmp_dir, version)
+
+
+# Categories assigned to homogeneous windows by the spectral classifier, see :func:'cnn.spectral_window_classes()'
+spectral_categories = {"water": 10, "snow": 9, "forest": 3, "rock": 7}
+
+
+def spectral_window_classes(bands_10m, bands_20m, i, patch_sz, threshold=0.98):
+    """Classify homogeneous windows of a strip from spectral indices
+
+    The indices NDVI, NDWI and NDSI are computed at 20m from L2A reflectances, and each pixel is tested for open
+    water, snow, dense forest and bare rock. A window is classified if the share of its valid pixels in one class is
+    at least threshold.
+
+    Parameters
+    ----------
+    bands_10m, bands_20m: list(ndarray)
+        Strips of 10m and 20m bands (see :class:'training_data.ImageSet'), same rows as the windows
+    i: ndarray(int)
+        Pixel column of each window in the 10m strips
+    patch_sz: int
+        Size of windows (10m pixels)
+    threshold: float
+        Minimum share of pixels of the class
+
+    Returns
+    -------
+    categories: ndarray(int)
+        Category of each window, see spectral_categories, -1 where ambiguous
+    confidence: ndarray(float)
+        Share of valid pixels in the most common class
+    """
+    b03, b04, b08 = [band[::2, ::2].astype('f4') / 10000 for band in bands_10m[1:4]]
+    b11 = bands_20m[4].astype('f4') / 10000
+    eps = 1e-6
+    ndvi = (b08 - b04) / (b08 + b04 + eps)
+    ndwi = (b03 - b08) / (b03 + b08 + eps)
+    ndsi = (b03 - b11) / (b03 + b11 + eps)
+    valid = (b03 > 0) & (b04 > 0) & (b08 > 0) & (b11 > 0)
+    masks = {
+        "water": valid & (ndwi > 0.2) & (b11 < 0.05),
+        "snow": valid & (ndsi > 0.4) & (b03 > 0.2),
+        "forest": valid & (ndvi > 0.7) & (b04 < 0.04) & (b11 < 0.15),
+        "rock": valid & (ndvi < 0.15) & (ndwi < 0) & (ndsi < 0.2) & (b11 > 0.1),
+    }
+
+    # Share of each class in each window
+    sz = patch_sz // 2
+    x0 = i // 2
+
+    def window_sum(mask):
+        return training_data.window_sums(mask, np.array(0), np.array(sz), x0, x0 + sz)
+
+    n_valid = np.maximum(window_sum(valid), 1)
+    shares = np.array([window_sum(mask) / n_valid for mask in masks.values()])
+    best = np.argmax(shares, axis=0)
+    confidence = shares[best, np.arange(len(i))]
+    categories = np.array([spectral_categories[name] for name in masks])[best]
+    return np.where(confidence >= threshold, categories, -1), confidence
+
+
+def window_grid(xform, cols, rows, patch_sz):
+    """Positions of the windows covering a whole satelite image, for classification
+
+    Unlike :func:'training_data.patch_grid()' the grid starts at the image corner and the last window of each row
+    and column is moved in to end at the image edge, so the whole image, including the overlap with neighbouring
+    tiles, is covered.
+
+    Parameters
+    ----------
+    xform: [x0, x_scale, 0, y0, 0, y_scale]
+        Transform of the 10m images
+    cols, rows: int
+        Size of the 10m images
+    patch_sz: int
+        Size of windows (pixels at base resolution)
+
+    Returns
+    -------
+    n, e: ndarray(int)
+        World coordinates of the upper left corner of each window row and column, rows from north to south
+    j, i: ndarray(int)
+        Pixel position of each window row and column in the 10m images
+    """
+    def starts(size):
+        return np.unique(np.append(np.arange(0, size - patch_sz + 1, patch_sz), max(size - patch_sz, 0)))
+
+    j, i = starts(rows), starts(cols)
+    n = (xform[3] + j * xform[5]).astype(int)
+    e = (xform[0] + i * xform[1]).astype(int)
+    return n, e, j, i
+
+
+def predict_tile(model, image_set, mosaic, batch_size=32, cascade_threshold=None, check_agreement=False,
+                 select=None):
+    """Classify a whole satelite image, one window (patch) at a time
+
+    With cascade_threshold, windows classified by :func:'cnn.spectral_window_classes()' are written directly, and
+    only the other windows are predicted by the model.
+
+    Parameters
+    ----------
+    model: tf.keras.Model
+        Dual resolution model, see :func:'cnn.unet_model2()'
+    image_set: training_data.ImageSet
+    mosaic: PredictionMosaic
+        Mosaic of the tile of image_set
+    batch_size: int
+        Number of windows predicted at a time
+    cascade_threshold: float
+        Confidence threshold of the spectral classifier, None to predict all windows with the model
+    check_agreement: bool
+        Also predict the windows classified by the spectral classifier, to measure agreement with the model
+    select: ndarray(bool)
+        Windows to classify, indexed by window row and column of :func:'cnn.window_grid()', default all
+
+    Returns
+    -------
+    dict
+        Number of windows, number and share of windows skipped, and pixel agreement between the spectral classifier
+        and the model (if check_agreement)
+    """
+    patch_sz = model.input_shape[0][1]
+    ds_10m, cols, rows, xform, proj = training_data.image_set_open(
+        [image_set.get_channel_image_filename(ch) for ch in training_data.ImageSet.ch10m])
+    ds_20m = training_data.image_set_open(
+        [image_set.get_channel_image_filename(ch) for ch in training_data.ImageSet.ch20m])[0]
+    grid_n, grid_e, grid_j, grid_i = window_grid(xform, cols, rows, patch_sz)
+    reader_10m = training_data.StripBuffer(ds_10m, 0, cols)
+    reader_20m = training_data.StripBuffer(ds_20m, 0, cols // 2)
+
+    stats = {"windows": 0, "skipped": 0, "checked": 0, "agree": 0}
+    pending = []
+
+    def predict_pending():
+        x = (np.stack([window[2] for window in pending]), np.stack([window[3] for window in pending]))
+        cats = np.argmax(model.predict_on_batch(x), axis=-1).astype("B")
+        for (n, e, x10, x20, nodata, cheap_cat), cat in zip(pending, cats):
+            if cheap_cat >= 0:
+                # Already written, only compared
+                stats["checked"] += int(np.sum(~nodata))
+                stats["agree"] += int(np.sum((cat == cheap_cat) & ~nodata))
+                continue
+            cat[nodata] = mosaic.nodata
+            mosaic.write(cat, (e, xform[1], 0, n, 0, xform[5]))
+        pending.clear()
+
+    for row_ix, (n, j) in enumerate(zip(grid_n, grid_j)):
+        if select is not None and not np.any(select[row_ix]):
+            continue
+        bands_10m = reader_10m.read(j, j + patch_sz)
+        bands_20m = reader_20m.read(j // 2, (j + patch_sz) // 2)
+        if cascade_threshold is not None:
+            cheap_cats, confidence = spectral_window_classes(bands_10m, bands_20m, grid_i, patch_sz,
+                                                             cascade_threshold)
+        else:
+            cheap_cats = np.full(len(grid_i), -1)
+
+        for col_ix, (e, i, cheap_cat) in enumerate(zip(grid_e, grid_i, cheap_cats)):
+            if select is not None and not select[row_ix, col_ix]:
+                continue
+            x10 = np.stack([band[:, i:i + patch_sz] for band in bands_10m], -1).astype('f4') / (2 ** 16 - 1)
+            x20 = np.stack([band[:, i // 2:(i + patch_sz) // 2] for band in bands_20m], -1).astype('f4') / (2 ** 16 - 1)
+            nodata = np.any(x10 == 0, axis=-1)
+            if np.all(nodata):
+                continue
+            stats["windows"] += 1
+            if cheap_cat >= 0:
+                stats["skipped"] += 1
+                cat = np.full((patch_sz, patch_sz), cheap_cat, dtype="B")
+                cat[nodata] = mosaic.nodata
+                mosaic.write(cat, (e, xform[1], 0, n, 0, xform[5]))
+                if not check_agreement:
+                    continue
+            pending.append((n, e, x10, x20, nodata, cheap_cat))
+            if len(pending) >= batch_size:
+                predict_pending()
+    if pending:
+        predict_pending()
+
+    report = {"windows": stats["windows"], "skipped": stats["skipped"],
+              "skip_rate": stats["skipped"] / max(stats["windows"], 1)}
+    if check_agreement:
+        report["agreement"] = stats["agree"] / max(stats["checked"], 1)
+    return report
+
+
+def low_res_reflectance(image_set, cols, rows, scale=6, channels=("B03", "B04", "B08", "B11")):
+    """Reduced resolution read of L2A reflectances (0 where nodata), served from JP2 resolution levels or overviews
+
+    Parameters
+    ----------
+    image_set: training_data.ImageSet
+    cols, rows: int
+        Size of the 10m images
+    scale: int
+        Pixel size relative to the 10m images
+
+    Returns
+    -------
+    ndarray(len(channels), rows // scale, cols // scale)
+    """
+    bands = []
+    for channel in channels:
+        ds = gdal.Open(image_set.get_channel_image_filename(channel))
+        bands.append(ds.GetRasterBand(1).ReadAsArray(buf_xsize=cols // scale, buf_ysize=rows // scale))
+    return np.array(bands, dtype='f4') / 10000
+
+
+def predict_tile_incremental(model, image_set, mosaic, provenance_fn=None, change_threshold=0.02, max_cloud=0.1,
+                             max_snow=0.1, scale=6, data_path=training_data.data_path, **kwargs):
+    """Update the classification of a tile with a new satelite image, only where needed
+
+    A window is classified again if it has not been classified before, if the image it was classified from was
+    obscured by cloud or snow, or if the mean absolute reflectance difference between the new image and that image
+    is above change_threshold. Windows obscured in the new image are not classified again, unless they have never
+    been classified. The satelite image used for each window is recorded in a JSON provenance file.
+
+    Parameters
+    ----------
+    model, image_set, mosaic:
+        See :func:'cnn.predict_tile()'
+    provenance_fn: str (path)
+        Provenance file, default "<mosaic>_provenance.json". {"<n>_<e>": {"image_set", "reason", "cloud", "snow",
+        "change"}}
+    change_threshold: float
+        Reflectance difference (0-1) of a changed window
+    max_cloud, max_snow: float
+        Maximum share of cloud and snow of a clear window, see :func:'training_data.screen_patch_grid()'
+    scale: int
+        Resolution of the comparison relative to the 10m images
+    data_path: str (path)
+        Directory of the previous satelite images, see :class:'training_data.ImageSet'
+    kwargs:
+        Passed to :func:'cnn.predict_tile()'
+
+    Returns
+    -------
+    dict
+        Number of windows classified again for each reason, and number of windows kept
+    """
+    provenance_fn = provenance_fn or os.path.splitext(mosaic.filename)[0] + "_provenance.json"
+    provenance = {}
+    if os.path.exists(provenance_fn):
+        with open(provenance_fn) as file:
+            provenance = json.load(file)
+
+    patch_sz = model.input_shape[0][1]
+    ds_10m, cols, rows, xform, proj = training_data.image_set_open(
+        [image_set.get_channel_image_filename(ch) for ch in training_data.ImageSet.ch10m])
+    grid_n, grid_e, grid_j, grid_i = window_grid(xform, cols, rows, patch_sz)
+    keys = np.array([[f"{n}_{e}" for e in grid_e] for n in grid_n], dtype=object).reshape(len(grid_n), len(grid_e))
+
+    # Cloud and snow of the new image
+    layers = training_data.screen_layers(image_set, None, None, xform, cols, rows, proj)
+    cloud = training_data.grid_window_means(*layers["cloud"], grid_j, grid_i, patch_sz)
+    snow = training_data.grid_window_means(*layers["snow"], grid_j, grid_i, patch_sz)
+    clear = (cloud < max_cloud) & (snow < max_snow)
+
+    # Reflectance difference from the image each window was classified from
+    change = np.full(keys.shape, np.inf)
+    new_bands = low_res_reflectance(image_set, cols, rows, scale)
+    for previous_name in {record["image_set"] for record in provenance.values()}:
+        try:
+            previous_bands = low_res_reflectance(training_data.ImageSet(data_path, previous_name), cols, rows, scale)
+        except ValueError:
+            # Previous image not available, its windows count as changed
+            continue
+        diff = np.mean(np.abs(new_bands - previous_bands), axis=0)
+        # Nodata in either image counts as changed
+        diff[np.any(new_bands == 0, axis=0) | np.any(previous_bands == 0, axis=0)] = 1.0
+        window_diff = training_data.grid_window_means(diff, cols / (cols // scale), grid_j, grid_i, patch_sz)
+        from_previous = np.vectorize(lambda key: provenance.get(key, {}).get("image_set") == previous_name,
+                                     otypes=[bool])(keys)
+        change[from_previous] = window_diff[from_previous]
+
+    known = np.vectorize(lambda key: key in provenance, otypes=[bool])(keys)
+    was_obscured = np.vectorize(lambda key: provenance.get(key, {}).get("obscured", False), otypes=[bool])(keys)
+    reasons = np.full(keys.shape, "", dtype="U8")
+    reasons[~known] = "new"
+    reasons[known & was_obscured & clear] = "cleared"
+    reasons[known & ~was_obscured & clear & (change > change_threshold)] = "changed"
+    select = reasons != ""
+
+    predict_tile(model, image_set, mosaic, select=select, **kwargs)
+
+    for row_ix, col_ix in zip(*np.nonzero(select)):
+        provenance[keys[row_ix, col_ix]] = {
+            "image_set": image_set.image_set_name,
+            "reason": reasons[row_ix, col_ix],
+            "obscured": not bool(clear[row_ix, col_ix]),
+            "cloud": float(cloud[row_ix, col_ix]),
+            "snow": float(snow[row_ix, col_ix]),
+            "change": float(change[row_ix, col_ix]) if np.isfinite(change[row_ix, col_ix]) else None,
+        }
+    tmp_fn = provenance_fn + ".tmp"
+    with open(tmp_fn, "w") as file:
+        json.dump(provenance, file)
+    os.replace(tmp_fn, provenance_fn)
+
+    report = {reason: int(np.sum(reasons == reason)) for reason in ("new", "cleared", "changed")}
+    report["kept"] = int(np.sum(~select))
+    return report
+
+
+def _peak_memory(args):
+    """Train a few steps on random data in a fresh process, and return the peak resident memory (MB)"""
+    config, batch_size, steps = args
+    patch_sz = config.get("patch_sz", 128)
+    model = create_model(patch_sz, patch_sz, 4, 6, 14, config.get("depth", 3), config.get("capacity", 32),
+                         recompute=config.get("recompute", False), micro_batches=config.get("micro_batches", 1),
+                         report=False)
+    x = (np.random.rand(batch_size * steps, patch_sz, patch_sz, 4).astype('f4'),
+         np.random.rand(batch_size * steps, patch_sz // 2, patch_sz // 2, 6).astype('f4'))
+    y = np.random.randint(0, 14, (batch_size * steps, patch_sz, patch_sz, 1))
+    model.fit(x, y, batch_size=batch_size, epochs=1, verbose=0)
+    # Kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def memory_report(configs, batch_size=70, steps=2):
+    """Peak training memory of model configurations
+
+    Each configuration is trained for a few steps in a separate process, so the peak memory of one configuration
+    doesn't hide the others.
+
+    Parameters
+    ----------
+    configs: list(dict)
+        Keyword arguments depth, patch_sz, capacity, recompute and micro_batches, see :func:'cnn.create_model()'
+    batch_size: int
+    steps: int
+        Number of training steps
+
+    Returns
+    -------
+    list((dict, float))
+        Configurations and peak resident memory (MB)
+    """
+    report = []
+    ctx = multiprocessing.get_context("spawn")
+    for config in configs:
+        with ctx.Pool(1) as pool:
+            peak = pool.apply(_peak_memory, ((config, batch_size, steps),))
+        print(f"{config}: {peak:.0f} MB")
+        report.append((config, peak))
+    return report
+
+
+def launch_local_workers(num_workers, port=23456, settings=None):
+    """Run this module as a cluster of local worker processes, and wait for them to finish
+
+    Parameters
+    ----------
+    num_workers: int
+    port: int
+        First port number, the workers use consecutive ports
+    settings: dict
+        Keyword arguments of :func:'cnn.main()' in the workers
+
+    Returns
+    -------
+    list(int)
+        Exit codes of the workers
+    """
+    cluster = {"worker": [f"localhost:{port + i}" for i in range(num_workers)]}
+    processes = []
+    for i in range(num_workers):
+        env = dict(os.environ, TF_CONFIG=json.dumps({"cluster": cluster, "task": {"type": "worker", "index": i}}),
+                   CNN_SETTINGS=json.dumps(settings or {}))
+        processes.append(subprocess.Popen([sys.executable, os.path.abspath(__file__)], env=env))
+    return [process.wait() for process in processes]
+
+
+def main(n_cat=14, n_ch_10=4, n_ch_20=6, depth=3, batch_size=70, epochs=100, drop_rate=0.50, activation="relu",
+         capacity=32, optimizer='adam', use_bn=True, do_train=True, do_test=True, block_type='standard',
+         upsample='transpose', width=1.0, recompute=False, micro_batches=1, background_validation=False,
+         valid_subsample=None, full_valid_every=5, fine_tune_new=False, replay_sz=1000, fine_tune_epochs=5,
+         lr_schedule=("cosine", 1e-4, 0.01), local_workers=0, predict_image_sets=(), cascade_threshold=None,
+         check_agreement=False, incremental=False, distill_student=None, run_dir="run", run_name=None,
+         data_path=None, label_name="AR5"):
+    """Train, test and predict with a dual resolution unet model
+
+    Parameters
+    ----------
+    n_cat: int
+        Number of output categories
+    n_ch_10, n_ch_20: int
+        Number of input channels
+    depth: int
+        Depth of unet (number of bn-conv-relu-bn-conv-relu blocks). 3 = 0.7720, 4 = 0.77209
+    batch_size: int
+        Minibatch size
+    epochs: int
+        No epochs
+    drop_rate: float
+        Dropout rate. 0.2 = 0.7720
+    activation: str
+        Activation function
+    capacity: int
+        Capacity (number of features in first feature layer)
+    optimizer: str
+        Optimizer algorithm. So far supported algs are: 'adam', 'adagrad', 'SGD'.
+        So far adam gives best result (adam = 0.7720, adagrad = 0.7428, SGD = 0.72813)
+    use_bn: bool
+        Use batch normalization
+    do_train, do_test: bool
+        Do training, do testing
+    block_type, upsample, width:
+        Block convolutions ('standard' or 'separable'), upsampling ('transpose' or 'bilinear') and width multiplier
+    recompute, micro_batches:
+        Recompute block activations in backpropagation, and number of micro batches per batch, to save memory
+    background_validation, valid_subsample, full_valid_every:
+        Validate in a background process and write checkpoints in a background thread, see
+        :class:'cnn.BackgroundValidation'. Validation of a fixed subsample every epoch and the full split every
+        full_valid_every epochs, None = full split
+    fine_tune_new, replay_sz, fine_tune_epochs, lr_schedule:
+        Fine-tune the latest model version on new training patches instead of training, see :func:'cnn.fine_tune()'
+    local_workers: int
+        Number of local worker processes for data parallel training, 0 = single process.
+        A cluster of several machines is set up with the TF_CONFIG environment variable in each process instead
+    predict_image_sets: list(str)
+        Whole satelite images classified with the model after testing, see :func:'cnn.predict_tile()'
+    cascade_threshold: float
+        Confidence threshold of spectral classification of homogeneous windows, None = model only
+    check_agreement: bool
+        Also classify the spectrally classified windows with the model and report the agreement. This costs the
+        model compute the cascade saves, for evaluating the threshold only
+    incremental: bool
+        Only classify windows changed since the previous images of the tile, see :func:'cnn.predict_tile_incremental()'
+    distill_student: dict
+        Train a smaller student model from this run's model instead, see :func:'cnn.distill()',
+        e.g. {"depth": 3, "capacity": 16, "block_type": "separable"}
+    run_dir: str (path)
+        Directory of runs
+    run_name: str
+        Directory of this run in run_dir, default made from the settings
+    data_path: str (path)
+        Directory of training data splits and satelite images, default training_data.data_path
+    label_name: str
+        Labels of the model, "AR5" or "LDir", used for the new training patches when fine-tuning (see
+        :func:'cnn.fine_tune()') and the legend of the predicted mosaics
+    """
+    if data_path:
+        training_data.data_path = data_path
+
+    if local_workers and "TF_CONFIG" not in os.environ:
+        launch_local_workers(local_workers, settings=dict(locals(), local_workers=0))
+        return
+
+    # Multi worker strategy must be created before any other tensorflow operations
+    num_workers, task_index, is_chief = cluster_task()
+    if num_workers > 1:
+        strategy = tf.distribute.experimental.MultiWorkerMirroredStrategy()
+    else:
+        strategy = tf.distribute.get_strategy()
 
     # Directory and file info
-    run_dir = "run"
-    run_name = f"10m20m_depth{depth:02}_cap{capacity:03}{'_bn_' if use_bn else '_nbn_'}drop{int(drop_rate*100):02}_{activation}_opt{optimizer}_v6_best"
+    if not run_name:
+        run_name = f"10m20m_depth{depth:02}_cap{capacity:03}{'_bn_' if use_bn else '_nbn_'}drop{int(drop_rate*100):02}_{activation}_opt{optimizer}_v6_best"
+        if (block_type, upsample, width) != ('standard', 'transpose', 1.0):
+            run_name += f"_{block_type}_{upsample}_w{int(width * 100):03}"
     #model_fn = model filename
     model_fn = os.path.join(run_dir, run_name, "model.hdf5")
     log_dir = os.path.join(run_dir, run_name, "log")
     test_dir = os.path.join(run_dir, run_name, "test")
     os.makedirs(test_dir, exist_ok=True)
+    # All workers save checkpoints, but only the chief's are kept
+    checkpoint_fn = model_fn if is_chief else os.path.join(run_dir, run_name, f"worker{task_index}", "model.hdf5")
+    os.makedirs(os.path.dirname(checkpoint_fn), exist_ok=True)
+
+    train_fn = os.path.join(training_data.data_path, "train_set.txt")
+    valid_fn = os.path.join(training_data.data_path, "valid_set.txt")
 
     # Callbacks for model fitting and evaluation
-    tensorboard_cb = tf.keras.callbacks.TensorBoard(log_dir=log_dir, histogram_freq=1,
-                                                    write_graph=True, write_grads=True, write_images=False,
-                                                    update_freq='batch')
-    checkpoint_cb = tf.keras.callbacks.ModelCheckpoint(model_fn, monitor='val_acc', verbose=1, save_best_only=True)
-    earlystop_cb = tf.keras.callbacks.EarlyStopping(monitor="val_loss", patience=10)
-
-    model = None
-    if os.path.exists(model_fn):
-        model = tf.keras.models.load_model(model_fn)
-
-    if do_train or not model:
-        # Read training data set
-        with open(os.path.join(training_data.data_path, "train_set.txt"), "r") as file:
-            train_set = [TrainingData(img_fn.strip()) for img_fn in file]
-        # create training tensors
-        train_x = (np.concatenate([np.expand_dims(td.X10, 0) for td in train_set], 0),
-                   np.concatenate([np.expand_dims(td.X20, 0) for td in train_set], 0))
-        train_y = np.concatenate([np.expand_dims(td.Y, 0) for td in train_set], 0)
-
-        # Read validation data set
-        with open(os.path.join(training_data.data_path, "valid_set.txt"), "r") as file:
-            valid_set = [TrainingData(img_fn.strip()) for img_fn in file]
-        # Create validation tensors
-        valid_x = (np.concatenate([np.expand_dims(td.X10, 0) for td in valid_set], 0),
-                   np.concatenate([np.expand_dims(td.X20, 0) for td in valid_set], 0))
-        valid_y = np.concatenate([np.expand_dims(td.Y, 0) for td in valid_set], 0)
+    background_validation = background_validation and num_workers == 1
+    if background_validation:
+        cb = [BackgroundValidation(checkpoint_fn, valid_fn, "val_loss", patience=10, subsample=valid_subsample,
+                                   full_every=full_valid_every)]
+    else:
+        checkpoint_cb = tf.keras.callbacks.ModelCheckpoint(checkpoint_fn, monitor='val_acc', verbose=1,
+                                                           save_best_only=True)
+        earlystop_cb = tf.keras.callbacks.EarlyStopping(monitor="val_loss", patience=10)
+        cb = [checkpoint_cb, earlystop_cb]
+    if is_chief:
+        cb.append(tf.keras.callbacks.TensorBoard(log_dir=log_dir, histogram_freq=1,
+                                                 write_graph=True, write_grads=True, write_images=False,
+                                                 update_freq='batch'))
+
+    if distill_student:
+        student_name = "student_" + "_".join(f"{key}{value}" for key, value in sorted(distill_student.items()))
+        distill(model_fn, os.path.join(run_dir, run_name, student_name, "model.hdf5"), distill_student,
+                batch_size=batch_size, epochs=epochs)
+        return
+
+    if fine_tune_new:
+        # Test and predict with the new version
+        version = fine_tune(model_fn, os.path.join(run_dir, run_name, "versions"), replay_sz=replay_sz,
+                            epochs=fine_tune_epochs, batch_size=batch_size, schedule=lr_schedule,
+                            label_name=label_name)
+        model_fn = os.path.join(version, "model.hdf5")
+        do_train = False
+
+    with strategy.scope():
+        model = None
+        if os.path.exists(model_fn):
+            model = tf.keras.models.load_model(model_fn, custom_objects=custom_objects)
 
         if not model:
-            # If model doesn't exist, create one
-            os.makedirs(os.path.dirname(model_fn), exist_ok=True)
-            model = unet_model2(train_x[0].shape[1], train_x[0].shape[2], n_ch_10, n_ch_20, n_cat, depth, n_features=capacity,
-                               use_bn=use_bn, dropout=drop_rate, activation=activation)
-            if optimizer == 'adagrad':
-                opz=tf.keras.optimizers.Adagrad()
-            elif optimizer == 'adam':
-                opz=tf.keras.optimizers.Adam()
-            elif optimizer == 'SGD':
-                opz=tf.keras.optimizers.SGD()
+            # If model doesn't exist, create one. Patch size from the first training sample
+            do_train = True
+            with open(train_fn, "r") as file:
+                patch_sz = TrainingData(file.readline().strip()).X10.shape[0]
+            model = create_model(patch_sz, patch_sz, n_ch_10, n_ch_20, n_cat, depth, capacity, use_bn, drop_rate,
+                                 activation, optimizer, recompute, micro_batches, block_type, upsample, width,
+                                 report=num_workers == 1)
+            if num_workers == 1:
+                with open(os.path.join(run_dir, run_name, "model_report.json"), "w") as file:
+                    json.dump(model.report, file)
+
+    if do_train:
+        if num_workers > 1:
+            # Each worker reads its own shard, gradients are summed over all workers
+            train_ds, train_steps = distributed_data_set(strategy, train_fn, batch_size)
+            valid_ds, valid_steps = distributed_data_set(strategy, valid_fn, batch_size)
+            model.fit(train_ds, steps_per_epoch=train_steps, callbacks=cb, validation_data=valid_ds,
+                      validation_steps=valid_steps, epochs=epochs)
+        else:
+            # Read training and validation data set
+            train_x, train_y, train_set = read_data_set(train_fn)
+
+            # Do training and validation
+            if background_validation:
+                model.fit(train_x, train_y, callbacks=cb, batch_size=batch_size, epochs=epochs)
             else:
-                raise ValueError('illegal optimizer chosen: '+ optimizer)
-            
-            model.compile(optimizer=opz, loss='sparse_categorical_crossentropy',
-                            metrics=['accuracy'])
-            
-        # Do training and validation
-        cb = [tensorboard_cb, checkpoint_cb, earlystop_cb]
-        model.fit(train_x, train_y, callbacks=cb, validation_data=(valid_x, valid_y), batch_size=batch_size, epochs=epochs)
+                valid_x, valid_y, valid_set = read_data_set(valid_fn)
+                model.fit(train_x, train_y, callbacks=cb, validation_data=(valid_x, valid_y), batch_size=batch_size, epochs=epochs)
+
+    if not is_chief:
+        return
 
     if do_test:
         # Load the "best" model
-        model = tf.keras.models.load_model(model_fn)
+        model = tf.keras.models.load_model(model_fn, custom_objects=custom_objects)
         # Read test data set
-        with open(os.path.join(training_data.data_path, "test_set.txt"), "r") as file:
-            test_set = [TrainingData(img_fn.strip()) for img_fn in file]
-        # Create test data tensors
-        test_x = (np.concatenate([np.expand_dims(td.X10, 0) for td in test_set], 0),
-                  np.concatenate([np.expand_dims(td.X20, 0) for td in test_set], 0))
-        test_y = np.concatenate([np.expand_dims(td.Y, 0) for td in test_set], 0)
+        test_x, test_y, test_set = read_data_set(os.path.join(training_data.data_path, "test_set.txt"))
 
         # Evaluate model on test data
-        model.evaluate(test_x, test_y)
+        evaluation = model.evaluate(test_x, test_y, return_dict=True)
         # Predict test data from model
         test_pred = model.predict(test_x)
         # Find class from output probability vectors
         test_pred_cat = np.argmax(test_pred, axis=-1).astype("B")
 
-        # Export test data as geotiff
+        # Export test data as one geotiff per MGRS tile
+        mosaics = {}
         for i, test_sample in enumerate(test_set):
-            predict_fn = os.path.basename(test_sample.paths[2])
-            ix = predict_fn.rfind("_")
-            predict_fn = predict_fn[:ix] + "_predict.tif"
-            ds = gdal.GetDriverByName('GTiff').Create(os.path.join(test_dir, predict_fn),
-                                                  test_pred.shape[1], test_pred.shape[2], 1, gdal.GDT_Byte,
-                                                  ['COMPRESS=LZW', 'PREDICTOR=2'])
-            ds.SetGeoTransform(test_sample.xform)
-            ds.SetProjection(test_sample.proj)
-            ds.GetRasterBand(1).WriteArray(test_pred_cat[i,:,:])
-            ds = None
+            tile = patch_tile(test_sample.paths[0])
+            if tile not in mosaics:
+                mosaics[tile] = PredictionMosaic(os.path.join(test_dir, f"{tile}_predict.tif"), tile,
+                                                 test_sample.proj, label_name=label_name)
+            mosaics[tile].write(test_pred_cat[i, :, :], test_sample.xform)
+        for mosaic in mosaics.values():
+            mosaic.close()
+        # Written last, marks a completed test
+        with open(os.path.join(test_dir, "evaluation.json"), "w") as file:
+            json.dump({name: float(value) for name, value in evaluation.items()}, file)
+
+    if predict_image_sets:
+        model = tf.keras.models.load_model(model_fn, custom_objects=custom_objects)
+        predict_dir = os.path.join(run_dir, run_name, "predict")
+        os.makedirs(predict_dir, exist_ok=True)
+        for image_set_name in predict_image_sets:
+            image_set = training_data.ImageSet(training_data.data_path, image_set_name)
+            ds = gdal.Open(image_set.get_channel_image_filename(training_data.ImageSet.ch10m[0]))
+            mosaic = PredictionMosaic(os.path.join(predict_dir, f"{image_set.tile.code}_predict.tif"),
+                                      image_set.tile.code, ds.GetProjection(), label_name=label_name)
+            if incremental:
+                report = predict_tile_incremental(model, image_set, mosaic, cascade_threshold=cascade_threshold,
+                                                  data_path=training_data.data_path)
+            else:
+                report = predict_tile(model, image_set, mosaic, cascade_threshold=cascade_threshold,
+                                      check_agreement=check_agreement)
+            mosaic.close()
+            print(image_set_name, report)
 
 
 if __name__ == "__main__":
-    main()
+    # Settings of worker processes, see :func:'cnn.launch_local_workers()'
+    main(**json.loads(os.environ.get("CNN_SETTINGS", "{}")))
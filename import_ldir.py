@@ -1,4 +1,7 @@
 
+import io
+import multiprocessing
+import sqlite3
 import ogr, osr
 import psycopg2
 
@@ -17,7 +20,31 @@ def print_layer_def(layer):
 
         print(fieldName + " - " + fieldType + " " + str(fieldWidth) + " " + str(GetPrecision))
 
-def import_pt(layer, cur, default_prod=None):
+# Columns of the database tables, the id column is always first
+pa_columns = ("id", "knr", "gnr", "bnr", "snr", "fnr", "prod", "dp_fra", "dp_til", "geog")
+pt_columns = ("id", "artype", "argrunnf")
+rmp_columns = ("id", "soknad_id", "soknads_om", "godkjent_s", "commit_dat", "tiltak_nav", "satskode", "sid", "fnr")
+
+
+def read_pt_features(layer, default_prod=None):
+    """Read features from a PT or RMP layer
+
+    Parameters
+    ----------
+    layer: ogr.Layer
+        PT or RMP layer
+    default_prod: str
+        Product used when the feature has no product
+
+    Yields
+    ------
+    pa: tuple
+        Values for the pa table without id, the geometry as WGS84 WKB
+    pt: tuple or None
+        Values for the pt table without id, None if there are no PT data
+    rmp: tuple or None
+        Values for the rmp table without id, None if there are no RMP data
+    """
     # print_layer_def(layer)
 
     # Find layer definitions
@@ -95,40 +122,227 @@ def import_pt(layer, cur, default_prod=None):
         if not prod:
             prod = default_prod
 
+        pa = (knr, gnr, bnr, snr, fnr, prod, dp_fra, dp_til, geog_wkb)
+        pt = (artype, argrunnf) if artype or argrunnf else None
+        rmp = (soknad_id, soknads_om, godkjent_s, commit_dat, tiltak_nav, satskode, sid, rmp_fnr) \
+            if soknad_id or soknads_om or godkjent_s or commit_dat or tiltak_nav or satskode or sid or rmp_fnr \
+            else None
+        yield pa, pt, rmp
+
+
+def import_pt(layer, cur, default_prod=None):
+    for pa, pt, rmp in read_pt_features(layer, default_prod):
         # Insert common data into database
         cur.execute("""INSERT INTO pa (knr, gnr, bnr, snr, fnr, prod, dp_fra, dp_til, geog) 
                        VALUES ( %s, %s, %s, %s, %s, %s, %s, %s, ST_GeomFromWKB(%s)::geography ) 
                        RETURNING id;""",
-                    (knr, gnr, bnr, snr, fnr, prod, dp_fra, dp_til, geog_wkb))
+                    pa)
         # Extract id of inserted row
         res = cur.fetchall()
         id = res[0][0]
 
         # Insert PT data
-        if id and (artype or argrunnf):
+        if id and pt:
             cur.execute("""INSERT INTO pt (id, artype, argrunnf)
                             VALUES (%s, %s, %s);""",
-                        (id, artype, argrunnf))
+                        (id,) + pt)
 
         # Insert RMP data
-        if id and (soknad_id or soknads_om or godkjent_s or commit_dat or tiltak_nav or satskode or sid or rmp_fnr):
+        if id and rmp:
             cur.execute("""INSERT INTO rmp (id, soknad_id, soknads_om, godkjent_s, commit_dat, tiltak_nav, satskode, sid, fnr)
                                         VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s);""",
-                        (id, soknad_id, soknads_om, godkjent_s, commit_dat, tiltak_nav, satskode, sid, rmp_fnr))
+                        (id,) + rmp)
+
+
+def _copy_value(value):
+    """Format a value for the PostgreSQL COPY text format"""
+    if value is None:
+        return "\\N"
+    if isinstance(value, (bytes, bytearray)):
+        # Geometry as hex WKB, accepted directly by the geography input function
+        return value.hex()
+    return str(value).replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+
+class PgBulkWriter:
+    """Load rows into PostgreSQL/PostGIS with COPY
+
+    Parameters
+    ----------
+    conn: psycopg2 connection
+    """
+    def __init__(self, conn):
+        self.conn = conn
+
+    def allocate_ids(self, n):
+        """Reserve n ids from the pa id sequence"""
+        with self.conn.cursor() as cur:
+            cur.execute("SELECT nextval(pg_get_serial_sequence('pa', 'id')) FROM generate_series(1, %s)", (n,))
+            return [row[0] for row in cur.fetchall()]
+
+    def write(self, table, columns, rows):
+        """Load rows into table with a single COPY statement"""
+        buffer = io.StringIO()
+        for row in rows:
+            print("\t".join(_copy_value(v) for v in row), file=buffer)
+        buffer.seek(0)
+        with self.conn.cursor() as cur:
+            cur.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN", buffer)
+
+    def commit(self):
+        self.conn.commit()
+
+
+class SqliteBulkWriter:
+    """Load rows into a SQLite (or SpatiaLite) stand-in database with batched inserts
+
+    Geometries are stored as WKB blobs. The tables pa, pt and rmp, and the table "id_seq" ids are allocated
+    from, are created if they don't exist.
+
+    Parameters
+    ----------
+    conn: sqlite3 connection
+    """
+    def __init__(self, conn):
+        self.conn = conn
+        for table, columns in (("pa", pa_columns), ("pt", pt_columns), ("rmp", rmp_columns)):
+            types = ["INTEGER PRIMARY KEY" if column == "id" else "BLOB" if column == "geog" else ""
+                     for column in columns]
+            self.conn.execute(f"CREATE TABLE IF NOT EXISTS {table} "
+                              f"({', '.join(f'{column} {type}'.strip() for column, type in zip(columns, types))})")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS id_seq (name TEXT PRIMARY KEY, value INTEGER)")
+        self.conn.execute("INSERT OR IGNORE INTO id_seq VALUES ('pa', 0)")
+        self.conn.commit()
+
+    def allocate_ids(self, n):
+        """Reserve n ids, safe for concurrent connections to the same database file"""
+        self.conn.commit()
+        self.conn.execute("BEGIN IMMEDIATE")
+        value = self.conn.execute("SELECT value FROM id_seq WHERE name = 'pa'").fetchone()[0]
+        self.conn.execute("UPDATE id_seq SET value = ? WHERE name = 'pa'", (value + n,))
+        self.conn.commit()
+        return list(range(value + 1, value + n + 1))
+
+    def write(self, table, columns, rows):
+        """Load rows into table with executemany"""
+        self.conn.executemany(f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})",
+                              rows)
+
+    def commit(self):
+        self.conn.commit()
+
+
+def import_pt_bulk(layer, writer, default_prod=None, batch_sz=10000):
+    """Import a PT or RMP layer in batches
+
+    Features are buffered in batches of batch_sz, ids are allocated for the whole batch in advance, so that
+    the pa, pt and rmp rows can be loaded with one statement per table and batch.
+
+    Parameters
+    ----------
+    layer: ogr.Layer
+        PT or RMP layer
+    writer: PgBulkWriter or SqliteBulkWriter
+    default_prod: str
+        Product used when the feature has no product
+    batch_sz: int
+        Number of features in each batch
+
+    Returns
+    -------
+    int
+        Number of imported features
+    """
+    def flush(batch):
+        ids = writer.allocate_ids(len(batch))
+        writer.write("pa", pa_columns, [(id,) + pa for id, (pa, pt, rmp) in zip(ids, batch)])
+        writer.write("pt", pt_columns, [(id,) + pt for id, (pa, pt, rmp) in zip(ids, batch) if pt])
+        writer.write("rmp", rmp_columns, [(id,) + rmp for id, (pa, pt, rmp) in zip(ids, batch) if rmp])
+
+    n_features = 0
+    batch = []
+    for row in read_pt_features(layer, default_prod):
+        batch.append(row)
+        if len(batch) >= batch_sz:
+            flush(batch)
+            n_features += len(batch)
+            batch = []
+    if batch:
+        flush(batch)
+        n_features += len(batch)
+    writer.commit()
+    return n_features
+
+
+def _import_layer_bulk(args):
+    """Worker for :func:'import_ldir.bulk_import()', each layer is loaded on its own connection"""
+    filename, layer_name, default_prod, dsn, backend, batch_sz = args
+    if backend == "pg":
+        conn = psycopg2.connect(dsn)
+        writer = PgBulkWriter(conn)
+    elif backend == "sqlite":
+        conn = sqlite3.connect(dsn, timeout=60)
+        writer = SqliteBulkWriter(conn)
+    else:
+        raise ValueError(f"Illegal backend: {backend}")
+
+    try:
+        ds = ogr.Open(filename)
+        layer = ds.GetLayerByName(layer_name)
+        if layer is None:
+            raise ValueError(f"No layer {layer_name} in {filename}")
+        return layer_name, import_pt_bulk(layer, writer, default_prod, batch_sz)
+    finally:
+        conn.close()
+
+
+def bulk_import(filename, layers, dsn, backend="pg", batch_sz=10000):
+    """Import several PT/RMP layers concurrently, one process and database connection for each layer
+
+    Parameters
+    ----------
+    filename: str (path)
+        Vector data source, e.g. FileGDB
+    layers: [("layer name", "default product"), ...]
+    dsn: str
+        psycopg2 connection string, or SQLite database filename
+    backend: str
+        "pg" for PostgreSQL/PostGIS or "sqlite" for a SQLite stand-in
+    batch_sz: int
+        Number of features in each batch
+
+    Returns
+    -------
+    dict
+        Number of imported features by layer name
+    """
+    args = [(filename, layer_name, default_prod, dsn, backend, batch_sz) for layer_name, default_prod in layers]
+    with multiprocessing.Pool(len(args)) as pool:
+        return dict(pool.map(_import_layer_bulk, args))
 
 
 def main():
-    with psycopg2.connect("host=beistet port=5433 dbname=LDir user=postgres password=1234") as conn:
+    dsn = "host=beistet port=5433 dbname=LDir user=postgres password=1234"
+    # ['Gras_fra_RMP', 'Korn_fra_RMP', 'Gras_fra_PT', 'Korn_fra_PT']
+    filename = r"C:/Users/runaas.NORKART/PycharmProjects/SentinelTest/data/POC_KornGras.gdb/POC_KornGras.gdb"
+    layers = [
+        ('Gras_fra_PT', "Gras"),
+        ('Korn_fra_PT', "Korn"),
+        ('Gras_fra_RMP', "Gras"),
+        ('Korn_fra_RMP', "Korn"),
+    ]
+    # Load the layers concurrently with COPY
+    bulk = True
 
-        # ['Gras_fra_RMP', 'Korn_fra_RMP', 'Gras_fra_PT', 'Korn_fra_PT']
-        filename = r"C:/Users/runaas.NORKART/PycharmProjects/SentinelTest/data/POC_KornGras.gdb/POC_KornGras.gdb"
+    if bulk:
+        print(bulk_import(filename, layers, dsn))
+        return
 
+    with psycopg2.connect(dsn) as conn:
         ds = ogr.Open(filename)
         with conn.cursor() as cur:
-            import_pt(ds.GetLayerByName('Gras_fra_PT'), cur, default_prod="Gras")
-            import_pt(ds.GetLayerByName('Korn_fra_PT'), cur, default_prod="Korn")
-            import_pt(ds.GetLayerByName('Gras_fra_RMP'), cur, default_prod="Gras")
-            import_pt(ds.GetLayerByName('Korn_fra_RMP'), cur, default_prod="Korn")
+            for layer_name, default_prod in layers:
+                import_pt(ds.GetLayerByName(layer_name), cur, default_prod=default_prod)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
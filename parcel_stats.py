@@ -0,0 +1,459 @@
+"""Module for aggregating predicted categories and band values to parcels
+
+The parcel ids of the pa table (see :mod:'import_ldir') are rasterized once per MGRS tile onto the grid of the
+prediction mosaic (see :class:'cnn.PredictionMosaic'). Class histograms of all parcels are then computed with one
+bincount pass over the prediction raster, giving majority class, confidence and pixel counts keyed by pa.id.
+
+Spectral time series are extracted the same way: per-parcel mean, median and standard deviation of all bands of
+each satelite image, excluding cloud and snow, stored as Parquet partitioned by tile and date.
+"""
+import csv
+import datetime as dt
+import glob
+import hashlib
+import io
+import multiprocessing
+import os
+import numpy as np
+import ogr, gdal
+import training_data
+
+
+def rasterize_parcel_ids(parcel_layer, cols, rows, xform, proj, id_field="id"):
+    """Rasterize parcel ids, pixels are assigned to the parcel containing the pixel center
+
+    Parameters
+    ----------
+    parcel_layer: ogr.Layer
+        Parcel polygons, e.g. the pa table
+    cols, rows, xform, proj:
+        Grid of the prediction raster, see :func:'training_data.fill_features()'
+    id_field: str
+        Integer parcel id field
+
+    Returns
+    -------
+    ndarray(int32) (rows, cols)
+        Parcel id, 0 outside parcels
+    """
+    target_ds = gdal.GetDriverByName('MEM').Create("", cols, rows, 1, gdal.GDT_Int32)
+    target_ds.SetGeoTransform(xform)
+    target_ds.SetProjection(proj)
+
+    training_data.set_extent_filter(parcel_layer, cols, rows, xform, proj)
+    parcel_layer.SetAttributeFilter(None)
+    if gdal.RasterizeLayer(target_ds, [1], parcel_layer, options=[f"ATTRIBUTE={id_field}"]) != 0:
+        raise Exception("error rasterizing parcel ids")
+    return target_ds.GetRasterBand(1).ReadAsArray()
+
+
+def zonal_statistics(ids, categories, n_cat=14, nodata=255, block_rows=1024):
+    """Class histograms of parcels
+
+    Parcel ids are mapped to consecutive indices through a lookup table, and the histograms of all parcels are
+    counted with one bincount of (parcel index, category) per block of rows.
+
+    Parameters
+    ----------
+    ids: ndarray(int) (rows, cols)
+        Parcel ids, 0 outside parcels, see :func:'parcel_stats.rasterize_parcel_ids()'
+    categories: ndarray(uint8) (rows, cols)
+        Predicted categories
+    n_cat: int
+        Number of categories
+    nodata: int
+        Category value of pixels without prediction
+    block_rows: int
+        Number of rows counted at a time, limits memory of temporary arrays
+
+    Returns
+    -------
+    dict
+        "id": parcel ids, "hist": ndarray(n_parcels, n_cat) pixel count of each category, "majority": most frequent
+        category (-1 if no predicted pixels), "confidence": share of predicted pixels in the majority category,
+        "n_pixels": number of pixels, "n_valid": number of predicted pixels
+    """
+    # Lookup table from parcel id to consecutive index, index 0 is outside parcels
+    present = np.flatnonzero(np.bincount(ids.ravel()))
+    present = present[present > 0]
+    lut = np.zeros(int(ids.max()) + 1 if ids.size else 1, dtype=np.int64)
+    lut[present] = np.arange(1, len(present) + 1)
+
+    # Category n_cat counts nodata and invalid categories
+    counts = np.zeros((len(present) + 1) * (n_cat + 1), dtype=np.int64)
+    for row0 in range(0, ids.shape[0], block_rows):
+        index = lut[ids[row0:row0 + block_rows]]
+        cat = categories[row0:row0 + block_rows].astype(np.int64)
+        cat[(cat == nodata) | (cat >= n_cat)] = n_cat
+        counts += np.bincount((index * (n_cat + 1) + cat).ravel(), minlength=len(counts))
+    counts = counts.reshape(-1, n_cat + 1)[1:]
+
+    hist = counts[:, :n_cat]
+    n_valid = hist.sum(axis=1)
+    majority = np.where(n_valid > 0, np.argmax(hist, axis=1), -1)
+    confidence = np.where(n_valid > 0, hist.max(axis=1) / np.maximum(n_valid, 1), 0.0)
+    return {"id": present, "hist": hist, "majority": majority, "confidence": confidence,
+            "n_pixels": counts.sum(axis=1), "n_valid": n_valid}
+
+
+def parcel_statistics(prediction_fn, parcel_layer, n_cat=14, id_field="id"):
+    """Class histograms of the parcels in a prediction raster
+
+    Parameters
+    ----------
+    prediction_fn: str (path)
+        Predicted categories, e.g. a tile mosaic written by :class:'cnn.PredictionMosaic'
+    parcel_layer: ogr.Layer
+    n_cat: int
+    id_field: str
+        See :func:'parcel_stats.rasterize_parcel_ids()'
+
+    Returns
+    -------
+    dict
+        See :func:'parcel_stats.zonal_statistics()'
+    """
+    ds = gdal.Open(prediction_fn)
+    if not ds:
+        raise ValueError(f"Unable to open: {prediction_fn}")
+    band = ds.GetRasterBand(1)
+    nodata = band.GetNoDataValue()
+    ids = rasterize_parcel_ids(parcel_layer, ds.RasterXSize, ds.RasterYSize, ds.GetGeoTransform(),
+                               ds.GetProjection(), id_field)
+    return zonal_statistics(ids, band.ReadAsArray(), n_cat, 255 if nodata is None else int(nodata))
+
+
+def _rows(results):
+    n_cat = results["hist"].shape[1]
+    for i in range(len(results["id"])):
+        yield [int(results["id"][i]), int(results["majority"][i]), float(results["confidence"][i]),
+               int(results["n_pixels"][i]), int(results["n_valid"][i])] + \
+              [int(count) for count in results["hist"][i, :n_cat]]
+
+
+def write_csv(results, filename):
+    """Write parcel statistics as CSV, one line per parcel"""
+    n_cat = results["hist"].shape[1]
+    with open(filename, "w", newline="") as file:
+        writer = csv.writer(file)
+        writer.writerow(["id", "majority", "confidence", "n_pixels", "n_valid"] + [f"n_{cat}" for cat in range(n_cat)])
+        writer.writerows(_rows(results))
+
+
+def write_pg(results, conn, table="pa_prediction", source=None):
+    """Write parcel statistics to a database table keyed by pa.id, with COPY
+
+    Parameters
+    ----------
+    results: dict
+        See :func:'parcel_stats.zonal_statistics()'
+    conn: psycopg2 connection
+    table: str
+        Created if it doesn't exist. Existing rows of the parcels (and source) are replaced
+    source: str
+        Name of the prediction, e.g. the mosaic file name
+    """
+    with conn.cursor() as cur:
+        cur.execute(f"""CREATE TABLE IF NOT EXISTS {table} (
+                            id BIGINT REFERENCES pa (id),
+                            source TEXT,
+                            majority SMALLINT,
+                            confidence REAL,
+                            n_pixels INTEGER,
+                            n_valid INTEGER,
+                            hist INTEGER[])""")
+        cur.execute(f"DELETE FROM {table} WHERE id = ANY(%s) AND source IS NOT DISTINCT FROM %s",
+                    ([int(i) for i in results["id"]], source))
+        buffer = io.StringIO()
+        for row in _rows(results):
+            hist = "{" + ",".join(str(count) for count in row[5:]) + "}"
+            source_value = "\\N" if source is None else source
+            buffer.write(f"{row[0]}\t{source_value}\t{row[1]}\t{row[2]}\t{row[3]}\t{row[4]}\t{hist}\n")
+        buffer.seek(0)
+        cur.copy_expert(f"COPY {table} (id, source, majority, confidence, n_pixels, n_valid, hist) FROM STDIN",
+                        buffer)
+    conn.commit()
+
+
+def parcel_index(ids_list, block_rows=1024):
+    """Map parcel ids to consecutive indices (1, 2, ...) shared by several id rasters
+
+    Parameters
+    ----------
+    ids_list: list(ndarray(int))
+        Parcel id rasters, e.g. memory mapped, counted a block of rows at a time
+    block_rows: int
+
+    Returns
+    -------
+    present: ndarray(int)
+        Parcel id of each index - 1
+    lut: ndarray(int)
+        Index of each parcel id, 0 for ids not present
+    """
+    max_id = max(int(ids.max()) for ids in ids_list)
+    seen = np.zeros(max_id + 1, dtype=bool)
+    for ids in ids_list:
+        for row0 in range(0, ids.shape[0], block_rows):
+            seen |= np.bincount(np.ravel(ids[row0:row0 + block_rows]), minlength=max_id + 1) > 0
+    seen[0] = False
+    present = np.flatnonzero(seen)
+    lut = np.zeros(max_id + 1, dtype=np.int64)
+    lut[present] = np.arange(1, len(present) + 1)
+    return present, lut
+
+
+class ParcelAccumulator:
+    """Mean, standard deviation and exact median of pixel values per parcel, added one block of rows at a time
+
+    Sums are accumulated with bincount. Values are kept only for parcels continuing in later blocks (spilled), the
+    medians of the other parcels are computed when their last block is added, so memory is bounded by the block size
+    and the parcels crossing block borders.
+
+    Parameters
+    ----------
+    n_parcels: int
+    last_block: ndarray(int) (n_parcels + 1)
+        Number of the last block containing each parcel index
+    """
+    def __init__(self, n_parcels, last_block):
+        self.count = np.zeros(n_parcels + 1)
+        self.sum = np.zeros(n_parcels + 1)
+        self.sum_sq = np.zeros(n_parcels + 1)
+        self.median = np.full(n_parcels + 1, np.nan)
+        self.last_block = last_block
+        self.spill_index = np.zeros(0, dtype=np.int64)
+        self.spill_value = np.zeros(0)
+
+    def add(self, index, values, block):
+        """Add pixel values of parcel indices (> 0) of a block"""
+        n = len(self.count)
+        self.count += np.bincount(index, minlength=n)
+        self.sum += np.bincount(index, weights=values, minlength=n)
+        self.sum_sq += np.bincount(index, weights=values * values, minlength=n)
+
+        index = np.concatenate((self.spill_index, index))
+        values = np.concatenate((self.spill_value, values))
+        done = self.last_block[index] <= block
+        self._medians(index[done], values[done])
+        self.spill_index = index[~done]
+        self.spill_value = values[~done]
+
+    def _medians(self, index, values):
+        if not len(index):
+            return
+        order = np.lexsort((values, index))
+        index = index[order]
+        values = values[order]
+        starts = np.flatnonzero(np.r_[True, index[1:] != index[:-1]])
+        counts = np.diff(np.r_[starts, len(index)])
+        self.median[index[starts]] = (values[starts + (counts - 1) // 2] + values[starts + counts // 2]) / 2
+
+    def finish(self):
+        """Returns mean, median, standard deviation and number of pixels of each parcel (NaN if no pixels)"""
+        self._medians(self.spill_index, self.spill_value)
+        self.spill_index = self.spill_index[:0]
+        self.spill_value = self.spill_value[:0]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = self.sum / self.count
+            std = np.sqrt(np.maximum(self.sum_sq / self.count - mean * mean, 0))
+        return mean[1:], self.median[1:], std[1:], self.count[1:].astype(np.int64)
+
+
+def tile_parcel_ids(parcel_layer, image_set, cache_path, id_field="id", version=None):
+    """Rasterize parcel ids on the 10m and 20m grids of a tile, once per tile and parcel layer version
+
+    Parameters
+    ----------
+    parcel_layer: ogr.Layer
+    image_set: training_data.ImageSet
+        Any satelite image of the tile
+    cache_path: str (path)
+        Directory of rasterized ids
+    id_field: str
+    version: str
+        Version of the parcel layer, see :func:'training_data.layer_version()'
+
+    Returns
+    -------
+    (str, str)
+        Numpy files of 10m and 20m parcel ids, see :func:'parcel_stats.rasterize_parcel_ids()'
+    """
+    version = hashlib.sha1(training_data.layer_version(parcel_layer, version).encode()).hexdigest()[:12]
+    filenames = []
+    for res, channel in ((10, training_data.ImageSet.ch10m[0]), (20, training_data.ImageSet.ch20m[0])):
+        fn = os.path.join(cache_path, f"{image_set.tile.code}_{version}_{res}m_ids.npy")
+        if not os.path.exists(fn):
+            ds = gdal.Open(image_set.get_channel_image_filename(channel))
+            ids = rasterize_parcel_ids(parcel_layer, ds.RasterXSize, ds.RasterYSize, ds.GetGeoTransform(),
+                                       ds.GetProjection(), id_field)
+            os.makedirs(cache_path, exist_ok=True)
+            np.save(fn + ".tmp.npy", ids)
+            os.replace(fn + ".tmp.npy", fn)
+        filenames.append(fn)
+    return tuple(filenames)
+
+
+def parcel_band_statistics(image_set, ids_10m, ids_20m, block_rows=512, max_prob=30):
+    """Per-parcel statistics of all bands of a satelite image, excluding cloud, snow and nodata pixels
+
+    Parameters
+    ----------
+    image_set: training_data.ImageSet
+    ids_10m, ids_20m: ndarray(int)
+        Parcel ids on the 10m and 20m grids, see :func:'parcel_stats.tile_parcel_ids()'
+    block_rows: int
+        Number of 10m rows read at a time, even so that the 10m and 20m blocks cover the same area
+    max_prob: int
+        Maximum cloud and snow probability (%) of the QI masks of a used pixel
+
+    Returns
+    -------
+    dict
+        "id", and "<band>_mean", "<band>_median", "<band>_std" for each band, "n_10m" and "n_20m" pixels used
+    """
+    if block_rows <= 0 or block_rows % 2:
+        raise ValueError(f"block_rows must be even and positive: {block_rows}")
+    present, lut = parcel_index([ids_10m, ids_20m], block_rows)
+    datasets = {10: training_data.image_set_open([image_set.get_channel_image_filename(ch)
+                                                  for ch in training_data.ImageSet.ch10m])[0],
+                20: training_data.image_set_open([image_set.get_channel_image_filename(ch)
+                                                  for ch in training_data.ImageSet.ch20m])[0]}
+    qi_datasets = [gdal.Open(image_set.get_qi_filename(qi_name + "_20m.jp2"))
+                   for qi_name in ("MSK_CLDPRB", "MSK_SNWPRB")]
+    channels = {10: training_data.ImageSet.ch10m, 20: training_data.ImageSet.ch20m}
+    ids = {10: ids_10m, 20: ids_20m}
+    block_sz = {10: block_rows, 20: block_rows // 2}
+    n_blocks = -(-ids_20m.shape[0] // block_sz[20])
+
+    # Last block of each parcel
+    last_block = {}
+    for res in (10, 20):
+        last_block[res] = np.zeros(len(present) + 1, dtype=np.int64)
+        for block in range(n_blocks):
+            index = lut[ids[res][block * block_sz[res]:(block + 1) * block_sz[res]]]
+            last_block[res][np.bincount(index.ravel(), minlength=len(present) + 1) > 0] = block
+    accumulators = {res: [ParcelAccumulator(len(present), last_block[res]) for ch in channels[res]]
+                    for res in (10, 20)}
+
+    for block in range(n_blocks):
+        # Cloud and snow at 20m
+        row0 = block * block_sz[20]
+        rows = min(block_sz[20], ids_20m.shape[0] - row0)
+        qi_ok = np.ones((rows, ids_20m.shape[1]), dtype=bool)
+        for qi_ds in qi_datasets:
+            qi_ok &= qi_ds.GetRasterBand(1).ReadAsArray(0, row0, ids_20m.shape[1], rows) <= max_prob
+
+        for res in (10, 20):
+            row0 = block * block_sz[res]
+            rows = min(block_sz[res], ids[res].shape[0] - row0)
+            if rows <= 0:
+                continue
+            bands = training_data.image_set_read(datasets[res], 0, row0, ids[res].shape[1], rows)
+            ok = qi_ok if res == 20 else np.repeat(np.repeat(qi_ok, 2, axis=0), 2, axis=1)[:rows, :ids[res].shape[1]]
+            index = lut[ids[res][row0:row0 + rows]]
+            valid = ok & (index > 0) & np.all([band > 0 for band in bands], axis=0)
+            for accumulator, band in zip(accumulators[res], bands):
+                accumulator.add(index[valid], band[valid].astype(np.float64), block)
+
+    results = {"id": present}
+    for res in (10, 20):
+        for channel, accumulator in zip(channels[res], accumulators[res]):
+            mean, median, std, count = accumulator.finish()
+            results[f"{channel}_mean"] = mean
+            results[f"{channel}_median"] = median
+            results[f"{channel}_std"] = std
+        results[f"n_{res}m"] = count
+    return results
+
+
+def _extract_image_set(args):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    image_set_name, ids_10m_fn, ids_20m_fn, out_path, data_path, block_rows, max_prob = args
+    image_set = training_data.ImageSet(data_path, image_set_name)
+    results = parcel_band_statistics(image_set, np.load(ids_10m_fn, mmap_mode="r"),
+                                     np.load(ids_20m_fn, mmap_mode="r"), block_rows, max_prob)
+    table = pa.table(results)
+    table = table.append_column("image_set", pa.array([image_set_name] * table.num_rows, pa.string()))
+    fn = os.path.join(out_path, f"tile={image_set.tile.code}", f"date={image_set.datatake_time[:8]}",
+                      f"{image_set_name}.parquet")
+    os.makedirs(os.path.dirname(fn), exist_ok=True)
+    pq.write_table(table, fn + ".tmp")
+    os.replace(fn + ".tmp", fn)
+    return image_set_name, table.num_rows
+
+
+def extract_time_series(image_set_names, parcel_layer, out_path, data_path=training_data.data_path,
+                        cache_path=None, workers=4, block_rows=512, max_prob=30, id_field="id", version=None):
+    """Per-parcel band statistics of a set of satelite images, see :func:'parcel_stats.parcel_band_statistics()'
+
+    Parcel ids are rasterized once per tile, and the satelite images are processed in parallel processes. The
+    result of each image is written to "<out_path>/tile=<tile>/date=<yyyymmdd>/<image set>.parquet", readable as one
+    dataset with pyarrow.dataset (hive partitioning).
+
+    Parameters
+    ----------
+    image_set_names: list(str)
+    parcel_layer: ogr.Layer
+        The pa table, or a local snapshot, e.g. GeoParquet written by :mod:'parcel_store'
+    out_path: str (path)
+    data_path: str (path)
+        See :class:'training_data.ImageSet'
+    cache_path: str (path)
+        Directory of rasterized parcel ids, default "parcel_ids" in out_path
+    workers: int
+        Number of processes
+    block_rows, max_prob:
+        See :func:'parcel_stats.parcel_band_statistics()'
+    id_field, version:
+        See :func:'parcel_stats.tile_parcel_ids()'
+
+    Returns
+    -------
+    list((str, int))
+        Image set names and number of parcels
+    """
+    cache_path = cache_path or os.path.join(out_path, "parcel_ids")
+    version = training_data.layer_version(parcel_layer, version)
+    jobs = []
+    tile_ids = {}
+    for image_set_name in image_set_names:
+        image_set = training_data.ImageSet(data_path, image_set_name)
+        if image_set.tile.code not in tile_ids:
+            tile_ids[image_set.tile.code] = tile_parcel_ids(parcel_layer, image_set, cache_path, id_field, version)
+        jobs.append((image_set_name, *tile_ids[image_set.tile.code], out_path, data_path, block_rows, max_prob))
+
+    with multiprocessing.Pool(workers) as pool:
+        return pool.map(_extract_image_set, jobs)
+
+
+def main():
+    import product_index
+    # Postgres stuff
+    pg_server = "beistet"
+    pg_port = "5433"
+    pg_dbname = "LDir"
+    pg_user = "postgres"
+    pg_passw = "1234"
+    pg_layer = "pa"
+    connString = f"PG: host={pg_server} port={pg_port} dbname={pg_dbname} user={pg_user} password={pg_passw}"
+    conn = ogr.Open(connString)
+    parcel_layer = conn.GetLayer(pg_layer)
+
+    for prediction_fn in glob.glob(os.path.join("run", "*", "predict", "*_predict.tif")):
+        results = parcel_statistics(prediction_fn, parcel_layer)
+        write_csv(results, os.path.splitext(prediction_fn)[0] + "_parcels.csv")
+        print(prediction_fn, len(results["id"]), "parcels")
+
+    # Spectral time series of the growing season
+    index = product_index.ProductIndex()
+    image_set_names = index.query(date_fra=dt.date(2019, 4, 1), date_til=dt.date(2019, 9, 30), level="2A",
+                                  max_cloud=50)
+    for image_set_name, n_parcels in extract_time_series(image_set_names, parcel_layer,
+                                                         os.path.join("data", "time_series")):
+        print(image_set_name, n_parcels, "parcels")
+
+
+if __name__ == '__main__':
+    main()
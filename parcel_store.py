@@ -0,0 +1,280 @@
+"""Module for columnar storage of LDir PT/RMP parcel layers as GeoParquet
+
+The FileGDB layers are read as Arrow record batches, geometries are reprojected to WGS84 a batch at a time, the
+field name variants of the PT and RMP layers are normalized, and the result is written as GeoParquet partitioned by
+municipality number (knr). The output can be read with :func:'parcel_store.read_parcels()' or opened directly by
+OGR (GDAL >= 3.5) as a vector layer, e.g. for label rasterization without a database.
+"""
+import datetime as dt
+import json
+import os
+import numpy as np
+import ogr, osr
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+import shapely
+
+# Output column name and source field names, the first existing source field is used.
+# Matching is case insensitive, the same way as ogr.FeatureDefn.GetFieldIndex()
+field_aliases = {
+    # Fra PT
+    "artype": ("arealtype",),
+    "argrunnf": ("grunnforho",),
+    # Fra RMP
+    "soknad_id": ("SOKNAD_ID",),
+    "soknads_om": ("SOKNADS_OM",),
+    "godkjent_s": ("GODKJENT_S",),
+    "commit_dat": ("COMMIT_DAT",),
+    "tiltak_nav": ("TILTAK_NAV",),
+    "satskode": ("SATSKODE",),
+    "sid": ("SID",),
+    "rmp_fnr": ("Fnr",),
+    # Generelt
+    "knr": ("MATRIKKELK", "HKOMNR"),
+    "gnr": ("GNR", "HGNR"),
+    "bnr": ("BNR", "HBNR"),
+    "fnr": ("FNR", "HFNR"),
+    "snr": ("SNR",),
+    "prod": ("Prod",),
+    "dp_fra": ("DP_fra",),
+    "dp_til": ("DP_til",),
+}
+
+wgs84 = osr.SpatialReference()
+wgs84.ImportFromEPSG(4326)
+if hasattr(osr, "OAMS_TRADITIONAL_GIS_ORDER"):
+    # Keep longitude - latitude order as required by GeoParquet
+    wgs84.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+
+# GeoParquet metadata, no crs means OGC:CRS84 (WGS84 longitude - latitude)
+geo_metadata = {
+    "version": "1.0.0",
+    "primary_column": "geometry",
+    "columns": {
+        "geometry": {
+            "encoding": "WKB",
+            "geometry_types": ["Polygon", "MultiPolygon"],
+        }
+    }
+}
+
+
+def layer_batches(layer, batch_sz=65536):
+    """Read an OGR layer as Arrow record batches
+
+    GDAL's Arrow stream interface (GDAL >= 3.6) is used if available, otherwise the features are collected
+    into batches in Python.
+
+    Parameters
+    ----------
+    layer: ogr.Layer
+    batch_sz: int
+        Maximum number of features in each batch
+
+    Yields
+    ------
+    pyarrow.RecordBatch
+        Attribute columns and a "geometry" column with WKB geometries in the layer coordinate system
+    """
+    if hasattr(layer, "GetArrowStreamAsPyArrow"):
+        stream = layer.GetArrowStreamAsPyArrow([f"MAX_FEATURES_IN_BATCH={batch_sz}", "GEOMETRY_ENCODING=WKB"])
+        geom_name = layer.GetGeometryColumn() or "wkb_geometry"
+        for batch in stream:
+            names = ["geometry" if name == geom_name else name for name in batch.schema.names]
+            yield pa.RecordBatch.from_arrays(batch.columns, names=names)
+        return
+
+    layer_defn = layer.GetLayerDefn()
+    names = [layer_defn.GetFieldDefn(i).GetName() for i in range(layer_defn.GetFieldCount())]
+    date_fields = {i for i in range(layer_defn.GetFieldCount())
+                   if layer_defn.GetFieldDefn(i).GetType() in (ogr.OFTDate, ogr.OFTDateTime)}
+    columns = {name: [] for name in names + ["geometry"]}
+    for feature in layer:
+        for i, name in enumerate(names):
+            if i in date_fields and feature.IsFieldSetAndNotNull(i):
+                year, month, day = feature.GetFieldAsDateTime(i)[:3]
+                columns[name].append(dt.date(year, month, day))
+            else:
+                columns[name].append(feature[i])
+        geom = feature.GetGeometryRef()
+        columns["geometry"].append(bytes(geom.ExportToWkb()) if geom else None)
+        if len(columns["geometry"]) >= batch_sz:
+            yield pa.RecordBatch.from_pydict(columns)
+            columns = {name: [] for name in columns}
+    if columns["geometry"]:
+        yield pa.RecordBatch.from_pydict(columns)
+
+
+def normalize_batch(batch, layer_name, default_prod=None):
+    """Rename PT/RMP field name variants to common column names
+
+    Parameters
+    ----------
+    batch: pyarrow.RecordBatch
+        Batch from :func:'parcel_store.layer_batches()'
+    layer_name: str
+        Stored in the "layer" column
+    default_prod: str
+        Product used where the product is missing
+
+    Returns
+    -------
+    pyarrow.Table
+        Table with all columns of field_aliases (null if missing in the layer), "layer" and "geometry"
+    """
+    lower_names = {name.lower(): i for i, name in reversed(list(enumerate(batch.schema.names)))}
+    n_rows = batch.num_rows
+
+    columns = {}
+    for column, aliases in field_aliases.items():
+        ix = next((lower_names[alias.lower()] for alias in aliases if alias.lower() in lower_names), None)
+        columns[column] = batch.column(ix) if ix is not None else pa.nulls(n_rows)
+
+    # Common types, so that batches from different layers can be stored in the same dataset
+    for column in ("knr", "gnr", "bnr", "fnr", "snr", "artype", "argrunnf"):
+        columns[column] = pc.cast(columns[column], pa.int32())
+    for column in ("prod", "soknad_id", "soknads_om", "godkjent_s", "commit_dat", "tiltak_nav", "satskode", "sid",
+                   "rmp_fnr"):
+        columns[column] = pc.cast(columns[column], pa.string())
+    for column in ("dp_fra", "dp_til"):
+        # FileGDB dates are read as timestamps, the time of day is dropped
+        columns[column] = pc.cast(columns[column], pa.date32(), safe=False)
+
+    # If no product found, fallback to default
+    if default_prod:
+        columns["prod"] = pc.fill_null(columns["prod"], default_prod)
+    columns["layer"] = pa.array([layer_name] * n_rows, pa.string())
+    columns["geometry"] = batch.column(batch.schema.get_field_index("geometry"))
+    return pa.table(columns)
+
+
+def reproject_wkb(wkb, src_srs, dst_srs=wgs84):
+    """Reproject an array of WKB geometries
+
+    All vertices of the batch are transformed with one call to the coordinate transformation.
+
+    Parameters
+    ----------
+    wkb: pyarrow.Array or ndarray
+        WKB geometries
+    src_srs, dst_srs: osr.SpatialReference
+
+    Returns
+    -------
+    ndarray(object)
+        WKB geometries in dst_srs
+    """
+    geoms = shapely.from_wkb(np.asarray(wkb, dtype=object))
+    if src_srs is None or src_srs.IsSame(dst_srs):
+        return shapely.to_wkb(geoms)
+
+    src_srs = src_srs.Clone()
+    if hasattr(osr, "OAMS_TRADITIONAL_GIS_ORDER"):
+        src_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    transform = osr.CoordinateTransformation(src_srs, dst_srs)
+
+    def transform_coords(coords):
+        if coords.shape[0] == 0:
+            return coords
+        return np.array(transform.TransformPoints(coords))[:, :2]
+
+    return shapely.to_wkb(shapely.transform(geoms, transform_coords))
+
+
+def import_layer(layer, out_path, default_prod=None, batch_sz=65536):
+    """Write a PT or RMP layer as GeoParquet partitioned by municipality
+
+    Parameters
+    ----------
+    layer: ogr.Layer
+        PT or RMP layer
+    out_path: str (path)
+        Root directory of the GeoParquet dataset, the data are stored in "knr=<kommunenr>" subdirectories
+    default_prod: str
+        Product used when the feature has no product
+    batch_sz: int
+        Number of features in each batch
+
+    Returns
+    -------
+    int
+        Number of features written
+    """
+    src_srs = layer.GetSpatialRef()
+    layer_name = layer.GetName()
+    n_features = 0
+    for batch_nr, batch in enumerate(layer_batches(layer, batch_sz)):
+        table = normalize_batch(batch, layer_name, default_prod)
+        geometry = pa.array(reproject_wkb(table.column("geometry"), src_srs), pa.binary())
+        table = table.set_column(table.schema.get_field_index("geometry"), "geometry", geometry)
+        table = table.replace_schema_metadata({b"geo": json.dumps(geo_metadata).encode()})
+
+        pq.write_to_dataset(table, out_path, partition_cols=["knr"],
+                            basename_template=f"{layer_name}-{batch_nr:05}-{{i}}.parquet")
+        n_features += table.num_rows
+    return n_features
+
+
+def import_gdb(filename, layers, out_path, batch_sz=65536):
+    """Write several PT/RMP layers of a vector data source (e.g. FileGDB) to one GeoParquet dataset
+
+    Parameters
+    ----------
+    filename: str (path)
+        Vector data source
+    layers: [("layer name", "default product"), ...]
+    out_path: str (path)
+        Root directory of the GeoParquet dataset
+
+    Returns
+    -------
+    dict
+        Number of features written by layer name
+    """
+    src = ogr.Open(filename)
+    if not src:
+        raise ValueError(f"Unable to open: {filename}")
+    return {layer_name: import_layer(src.GetLayerByName(layer_name), out_path, default_prod, batch_sz)
+            for layer_name, default_prod in layers}
+
+
+def read_parcels(path, knr=None, columns=None):
+    """Read parcels written by :func:'parcel_store.import_layer()'
+
+    Parameters
+    ----------
+    path: str (path)
+        Root directory of the GeoParquet dataset
+    knr: int or list(int)
+        Municipality number(s), only the corresponding partitions are read
+    columns: list(str)
+        Columns to read, default all
+
+    Returns
+    -------
+    pyarrow.Table
+    """
+    dataset = ds.dataset(path, format="parquet", partitioning="hive")
+    flt = None
+    if knr is not None:
+        knr = [knr] if np.isscalar(knr) else list(knr)
+        flt = ds.field("knr").isin(knr)
+    return dataset.to_table(columns=columns, filter=flt)
+
+
+def main():
+    # ['Gras_fra_RMP', 'Korn_fra_RMP', 'Gras_fra_PT', 'Korn_fra_PT']
+    filename = r"C:/Users/runaas.NORKART/PycharmProjects/SentinelTest/data/POC_KornGras.gdb/POC_KornGras.gdb"
+    layers = [
+        ('Gras_fra_PT', "Gras"),
+        ('Korn_fra_PT', "Korn"),
+        ('Gras_fra_RMP', "Gras"),
+        ('Korn_fra_RMP', "Korn"),
+    ]
+    print(import_gdb(filename, layers, os.path.join("data", "parcels")))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,322 @@
+"""Module for running the flow from satelite images to predictions as a pipeline of cached stages
+
+The stages (tiling of each MGRS tile, mixing of training data, training, testing and prediction) form a directed
+acyclic graph. The fingerprint of a stage is a hash of its function, parameters, input files and the fingerprints of
+the stages it depends on, and is stored in a stamp file when the stage has run. A stage is only run again when its
+fingerprint has changed or one of its outputs is missing, so changing e.g. the training settings reruns training and
+testing but not tiling. Independent stages, such as tiling of separate tiles, are run in parallel processes.
+"""
+import collections
+import concurrent.futures
+import hashlib
+import json
+import multiprocessing
+import os
+import time
+import training_data
+
+# Files larger than this are fingerprinted by size and modification time instead of content
+max_hash_size = 64 * 2 ** 20
+
+
+class Stage:
+    """One step of a pipeline
+
+    Parameters
+    ----------
+    name: str
+        Unique name, also the name of the stamp file
+    func: function
+        Module level function (run in a separate process), called with params as keyword arguments
+    params: dict
+        JSON serializable keyword arguments of func
+    deps: list(str)
+        Names of stages that must run before this stage
+    inputs: list(str (path))
+        Files read by the stage, not made by other stages
+    outputs: list(str (path))
+        Files or directories made by the stage, the stage is run again if one is missing
+    """
+    def __init__(self, name, func, params=None, deps=(), inputs=(), outputs=()):
+        self.name = name
+        self.func = func
+        self.params = params or {}
+        self.deps = list(deps)
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+
+
+class FileHashes:
+    """Content hashes of files, cached by size and modification time in a JSON file"""
+    def __init__(self, filename):
+        self.filename = filename
+        self.cache = {}
+        if os.path.exists(filename):
+            with open(filename) as file:
+                self.cache = json.load(file)
+
+    def hash(self, path):
+        if not os.path.exists(path):
+            return None
+        if os.path.isdir(path):
+            return "dir"
+        stat = os.stat(path)
+        if stat.st_size > max_hash_size:
+            return f"{stat.st_size}:{stat.st_mtime_ns}"
+        cached = self.cache.get(path)
+        if cached and cached[:2] == [stat.st_size, stat.st_mtime_ns]:
+            return cached[2]
+        sha1 = hashlib.sha1()
+        with open(path, "rb") as file:
+            for block in iter(lambda: file.read(2 ** 20), b""):
+                sha1.update(block)
+        self.cache[path] = [stat.st_size, stat.st_mtime_ns, sha1.hexdigest()]
+        return sha1.hexdigest()
+
+    def save(self):
+        tmp_fn = self.filename + ".tmp"
+        with open(tmp_fn, "w") as file:
+            json.dump(self.cache, file)
+        os.replace(tmp_fn, self.filename)
+
+
+def topological_order(stages):
+    """Order stages so that each stage comes after the stages it depends on"""
+    by_name = {stage.name: stage for stage in stages}
+    order = []
+    state = {}
+
+    def visit(name):
+        if state.get(name) == "done":
+            return
+        if state.get(name) == "visiting":
+            raise ValueError(f"Dependency cycle at stage: {name}")
+        if name not in by_name:
+            raise ValueError(f"Unknown stage: {name}")
+        state[name] = "visiting"
+        for dep in by_name[name].deps:
+            visit(dep)
+        state[name] = "done"
+        order.append(by_name[name])
+
+    for stage in stages:
+        visit(stage.name)
+    return order
+
+
+def fingerprints(stages, hashes):
+    """Fingerprint of each stage, see :class:'pipeline.Stage'
+
+    Returns
+    -------
+    dict
+        {stage name: sha1 hex digest}
+    """
+    result = {}
+    for stage in topological_order(stages):
+        content = {"func": f"{stage.func.__module__}.{stage.func.__name__}", "params": stage.params,
+                   "inputs": {path: hashes.hash(path) for path in stage.inputs},
+                   "deps": {dep: result[dep] for dep in stage.deps}}
+        result[stage.name] = hashlib.sha1(json.dumps(content, sort_keys=True, default=str).encode()).hexdigest()
+    return result
+
+
+def _stamp_fn(stamp_dir, name):
+    return os.path.join(stamp_dir, name.replace(os.sep, "_").replace(":", "_") + ".json")
+
+
+def _run_stage(func, params):
+    t0 = time.perf_counter()
+    func(**params)
+    return time.perf_counter() - t0
+
+
+def run_pipeline(stages, stamp_dir, workers=2, force=()):
+    """Run the stale stages of a pipeline, independent stages in parallel
+
+    Parameters
+    ----------
+    stages: list(pipeline.Stage)
+    stamp_dir: str (path)
+        Directory of stamp files and the file hash cache
+    workers: int
+        Maximum number of stages run at the same time, each in a separate process
+    force: list(str)
+        Names of stages run even if they are up to date, the stages depending on them are run too
+
+    Returns
+    -------
+    dict
+        {stage name: (status, seconds)}, status is "cached", "ran", "failed" or "skipped" (a dependency failed)
+    """
+    os.makedirs(stamp_dir, exist_ok=True)
+    hashes = FileHashes(os.path.join(stamp_dir, "file_hashes.json"))
+    order = topological_order(stages)
+    prints = fingerprints(order, hashes)
+    hashes.save()
+
+    # Stale stages, and all stages depending on them
+    stale = set()
+    for stage in order:
+        stamp_fn = _stamp_fn(stamp_dir, stage.name)
+        stamp = None
+        if os.path.exists(stamp_fn):
+            with open(stamp_fn) as file:
+                stamp = json.load(file)
+        if stage.name in force or not stamp or stamp["fingerprint"] != prints[stage.name] or \
+                not all(os.path.exists(path) for path in stage.outputs) or any(dep in stale for dep in stage.deps):
+            stale.add(stage.name)
+
+    report = collections.OrderedDict((stage.name, ("cached", 0.0)) for stage in order)
+    pending = [stage for stage in order if stage.name in stale]
+    done = {stage.name for stage in order if stage.name not in stale}
+    failed = set()
+    running = {}
+    ctx = multiprocessing.get_context("spawn")
+    with concurrent.futures.ProcessPoolExecutor(workers, mp_context=ctx) as executor:
+        while pending or running:
+            # Start the stages whose dependencies are done
+            for stage in list(pending):
+                if any(dep in failed for dep in stage.deps):
+                    pending.remove(stage)
+                    failed.add(stage.name)
+                    report[stage.name] = ("skipped", 0.0)
+                elif all(dep in done for dep in stage.deps) and len(running) < workers:
+                    pending.remove(stage)
+                    print(f"Running {stage.name}")
+                    running[executor.submit(_run_stage, stage.func, stage.params)] = stage
+            if not running:
+                continue
+
+            finished, not_done = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                stage = running.pop(future)
+                try:
+                    seconds = future.result()
+                except Exception as e:
+                    print(f"Stage {stage.name} failed: {e!r}")
+                    failed.add(stage.name)
+                    report[stage.name] = ("failed", 0.0)
+                    continue
+                with open(_stamp_fn(stamp_dir, stage.name), "w") as file:
+                    json.dump({"fingerprint": prints[stage.name], "params": stage.params,
+                               "finished": time.strftime("%Y-%m-%dT%H:%M:%S"), "seconds": seconds}, file,
+                              indent=2, default=str)
+                done.add(stage.name)
+                report[stage.name] = ("ran", seconds)
+    return report
+
+
+def print_report(report):
+    """Print a timing summary of :func:'pipeline.run_pipeline()'"""
+    width = max(len(name) for name in report)
+    for name, (status, seconds) in report.items():
+        print(f"{name:{width}}  {status:8}  {seconds:8.1f} s")
+    print(f"{'total':{width}}  {'':8}  {sum(seconds for status, seconds in report.values()):8.1f} s")
+
+
+def tile_stage(image_set_names, labels="ar5", patch_sz=128, version=None, data_path=training_data.data_path):
+    """Cut the satelite images of one MGRS tile into training patches"""
+    training_data.data_path = data_path
+    if labels == "ar5":
+        training_data.generate_training_data_ar5(image_set_names, patch_sz, version)
+    else:
+        training_data.generate_training_data_ldir(image_set_names, patch_sz, version)
+
+
+def mix_stage(training_path=None, labels="ar5", data_path=training_data.data_path):
+    """Split the training patches into training, validation and test splits"""
+    training_data.data_path = data_path
+    training_data.mix_training_data(training_path, training_data.label_names[labels])
+
+
+def cnn_stage(**settings):
+    """Train, test or predict, see :func:'cnn.main()'"""
+    import cnn
+    cnn.main(**settings)
+
+
+def train_stage(**settings):
+    """Train a new model, see :func:'cnn.main()'
+
+    The stage only runs when its settings or training data changed, so a model from an earlier run is moved to
+    model.hdf5.old instead of being trained further
+    """
+    model_fn = os.path.join(settings["run_dir"], settings["run_name"], "model.hdf5")
+    if os.path.exists(model_fn):
+        os.replace(model_fn, model_fn + ".old")
+    cnn_stage(**settings)
+
+
+def build_pipeline(image_set_names, run_name, labels="ar5", patch_sz=128, version=None, cnn_settings=None,
+                   predict_image_sets=(), data_path=training_data.data_path, run_dir="run"):
+    """Stages from satelite images to predictions
+
+    Parameters
+    ----------
+    image_set_names: list(str)
+        Sentinel 2 products used for training data, e.g. from :meth:'product_index.ProductIndex.query()'. One
+        tiling stage is made for each MGRS tile, as the images of a tile share label files
+    run_name: str
+        Directory of the model in run_dir, see :func:'cnn.main()'
+    labels: str
+        "ar5" or "ldir", see :func:'training_data.generate_training_data_ar5()'
+    patch_sz: int
+    version: str
+        Version of the label layer, changing it reruns tiling. The label layer itself is not fingerprinted
+    cnn_settings: dict
+        Keyword arguments of :func:'cnn.main()'
+    predict_image_sets: list(str)
+        Satelite images classified with the trained model
+    data_path, run_dir: str (path)
+
+    Returns
+    -------
+    list(pipeline.Stage)
+    """
+    cnn_settings = dict(cnn_settings or {}, data_path=data_path, run_dir=run_dir, run_name=run_name,
+                        label_name=training_data.label_names[labels])
+    model_dir = os.path.join(run_dir, run_name)
+
+    tiles = collections.OrderedDict()
+    tile_dirs = {}
+    for image_set_name in image_set_names:
+        tile = training_data.ImageSet(data_path, image_set_name).tile
+        tiles.setdefault(tile.code, []).append(image_set_name)
+        tile_dirs[tile.code] = os.path.join(data_path, "training", training_data.training_tile_dir(tile))
+
+    stages = []
+    for tile, names in tiles.items():
+        # rejected_patches.csv is written when the tile is done
+        stages.append(Stage(f"tile:{tile}", tile_stage,
+                            {"image_set_names": names, "labels": labels, "patch_sz": patch_sz, "version": version,
+                             "data_path": data_path},
+                            outputs=[tile_dirs[tile], os.path.join(tile_dirs[tile], "rejected_patches.csv")]))
+    splits = [os.path.join(data_path, f"{split}_set.txt") for split in ("train", "valid", "test")]
+    stages.append(Stage("mix", mix_stage, {"labels": labels, "data_path": data_path}, deps=[stage.name for stage in stages],
+                        outputs=splits))
+    stages.append(Stage("train", train_stage, dict(cnn_settings, do_train=True, do_test=False), deps=["mix"],
+                        outputs=[os.path.join(model_dir, "model.hdf5")]))
+    stages.append(Stage("test", cnn_stage, dict(cnn_settings, do_train=False, do_test=True), deps=["train"],
+                        outputs=[os.path.join(model_dir, "test", "evaluation.json")]))
+    if predict_image_sets:
+        stages.append(Stage("predict", cnn_stage,
+                            dict(cnn_settings, do_train=False, do_test=False,
+                                 predict_image_sets=list(predict_image_sets)),
+                            deps=["train"], outputs=[os.path.join(model_dir, "predict")]))
+    return stages
+
+
+def main():
+    image_sets = [
+        "S2B_MSIL2A_20180715T105029_N0208_R051_T32VNN_20180715T152821",
+        "S2B_MSIL2A_20180715T105029_N0208_R051_T32VMM_20180715T152821",
+        "S2B_MSIL2A_20180821T104019_N0208_R008_T32VNM_20180821T170337",
+        "S2B_MSIL2A_20181010T104019_N0209_R008_T32VNM_20181010T171128",
+    ]
+    stages = build_pipeline(image_sets, "pipeline_depth03_cap032", cnn_settings={"depth": 3, "capacity": 32})
+    print_report(run_pipeline(stages, os.path.join("run", "pipeline"), workers=2))
+
+
+if __name__ == '__main__':
+    main()
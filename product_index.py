@@ -0,0 +1,289 @@
+"""Module for indexing a directory of Sentinel 2 products
+
+The index maps tile, datatake time, processing level and relative orbit to resolved band and quality information
+paths, together with cloud cover and footprint from the product metadata (MTD_MSIL*.xml). It is stored in SQLite
+and refreshed incrementally by directory modification time, so the directory tree of a product is only scanned
+when it has changed. Zipped products ("<name>.zip") are indexed with /vsizip/ paths.
+"""
+import os
+import re
+import sqlite3
+import xml.etree.ElementTree as ET
+import zipfile
+import training_data
+
+product_name_re = re.compile(r"(S2[AB])_MSIL([12][A-C])_(\d{8}T\d{6})_"
+                             r"N(\d{4})_R(\d{3})_T(\d{1,2}[A-HJ-NP-Z][A-HJ-NP-Z][A-HJ-NP-V])_(\d{8}T\d{6})$")
+
+# Band image file name, with resolution suffix in L2A products only
+band_fn_re = re.compile(r"T\w{5}_\d{8}T\d{6}_(B\w\w)(?:_(\d\d)m)?\.jp2$")
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+def _scan_dir(path):
+    """List a directory, empty if it doesn't exist"""
+    try:
+        with os.scandir(path) as it:
+            return [(entry.name, entry.path, entry.is_dir()) for entry in it]
+    except OSError:
+        return []
+
+
+def parse_metadata(mtd_fn):
+    """Read cloud cover and footprint from a product metadata file (filename or file object)
+
+    Returns
+    -------
+    cloud: float
+        Cloud cover percentage
+    footprint: str
+        WKT polygon in WGS84 longitude - latitude
+    """
+    cloud = None
+    footprint = None
+    for event, elem in ET.iterparse(mtd_fn):
+        tag = elem.tag.rsplit("}", 1)[-1]
+        if tag == "Cloud_Coverage_Assessment" and elem.text:
+            cloud = float(elem.text)
+        elif tag == "EXT_POS_LIST" and elem.text and footprint is None:
+            values = [float(v) for v in elem.text.split()]
+            # Pairs of latitude - longitude
+            points = ", ".join(f"{lon} {lat}" for lat, lon in zip(values[0::2], values[1::2]))
+            footprint = f"POLYGON (({points}))"
+        elem.clear()
+    return cloud, footprint
+
+
+def scan_product(product_path, name, level, tile_code):
+    """Find granule, band images, quality information and metadata of an unpacked product
+
+    Returns
+    -------
+    image_paths: dict
+        See :class:'training_data.ImageSet'
+    cloud, footprint:
+        See :func:'product_index.parse_metadata()'
+    """
+    safe_path = os.path.join(product_path, name + ".SAFE")
+    granules = [path for entry, path, is_dir in _scan_dir(os.path.join(safe_path, "GRANULE"))
+                if is_dir and entry.startswith(f"L{level}_T{tile_code}_A")]
+    if not granules:
+        return None, None, None
+    granule = sorted(granules)[0]
+
+    image_paths = {"granule": granule, "qi": os.path.join(granule, "QI_DATA")}
+    img_path = os.path.join(granule, "IMG_DATA")
+    # L2A products have one directory per resolution, L1C products have all bands in IMG_DATA
+    candidates = [(10, path) for entry, path, is_dir in _scan_dir(os.path.join(img_path, "R10m"))] + \
+                 [(20, path) for entry, path, is_dir in _scan_dir(os.path.join(img_path, "R20m"))] + \
+                 [(None, path) for entry, path, is_dir in _scan_dir(img_path) if not is_dir]
+    for res, path in candidates:
+        re_match = band_fn_re.search(os.path.basename(path))
+        if not re_match:
+            continue
+        channel = re_match.group(1)
+        native_res = 10 if channel in training_data.ImageSet.ch10m else 20
+        if channel not in image_paths and (res is None or res == native_res):
+            image_paths[channel] = path
+
+    cloud = footprint = None
+    for entry, path, is_dir in _scan_dir(safe_path):
+        if entry.startswith("MTD_MSIL") and entry.endswith(".xml"):
+            cloud, footprint = parse_metadata(path)
+    return image_paths, cloud, footprint
+
+
+def scan_zip_product(data_path, name):
+    """Find granule, band images, quality information and metadata of a zipped product
+
+    The paths are /vsizip/ paths readable by GDAL, see :func:'product_index.scan_product()'
+    """
+    try:
+        image_set = training_data.ImageSet(data_path, name)
+    except ValueError:
+        return None, None, None
+
+    image_paths = {"granule": image_set.data_path, "qi": image_set.get_qi_path()}
+    for channel in training_data.ImageSet.ch10m + training_data.ImageSet.ch20m:
+        try:
+            image_paths[channel] = image_set.get_channel_image_filename(channel)
+        except ValueError:
+            pass
+
+    cloud = footprint = None
+    files, dirs = training_data.zip_members(image_set.zip_fn)
+    mtd_re = re.compile(f"(.*/)?{re.escape(name + '.SAFE')}/MTD_MSIL[^/]*\\.xml$")
+    for member in files:
+        if mtd_re.match(member):
+            with zipfile.ZipFile(image_set.zip_fn) as zip_file, zip_file.open(member) as mtd_file:
+                cloud, footprint = parse_metadata(mtd_file)
+    return image_paths, cloud, footprint
+
+
+class ProductIndex:
+    """Index of the Sentinel 2 products in a data directory
+
+    Parameters
+    ----------
+    data_path: str (path)
+        Directory where Sentinel 2 products are stored, see :class:'training_data.ImageSet'
+    index_fn: str (path)
+        SQLite index file, default "product_index.sqlite" in data_path
+    refresh: bool
+        Bring the index up to date when opened
+    """
+    def __init__(self, data_path=training_data.data_path, index_fn=None, refresh=True):
+        self.data_path = data_path
+        self.conn = sqlite3.connect(index_fn or os.path.join(data_path, "product_index.sqlite"))
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS product (
+                name TEXT PRIMARY KEY,
+                path TEXT NOT NULL,
+                mtime REAL,
+                mission TEXT,
+                level TEXT,
+                datatake TEXT,
+                orbit INTEGER,
+                tile TEXT,
+                cloud REAL,
+                footprint TEXT
+            );
+            CREATE INDEX IF NOT EXISTS product_tile_datatake ON product (tile, datatake);
+            CREATE TABLE IF NOT EXISTS image_path (
+                name TEXT NOT NULL,
+                key TEXT NOT NULL,
+                path TEXT NOT NULL,
+                PRIMARY KEY (name, key)
+            );
+        """)
+        self._image_paths = None
+        if refresh:
+            self.refresh()
+
+    def _product_mtime(self, path, name):
+        """Modification time of the directories changed when a product is added, removed or unpacked"""
+        safe_path = os.path.join(path, name + ".SAFE")
+        return max(t for t in (_mtime(path), _mtime(safe_path), _mtime(os.path.join(safe_path, "GRANULE")))
+                   if t is not None)
+
+    def refresh(self):
+        """Bring the index up to date, only new and modified products are scanned
+
+        Returns
+        -------
+        int
+            Number of products (re)scanned
+        """
+        indexed = dict(self.conn.execute("SELECT name, mtime FROM product"))
+        found = set()
+        n_scanned = 0
+        entries = _scan_dir(self.data_path)
+        # Unpacked products take precedence over zipped products with the same name
+        unpacked = {entry for entry, path, is_dir in entries if is_dir}
+        for entry, path, is_dir in entries:
+            is_zip = not is_dir and entry.endswith(".zip")
+            name = entry[:-len(".zip")] if is_zip else entry
+            re_match = product_name_re.match(name)
+            if not re_match or not (is_dir or is_zip) or (is_zip and name in unpacked):
+                continue
+            found.add(name)
+            mtime = _mtime(path) if is_zip else self._product_mtime(path, name)
+            if indexed.get(name) == mtime:
+                continue
+
+            mission, level, datatake, baseline, orbit, tile_code, discriminator = re_match.groups()
+            image_paths = None
+            if not is_zip:
+                image_paths, cloud, footprint = scan_product(path, name, level, tile_code)
+            if not image_paths:
+                # Zipped product, either "<name>.zip" or "<name>/<name>.zip"
+                image_paths, cloud, footprint = scan_zip_product(self.data_path, name)
+            self.conn.execute("DELETE FROM image_path WHERE name = ?", (name,))
+            self.conn.execute("DELETE FROM product WHERE name = ?", (name,))
+            if image_paths:
+                self.conn.execute("INSERT INTO product VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                  (name, path, mtime, mission, level, datatake, int(orbit), tile_code, cloud,
+                                   footprint))
+                self.conn.executemany("INSERT INTO image_path VALUES (?, ?, ?)",
+                                      [(name, key, value) for key, value in image_paths.items()])
+            n_scanned += 1
+
+        # Remove deleted products
+        for name in set(indexed) - found:
+            self.conn.execute("DELETE FROM image_path WHERE name = ?", (name,))
+            self.conn.execute("DELETE FROM product WHERE name = ?", (name,))
+        self.conn.commit()
+        self._image_paths = None
+        return n_scanned
+
+    def image_paths(self, name):
+        """Resolved paths of a product, see :class:'training_data.ImageSet'"""
+        if self._image_paths is None:
+            # Load all paths at once, later lookups are dictionary lookups
+            self._image_paths = {}
+            for product, key, path in self.conn.execute("SELECT name, key, path FROM image_path"):
+                self._image_paths.setdefault(product, {})[key] = path
+        if name not in self._image_paths:
+            raise ValueError(f"Product not in index: {name}")
+        return self._image_paths[name]
+
+    def image_set(self, name):
+        """Create an ImageSet without any file system lookups"""
+        return training_data.ImageSet(self.data_path, name, self.image_paths(name))
+
+    def query(self, tile=None, date_fra=None, date_til=None, level=None, orbit=None, max_cloud=None):
+        """Find products
+
+        Parameters
+        ----------
+        tile: str
+            MGRS tile code
+        date_fra, date_til: datetime.date
+            Datatake date interval, both inclusive
+        level: str
+            Processing level, "1C" or "2A"
+        orbit: int
+            Relative orbit number
+        max_cloud: float
+            Maximum cloud cover percentage
+
+        Returns
+        -------
+        list(str)
+            Product names sorted by datatake time
+        """
+        conditions = []
+        values = []
+        if tile:
+            conditions.append("tile = ?")
+            values.append(tile)
+        if date_fra:
+            conditions.append("datatake >= ?")
+            values.append(f"{date_fra:%Y%m%d}")
+        if date_til:
+            conditions.append("datatake < ?")
+            values.append(f"{date_til:%Y%m%d}T999999")
+        if level:
+            conditions.append("level = ?")
+            values.append(level)
+        if orbit is not None:
+            conditions.append("orbit = ?")
+            values.append(int(orbit))
+        if max_cloud is not None:
+            conditions.append("cloud <= ?")
+            values.append(max_cloud)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        return [row[0] for row in self.conn.execute(f"SELECT name FROM product {where} ORDER BY datatake", values)]
+
+    def metadata(self, name):
+        """Cloud cover percentage and WKT footprint of a product"""
+        row = self.conn.execute("SELECT cloud, footprint FROM product WHERE name = ?", (name,)).fetchone()
+        if not row:
+            raise ValueError(f"Product not in index: {name}")
+        return row
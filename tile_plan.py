@@ -0,0 +1,285 @@
+"""Module for planning Sentinel 2 downloads per MGRS tile with a local product catalog
+
+Parcels are mapped to the MGRS 100x100km tiles covering them and a date window is computed for each tile from the
+parcel dp_fra / dp_til dates. Product metadata from the Copernicus hub is kept in a local SQLite catalog, loaded
+incrementally from saved query responses, so tile and date selection can be done offline.
+"""
+import datetime as dt
+import glob
+import json
+import os
+import re
+import sqlite3
+import numpy as np
+import ogr
+import training_data
+
+def tiles_covering(lon, lat):
+    """Find all MGRS tiles covering WGS84 longitude - latitude positions
+
+    Parameters
+    ----------
+    lon, lat: ndarray
+
+    Returns
+    -------
+    codes: ndarray(str) of shape (n, 4)
+        The tile containing each position, followed by the overlapping west, north and north west neighbour tiles
+    valid: ndarray(bool) of shape (n, 4)
+        True where the tile covers the position
+    """
+    zone, e, n, south = training_data.lonlat_to_utm(lon, lat)
+    return training_data.mgrs_overlap(zone, e, n, south)
+
+
+def parcels_from_db(dsn):
+    """Read parcel centroids and dates from the pa table
+
+    Parameters
+    ----------
+    dsn: str
+        psycopg2 connection string
+
+    Yields
+    ------
+    (lon, lat, dp_fra, dp_til)
+    """
+    import psycopg2
+    with psycopg2.connect(dsn) as conn:
+        with conn.cursor("plan_cur") as cur:
+            cur.execute("""SELECT ST_X(c), ST_Y(c), dp_fra, dp_til
+                           FROM (SELECT ST_Centroid(geog::geometry) AS c, dp_fra, dp_til FROM pa) AS p""")
+            for row in cur:
+                yield row
+
+
+def parcels_from_store(path, knr=None):
+    """Read parcel centroids and dates from a GeoParquet dataset written by :mod:'parcel_store'
+
+    Yields
+    ------
+    (lon, lat, dp_fra, dp_til)
+    """
+    import parcel_store
+    import shapely
+    table = parcel_store.read_parcels(path, knr, columns=["geometry", "dp_fra", "dp_til"])
+    centroids = shapely.get_coordinates(shapely.centroid(shapely.from_wkb(table.column("geometry").to_numpy(False))))
+    for (lon, lat), dp_fra, dp_til in zip(centroids, table.column("dp_fra").to_pylist(),
+                                          table.column("dp_til").to_pylist()):
+        yield lon, lat, dp_fra, dp_til
+
+
+def plan_tiles(parcels, default_window=None, chunk_sz=100000):
+    """Compute date windows for the MGRS tiles covering a set of parcels
+
+    Parameters
+    ----------
+    parcels: iterable((lon, lat, dp_fra, dp_til))
+        Parcel positions and dates, see :func:'tile_plan.parcels_from_db()'
+    default_window: (datetime.date, datetime.date)
+        Used for parcels without dates
+    chunk_sz: int
+        Number of parcels mapped to tiles at a time
+
+    Returns
+    -------
+    dict
+        {tile code: (date from, date til, number of parcels)}
+    """
+    plan = {}
+
+    def add_chunk(chunk):
+        lon, lat, dp_fra, dp_til = zip(*chunk)
+        codes, valid = tiles_covering(np.array(lon, dtype="f8"), np.array(lat, dtype="f8"))
+        dp_fra = np.broadcast_to(np.array(dp_fra, dtype="datetime64[D]")[:, None], valid.shape)[valid]
+        dp_til = np.broadcast_to(np.array(dp_til, dtype="datetime64[D]")[:, None], valid.shape)[valid]
+
+        # Aggregate per tile
+        tiles, inverse = np.unique(codes[valid], return_inverse=True)
+        date_fra = np.full(len(tiles), np.datetime64("9999-12-31"))
+        date_til = np.full(len(tiles), np.datetime64("0001-01-01"))
+        np.minimum.at(date_fra, inverse, dp_fra)
+        np.maximum.at(date_til, inverse, dp_til)
+        counts = np.bincount(inverse, minlength=len(tiles))
+
+        for code, fra, til, count in zip(tiles.tolist(), date_fra.astype(object), date_til.astype(object), counts):
+            if code in plan:
+                old_fra, old_til, old_count = plan[code]
+                plan[code] = (min(old_fra, fra), max(old_til, til), old_count + int(count))
+            else:
+                plan[code] = (fra, til, int(count))
+
+    chunk = []
+    for lon, lat, dp_fra, dp_til in parcels:
+        if not dp_fra or not dp_til:
+            if not default_window:
+                continue
+            dp_fra = dp_fra or default_window[0]
+            dp_til = dp_til or default_window[1]
+        chunk.append((lon, lat, dp_fra, dp_til))
+        if len(chunk) >= chunk_sz:
+            add_chunk(chunk)
+            chunk = []
+    if chunk:
+        add_chunk(chunk)
+    return plan
+
+
+class ProductCatalog:
+    """Local SQLite catalog of Sentinel 2 products and planned tiles
+
+    Parameters
+    ----------
+    filename: str (path)
+        SQLite database file, created if it doesn't exist
+    """
+    def __init__(self, filename):
+        self.conn = sqlite3.connect(filename)
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS product (
+                uuid TEXT PRIMARY KEY,
+                title TEXT NOT NULL,
+                mission TEXT,
+                level TEXT,
+                orbit INTEGER,
+                tile TEXT,
+                datatake TEXT,
+                cloud REAL,
+                footprint TEXT
+            );
+            CREATE INDEX IF NOT EXISTS product_tile_datatake ON product (tile, datatake);
+            CREATE TABLE IF NOT EXISTS tile_plan (
+                tile TEXT PRIMARY KEY,
+                date_fra TEXT,
+                date_til TEXT,
+                n_parcels INTEGER
+            );
+            CREATE TABLE IF NOT EXISTS tile_query (
+                tile TEXT PRIMARY KEY,
+                queried_til TEXT
+            );
+        """)
+
+    def add_product(self, uuid, title, cloud=None, footprint=None):
+        """Add or update one product, tile, date etc. are interpreted from the product name"""
+        re_match = re.match(r"(S2[AB])_MSIL([12][A-C])_(\d{8}T\d{6})_N\d{4}_R(\d{3})_T(\d{2}[A-Z]{3})", title)
+        if not re_match:
+            raise ValueError("Illegal product name: " + title)
+        self.conn.execute("INSERT OR REPLACE INTO product VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                          (uuid, title, re_match.group(1), re_match.group(2), int(re_match.group(4)),
+                           re_match.group(5), re_match.group(3), cloud, footprint))
+
+    def load_geojson(self, filename):
+        """Load products from a saved query response, as written by SentinelAPI.to_geojson()
+
+        Returns
+        -------
+        int
+            Number of products loaded
+        """
+        with open(filename) as file:
+            collection = json.load(file)
+        for feature in collection["features"]:
+            props = feature["properties"]
+            footprint = ogr.CreateGeometryFromJson(json.dumps(feature["geometry"])).ExportToWkt() \
+                if feature.get("geometry") else None
+            self.add_product(props.get("uuid", props.get("id")), props["title"],
+                             props.get("cloudcoverpercentage"), footprint)
+        self.conn.commit()
+        return len(collection["features"])
+
+    def load_query_result(self, products):
+        """Load products from the result of SentinelAPI.query()"""
+        for uuid, props in products.items():
+            self.add_product(uuid, props["title"], props.get("cloudcoverpercentage"), props.get("footprint"))
+        self.conn.commit()
+        return len(products)
+
+    def load_directory(self, path):
+        """Load all saved query responses (*.json) in a directory"""
+        return sum(self.load_geojson(fn) for fn in sorted(glob.glob(os.path.join(path, "*.json"))))
+
+    def set_plan(self, plan):
+        """Store the result of :func:'tile_plan.plan_tiles()'"""
+        self.conn.execute("DELETE FROM tile_plan")
+        self.conn.executemany("INSERT INTO tile_plan VALUES (?, ?, ?, ?)",
+                              [(tile, str(date_fra), str(date_til), count)
+                               for tile, (date_fra, date_til, count) in plan.items()])
+        self.conn.commit()
+
+    def query_hub(self, api, response_path, max_cloud=30):
+        """Update the catalog from the Copernicus hub, one query per planned tile
+
+        Only the part of each tile's date window that has not been queried before is requested. The responses are
+        saved in response_path, so the catalog can be rebuilt offline with :meth:'ProductCatalog.load_directory()'.
+
+        Parameters
+        ----------
+        api: sentinelsat.SentinelAPI
+        response_path: str (path)
+            Directory for saved query responses
+        max_cloud: float
+            Maximum cloud cover percentage
+        """
+        os.makedirs(response_path, exist_ok=True)
+        queried = dict(self.conn.execute("SELECT tile, queried_til FROM tile_query"))
+        today = dt.date.today()
+        for tile, date_fra, date_til in self.conn.execute("SELECT tile, date_fra, date_til FROM tile_plan").fetchall():
+            date_fra = dt.date.fromisoformat(date_fra)
+            date_til = min(dt.date.fromisoformat(date_til), today)
+            if tile in queried:
+                date_fra = max(date_fra, dt.date.fromisoformat(queried[tile]))
+            if date_fra >= date_til:
+                continue
+
+            products = api.query(date=(date_fra, date_til), platformname='Sentinel-2', tileid=tile,
+                                 cloudcoverpercentage=(0, max_cloud))
+            fn = os.path.join(response_path, f"{tile}_{date_fra:%Y%m%d}_{date_til:%Y%m%d}.json")
+            with open(fn, "w") as file:
+                json.dump(api.to_geojson(products), file)
+            self.load_query_result(products)
+            self.conn.execute("INSERT OR REPLACE INTO tile_query VALUES (?, ?)", (tile, str(date_til)))
+            self.conn.commit()
+
+    def select(self, tile, date_fra, date_til, max_cloud=30, level="2A"):
+        """Find products for one tile and date window
+
+        Returns
+        -------
+        list((title, datatake, cloud))
+            Sorted by datatake time
+        """
+        return self.conn.execute("""SELECT title, datatake, cloud FROM product
+                                    WHERE tile = ? AND datatake >= ? AND datatake < ? AND level = ?
+                                          AND (cloud IS NULL OR cloud <= ?)
+                                    ORDER BY datatake""",
+                                 (tile, f"{date_fra:%Y%m%d}", f"{date_til + dt.timedelta(days=1):%Y%m%d}", level,
+                                  max_cloud)).fetchall()
+
+    def planned_products(self, max_cloud=30, level="2A"):
+        """Find products for all planned tiles within their date windows
+
+        Returns
+        -------
+        dict
+            {tile code: list((title, datatake, cloud))}
+        """
+        plan = self.conn.execute("SELECT tile, date_fra, date_til FROM tile_plan ORDER BY tile").fetchall()
+        return {tile: self.select(tile, dt.date.fromisoformat(date_fra), dt.date.fromisoformat(date_til),
+                                  max_cloud, level)
+                for tile, date_fra, date_til in plan}
+
+
+def main():
+    catalog = ProductCatalog(os.path.join(training_data.data_path, "catalog.sqlite"))
+    catalog.load_directory(os.path.join(training_data.data_path, "responses"))
+    catalog.set_plan(plan_tiles(parcels_from_db("host=beistet port=5433 dbname=LDir user=postgres password=1234")))
+
+    for tile, products in catalog.planned_products().items():
+        print(tile)
+        for title, datatake, cloud in products:
+            print("   ", datatake, cloud, title)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,13 @@
 """Module for preparing data for cnn training and testing"""
 import os
+import collections
+import csv
+import functools
+import hashlib
+import posixpath
+import queue
+import threading
+import zipfile
 import numpy as np
 import ogr, gdal, osr
 import glob
@@ -106,10 +114,315 @@ col_code_to_nr = {
 }
 
 
+# Letter sequences for encoding MGRS 100x100km tile codes
+band_letters = "CDEFGHJKLMNPQRSTUVWX"
+row_letters = "ABCDEFGHJKLMNPQRSTUV"
+col_letters = ["ABCDEFGH", "JKLMNPQR", "STUVWXYZ"]
+
+# Lookup tables for vectorized encoding (index -> ascii code) and decoding (ascii code -> value, -1 if illegal)
+_band_letter_lut = np.frombuffer(band_letters.encode(), dtype=np.uint8)
+_row_letter_lut = np.frombuffer(row_letters.encode(), dtype=np.uint8)
+_col_letter_lut = np.frombuffer("".join(col_letters).encode(), dtype=np.uint8).reshape((3, 8))
+_band_ix_lut = np.full(256, -1, dtype=np.int64)
+_band_ix_lut[_band_letter_lut] = np.arange(len(band_letters))
+_row_ix_lut = np.full(256, -1, dtype=np.int64)
+_row_ix_lut[_row_letter_lut] = np.arange(len(row_letters))
+_col_ix_lut = np.full(256, -1, dtype=np.int64)
+_col_ix_lut[_col_letter_lut] = np.tile(np.arange(8), (3, 1))
+
+# WGS84 ellipsoid and UTM constants for the Krüger series (accurate to about a millimeter within a zone)
+_a = 6378137.0
+_f = 1 / 298.257223563
+_n = _f / (2 - _f)
+_A = _a / (1 + _n) * (1 + _n ** 2 / 4 + _n ** 4 / 64)
+_alpha = (_n / 2 - 2 * _n ** 2 / 3 + 5 * _n ** 3 / 16, 13 * _n ** 2 / 48 - 3 * _n ** 3 / 5, 61 * _n ** 3 / 240)
+_beta = (_n / 2 - 2 * _n ** 2 / 3 + 37 * _n ** 3 / 96, _n ** 2 / 48 + _n ** 3 / 15, 17 * _n ** 3 / 480)
+_delta = (2 * _n - 2 * _n ** 2 / 3 - 2 * _n ** 3, 7 * _n ** 2 / 3 - 8 * _n ** 3 / 5, 56 * _n ** 3 / 15)
+_k0 = 0.9996
+_e0 = 500000.0
+_n0_south = 10000000.0
+
+# Sentinel 2 tiles are 109.8km wide and overlap the neighbour tiles with 9.8km
+tile_overlap = 9800
+
+
+def utm_zones(lon, lat):
+    """WGS84/UTM zone numbers of positions, including the exceptions for south western Norway and Svalbard
+
+    Parameters
+    ----------
+    lon, lat: ndarray
+        WGS84 longitude and latitude in degrees
+
+    Returns
+    -------
+    ndarray(int)
+    """
+    lon = np.asarray(lon, dtype=np.float64)
+    lat = np.asarray(lat, dtype=np.float64)
+    zone = np.floor((lon + 180) / 6).astype(np.int64) % 60 + 1
+    zone = np.where((lat >= 56) & (lat < 64) & (lon >= 3) & (lon < 12), 32, zone)
+    svalbard = (lat >= 72) & (lat < 84) & (lon >= 0) & (lon < 42)
+    return np.where(svalbard, np.select([lon < 9, lon < 21, lon < 33], [31, 33, 35], 37), zone)
+
+
+def utm_zone(lon, lat):
+    """WGS84/UTM zone number of a position, including the exceptions for south western Norway and Svalbard"""
+    return int(utm_zones(lon, lat))
+
+
+def lonlat_to_utm(lon, lat, zone=None):
+    """Transform WGS84 positions to UTM
+
+    Parameters
+    ----------
+    lon, lat: ndarray
+        WGS84 longitude and latitude in degrees
+    zone: ndarray(int) or int
+        UTM zones, default the zone containing each position
+
+    Returns
+    -------
+    zone: ndarray(int)
+    e, n: ndarray
+        Easting and northing, with false northing on the southern hemisphere
+    south: ndarray(bool)
+    """
+    lon = np.asarray(lon, dtype=np.float64)
+    lat = np.asarray(lat, dtype=np.float64)
+    zone = utm_zones(lon, lat) if zone is None else np.broadcast_to(zone, lon.shape)
+
+    phi = np.radians(lat)
+    lam = np.radians(lon - (zone * 6 - 183))
+    c = 2 * np.sqrt(_n) / (1 + _n)
+    t = np.sinh(np.arctanh(np.sin(phi)) - c * np.arctanh(c * np.sin(phi)))
+    xi = np.arctan2(t, np.cos(lam))
+    eta = np.arctanh(np.sin(lam) / np.sqrt(1 + t * t))
+
+    e = eta.copy()
+    n = xi.copy()
+    for j, alpha in enumerate(_alpha, 1):
+        e += alpha * np.cos(2 * j * xi) * np.sinh(2 * j * eta)
+        n += alpha * np.sin(2 * j * xi) * np.cosh(2 * j * eta)
+    south = lat < 0
+    return zone, _e0 + _k0 * _A * e, np.where(south, _n0_south, 0.0) + _k0 * _A * n, south
+
+
+def utm_to_lonlat(zone, e, n, south=False):
+    """Transform UTM positions to WGS84
+
+    Parameters
+    ----------
+    zone: ndarray(int) or int
+    e, n: ndarray
+        Easting and northing, with false northing on the southern hemisphere
+    south: ndarray(bool) or bool
+
+    Returns
+    -------
+    lon, lat: ndarray
+        WGS84 longitude and latitude in degrees
+    """
+    e = np.asarray(e, dtype=np.float64)
+    n = np.asarray(n, dtype=np.float64)
+    xi = (n - np.where(south, _n0_south, 0.0)) / (_k0 * _A)
+    eta = (e - _e0) / (_k0 * _A)
+
+    xi1 = xi.copy()
+    eta1 = eta.copy()
+    for j, beta in enumerate(_beta, 1):
+        xi1 -= beta * np.sin(2 * j * xi) * np.cosh(2 * j * eta)
+        eta1 -= beta * np.cos(2 * j * xi) * np.sinh(2 * j * eta)
+    chi = np.arcsin(np.sin(xi1) / np.cosh(eta1))
+    phi = chi.copy()
+    for j, delta in enumerate(_delta, 1):
+        phi += delta * np.sin(2 * j * chi)
+    lon = np.degrees(np.arctan2(np.sinh(eta1), np.cos(xi1))) + (np.asarray(zone) * 6 - 183)
+    return lon, np.degrees(phi)
+
+
+def mgrs_encode(zone, e, n, south=False, lat=None):
+    """Find the MGRS 100x100km tiles containing a set of UTM positions
+
+    Parameters
+    ----------
+    zone: ndarray(int) or int
+    e, n: ndarray
+        Easting and northing, with false northing on the southern hemisphere
+    south: ndarray(bool) or bool
+    lat: ndarray
+        Latitude of the positions, computed from the UTM position if not given
+
+    Returns
+    -------
+    codes: ndarray(str)
+        Tile codes, "ZZBCR" with zero-padded zone numbers
+    e0, n0: ndarray(int)
+        Tile origins, same as MGRS.e, MGRS.n
+    """
+    e = np.asarray(e, dtype=np.float64)
+    n = np.asarray(n, dtype=np.float64)
+    zone = np.broadcast_to(np.asarray(zone, dtype=np.int64), e.shape)
+    if lat is None:
+        lat = utm_to_lonlat(zone, e, n, south)[1]
+
+    band_ix = np.clip(np.floor((np.asarray(lat) + 80) / 8).astype(np.int64), 0, len(band_letters) - 1)
+    e_ix = np.floor(e / 100000).astype(np.int64)
+    n_ix = np.floor(n / 100000).astype(np.int64)
+    if np.any((e_ix < 1) | (e_ix > 8)):
+        raise ValueError("Easting outside of UTM zone")
+
+    chars = np.empty(e.shape + (5,), dtype=np.uint8)
+    chars[..., 0] = ord("0") + zone // 10
+    chars[..., 1] = ord("0") + zone % 10
+    chars[..., 2] = _band_letter_lut[band_ix]
+    chars[..., 3] = _col_letter_lut[(zone - 1) % 3, e_ix - 1]
+    chars[..., 4] = _row_letter_lut[(n_ix + np.where(zone % 2 == 0, 5, 0)) % len(row_letters)]
+    codes = chars.view("S5")[..., 0].astype("U5")
+    return codes, e_ix * 100000, n_ix * 100000
+
+
+def mgrs_encode_lonlat(lon, lat):
+    """Find the MGRS 100x100km tiles containing a set of WGS84 longitude - latitude positions
+
+    Returns
+    -------
+    codes: ndarray(str)
+    zone: ndarray(int)
+    e, n: ndarray
+        UTM position
+    e0, n0: ndarray(int)
+        Tile origins
+    """
+    zone, e, n, south = lonlat_to_utm(lon, lat)
+    codes, e0, n0 = mgrs_encode(zone, e, n, south, lat)
+    return codes, zone, e, n, e0, n0
+
+
+def mgrs_decode(codes):
+    """Decode a set of MGRS 100x100km tile codes
+
+    Parameters
+    ----------
+    codes: ndarray(str) or list(str)
+        Tile codes, the zone number may be one or two digits
+
+    Returns
+    -------
+    zone: ndarray(int)
+    south: ndarray(bool)
+    e0, n0: ndarray(int)
+        Tile origins, same as MGRS.e, MGRS.n
+    """
+    codes = np.char.zfill(np.asarray(codes, dtype="U5"), 5)
+    chars = np.frombuffer(np.char.encode(codes, "ascii").tobytes(), dtype=np.uint8).reshape(codes.shape + (5,))
+    chars = chars.astype(np.int64)
+    zone = (chars[..., 0] - ord("0")) * 10 + chars[..., 1] - ord("0")
+    band_ix = _band_ix_lut[chars[..., 2]]
+    col_ix = _col_ix_lut[chars[..., 3]]
+    row_ix = _row_ix_lut[chars[..., 4]]
+    if np.any((zone < 1) | (zone > 60) | (band_ix < 0) | (col_ix < 0) | (row_ix < 0)):
+        raise ValueError("Illegal MGRS code")
+
+    # Northing of the southern edge of the latitude band at the central meridian, the lowest northing in the band
+    band_lat = band_ix * 8 - 80
+    south = band_lat < 0
+    band_n = lonlat_to_utm(zone * 6 - 183, band_lat, zone)[2]
+
+    # Row letters repeat every 2000km, use the first repetition reaching into the band
+    n0 = (row_ix - np.where(zone % 2 == 0, 5, 0)) % len(row_letters) * 100000
+    n0 += np.maximum(np.ceil((band_n - 100000 - n0) / 2000000), 0).astype(np.int64) * 2000000
+    e0 = (col_ix + 1) * 100000
+    return zone, south, e0, n0
+
+
+def mgrs_overlap(zone, e, n, south=False):
+    """Find the Sentinel 2 tiles covering a set of UTM positions
+
+    Sentinel 2 tiles are 109.8km wide, so positions near the western or northern edge of a 100x100km tile are also
+    covered by the neighbouring tile to the west, north or north west.
+
+    Returns
+    -------
+    codes: ndarray(str) of shape (..., 4)
+        Covering tile, west, north and north west neighbour
+    valid: ndarray(bool) of shape (..., 4)
+        True where the neighbour covers the position
+    """
+    e = np.asarray(e, dtype=np.float64)
+    n = np.asarray(n, dtype=np.float64)
+    e0 = np.floor(e / 100000) * 100000
+    n0 = np.floor(n / 100000) * 100000
+    west = (e - e0 < tile_overlap) & (e0 > 100000)
+    north = n - n0 >= 100000 - tile_overlap
+
+    offsets = ((0, 0), (-100000, 0), (0, 100000), (-100000, 100000))
+    valid = np.stack([np.ones(e.shape, dtype=bool), west, north, west & north], axis=-1)
+    codes = np.stack([mgrs_encode(zone, np.where(v, e0 + de + 50000, e), np.where(v, n0 + dn + 50000, n), south)[0]
+                      for (de, dn), v in zip(offsets, np.moveaxis(valid, -1, 0))], axis=-1)
+    return codes, valid
+
+
+class MGRSIndex:
+    """Index for looking up positions in a set of MGRS 100x100km tiles
+
+    Parameters
+    ----------
+    codes: list(str)
+        Tile codes
+    """
+    def __init__(self, codes):
+        self.codes = np.asarray(codes, dtype="U5")
+        zone, south, e0, n0 = mgrs_decode(self.codes)
+        keys = self._key(zone, south, e0, n0)
+        self._order = np.argsort(keys)
+        self._keys = keys[self._order]
+
+    @staticmethod
+    def _key(zone, south, e0, n0):
+        return ((np.asarray(zone, dtype=np.int64) * 2 + south) * 10 + e0 // 100000) * 1000 + n0 // 100000
+
+    def _find(self, keys):
+        pos = np.clip(np.searchsorted(self._keys, keys), 0, max(len(self._keys) - 1, 0))
+        found = self._keys[pos] == keys if len(self._keys) else np.zeros(keys.shape, dtype=bool)
+        return np.where(found, self._order[pos], -1)
+
+    def lookup(self, zone, e, n, south=False):
+        """Find the indexed tile covering each position, neighbour tiles are used where the position is in the overlap
+
+        Returns
+        -------
+        ndarray(int)
+            Index into codes, -1 if not covered by any indexed tile
+        """
+        e = np.asarray(e, dtype=np.float64)
+        n = np.asarray(n, dtype=np.float64)
+        zone = np.broadcast_to(np.asarray(zone, dtype=np.int64), e.shape)
+        south = np.broadcast_to(south, e.shape)
+        e0 = np.floor(e / 100000).astype(np.int64) * 100000
+        n0 = np.floor(n / 100000).astype(np.int64) * 100000
+
+        ix = self._find(self._key(zone, south, e0, n0))
+        west = e - e0 < tile_overlap
+        north = n - n0 >= 100000 - tile_overlap
+        for de, dn, in_overlap in ((-100000, 0, west), (0, 100000, north), (-100000, 100000, west & north)):
+            missing = (ix < 0) & in_overlap
+            if np.any(missing):
+                ix[missing] = self._find(self._key(zone[missing], south[missing], e0[missing] + de,
+                                                   n0[missing] + dn))
+        return ix
+
+    def lookup_lonlat(self, lon, lat):
+        """Find the indexed tile covering each WGS84 longitude - latitude position, see :meth:'MGRSIndex.lookup()'"""
+        zone, e, n, south = lonlat_to_utm(lon, lat)
+        return self.lookup(zone, e, n, south)
+
+
 class MGRS:
     """Class for handling MGSR 100x100km ctile codes"""
-    def __init__(self, code):
-        self.set_from_code(code)
+    def __init__(self, code=None):
+        if code:
+            self.set_from_code(code)
 
     def set_from_code(self, code):
         """Interpret MGRS 100x100km tile code.
@@ -127,30 +440,85 @@ class MGRS:
         self.col = re_match.group(3)
         self.row = re_match.group(4)
 
-        band_lat = band_code_to_nr[self.band]
-        band_y = 6400000 * m.radians(band_lat)
-
-        n = row_code_to_nr[(self.zone - 1)%2][self.row]
-        if band_y < 0:
-            band_y += 10000000
-        while n < band_y:
-            n += 2000000
-
-        self.e = col_code_to_nr[self.col]
-        self.n = n
+        zone, south, e0, n0 = mgrs_decode([code])
+        self.e = int(e0[0])
+        self.n = int(n0[0])
 
     def set_from_xy(self, zone, e, n, south=False):
-        """unfinished and will perhaps never be used?"""
+        """Find the MGRS 100x100km tile containing a WGS84/UTM position
+
+        Parameters
+        ----------
+        zone: int
+            WGS84/UTM zone number
+        e, n: float
+            UTM easting and northing, including false easting and northing
+        south: bool
+            Position on the southern hemisphere
+        """
+        codes, e0, n0 = mgrs_encode(zone, np.array([e]), np.array([n]), south)
+        self.code = str(codes[0])
         self.zone = zone
-        self.e = e
-        self.n = n
-        self.band = "A"
+        self.band = self.code[2]
+        self.col = self.code[3]
+        self.row = self.code[4]
+        self.e = int(e0[0])
+        self.n = int(n0[0])
+
+    def set_from_lonlat(self, lon, lat):
+        """Find the MGRS 100x100km tile containing a WGS84 longitude - latitude position"""
+        zone, e, n, south = lonlat_to_utm(np.array([lon]), np.array([lat]))
+        self.set_from_xy(int(zone[0]), e[0], n[0], bool(south[0]))
 
     def __repr__(self):
         return f"MGRS(code={self.code}, zone={self.zone}, band={self.band}, " \
             f"col={self.col}, row={self.row}, e={self.e}, n={self.n})"
 
 
+@functools.lru_cache(maxsize=256)
+def _zip_members(zip_fn, mtime):
+    files = set()
+    dirs = set()
+    with zipfile.ZipFile(zip_fn) as zip_file:
+        for name in zip_file.namelist():
+            parts = name.rstrip("/").split("/")
+            for i in range(1, len(parts)):
+                dirs.add("/".join(parts[:i]))
+            if name.endswith("/"):
+                dirs.add(name.rstrip("/"))
+            else:
+                files.add(name)
+    return frozenset(files), frozenset(dirs)
+
+
+def zip_members(zip_fn):
+    """List files and directories in a zip archive
+
+    The member directory is cached, and only reread if the archive is modified.
+
+    Returns
+    -------
+    files, dirs: frozenset(str)
+        Member paths, directories are included even if the archive has no explicit directory entries
+    """
+    return _zip_members(zip_fn, os.path.getmtime(zip_fn))
+
+
+def find_product_zip(data_path, image_set_name):
+    """Find zipped Sentinel 2 product, "<data_path>/<name>.zip" or "<data_path>/<name>/<name>.zip"
+
+    Returns
+    -------
+    str or None
+        Path to zip file, None if not found
+    """
+    for zip_fn in (os.path.join(data_path, image_set_name + ".zip"),
+                   os.path.join(data_path, image_set_name, image_set_name + ".zip")):
+        if os.path.isfile(zip_fn):
+            return zip_fn
+    return None
+
+
 class ImageSet:
     """Handling a Sentinel 2 tile, processing level 1C or 2A
 
@@ -162,6 +530,9 @@ class ImageSet:
         Project name, formatted according to theis standard:
         https://sentinel.esa.int/web/sentinel/user-guides/sentinel-2-msi/naming-convention
         Example: S2B_MSIL2A_20180715T105029_N0208_R051_T32VNN_20180715T152821
+    image_paths: dict
+        Resolved paths, e.g. from :class:'product_index.ProductIndex': {"granule": granule directory,
+        "qi": quality information directory, channel: image file}. Skips all directory and file lookups.
     """
 
     """List of channels with 10m ground resolution"""
@@ -170,7 +541,7 @@ class ImageSet:
     """List of channels with 20m ground resolution"""
     ch20m = ["B05", "B06", "B07", "B8A", "B11", "B12"]
 
-    def __init__(self, data_path, image_set_name):
+    def __init__(self, data_path, image_set_name, image_paths=None):
         # Interprete project name
         re_match = re.match(r"(S2[AB])_MSIL([12][A-C])_(\d{8}T\d{6})_"
                             r"N(\d{4})_R(\d{3})_T(\d{1,2}[A-HJ-NP-Z][A-HJ-NP-Z][A-HJ-NP-V])_(\d{8}T\d{6})",
@@ -187,10 +558,28 @@ class ImageSet:
         self.tile = MGRS(re_match.group(6))
         self.product_discriminator = re_match.group(7)
 
+        self.image_paths = image_paths
+        self.zip_fn = None
+        if image_paths:
+            self.data_path = image_paths["granule"]
+            return
+
         # Find and test existence of data directory in project
         image_dir = os.path.join(data_path, self.image_set_name, self.image_set_name + ".SAFE", "GRANULE")
         if not os.path.isdir(image_dir):
-            raise ValueError(f"Directory does not exist: {image_dir}")
+            # Look for zipped product, read through GDAL's /vsizip/ file system
+            self.zip_fn = find_product_zip(data_path, self.image_set_name)
+            if not self.zip_fn:
+                raise ValueError(f"Directory does not exist: {image_dir}")
+
+            granule_re = re.compile(f"(.*/)?{re.escape(self.image_set_name + '.SAFE')}/GRANULE/"
+                                    f"L{self.product_level}_T{self.tile.code}_A[^/]*$")
+            files, dirs = zip_members(self.zip_fn)
+            granules = sorted(d for d in dirs if granule_re.match(d))
+            if not granules:
+                raise ValueError(f"Unable to find granule directory in: {self.zip_fn}")
+            self.data_path = posixpath.join("/vsizip/" + self.zip_fn.replace(os.sep, "/"), granules[0])
+            return
 
         image_dir = os.path.join(image_dir, f"L{self.product_level}_T{self.tile.code}_A*")
         glob_match = glob.glob(image_dir)
@@ -213,6 +602,11 @@ class ImageSet:
             Full file path to image file
         """
         # GRANULE\\L2A_T32VNN_A007084_20180715T105300\\IMG_DATA\\R10m\\T32VNN_20180715T105029_B02_10m.jp2,
+        if self.image_paths:
+            if channel not in self.image_paths:
+                raise ValueError(f"Illegal or missing channel: {channel}")
+            return self.image_paths[channel]
+
         if channel in ImageSet.ch10m:
             ground_resolution = 10
         elif channel in ImageSet.ch20m:
@@ -221,24 +615,52 @@ class ImageSet:
             raise ValueError(f"Illegal channel: {channel}")
 
         # Find and test for existence of image files
-        image_dir = os.path.join(self.data_path, "IMG_DATA", f"R{ground_resolution}m")
-        if not os.path.isdir(image_dir):
+        image_dir = self._join(self.data_path, "IMG_DATA", f"R{ground_resolution}m")
+        if not self._isdir(image_dir):
             raise ValueError(f"Directory does not exist: {image_dir}")
 
-        image_fn = os.path.join(image_dir, f"T{self.tile.code}_{self.datatake_time}_{channel}_{ground_resolution}m.jp2")
-        if not os.path.isfile(image_fn):
+        image_fn = self._join(image_dir, f"T{self.tile.code}_{self.datatake_time}_{channel}_{ground_resolution}m.jp2")
+        if not self._isfile(image_fn):
             raise ValueError(f"Image file does not exist: {image_fn}")
 
         return image_fn
 
     def get_qi_path(self):
         """Return directory path ti quality information"""
-        qi_path = os.path.join(self.data_path, "QI_DATA")
-        if not os.path.isdir(qi_path):
+        if self.image_paths:
+            return self.image_paths["qi"]
+
+        qi_path = self._join(self.data_path, "QI_DATA")
+        if not self._isdir(qi_path):
             raise ValueError(f"Directory does not exist: {qi_path}")
 
         return qi_path
 
+    def get_qi_filename(self, qi_name):
+        """Return full filename of a quality information image, e.g. "MSK_CLDPRB_20m.jp2" """
+        qi_fn = self._join(self.get_qi_path(), qi_name)
+        if not self.image_paths and not self._isfile(qi_fn):
+            raise ValueError(f"Image file does not exist: {qi_fn}")
+        return qi_fn
+
+    def _join(self, *parts):
+        """Join path, with / as separator inside zip archives"""
+        return posixpath.join(*parts) if self.zip_fn else os.path.join(*parts)
+
+    def _zip_member(self, path):
+        """Path inside zip archive of a /vsizip/ path"""
+        return path[len("/vsizip/" + self.zip_fn.replace(os.sep, "/")) + 1:]
+
+    def _isdir(self, path):
+        if self.zip_fn:
+            return self._zip_member(path) in zip_members(self.zip_fn)[1]
+        return os.path.isdir(path)
+
+    def _isfile(self, path):
+        if self.zip_fn:
+            return self._zip_member(path) in zip_members(self.zip_fn)[0]
+        return os.path.isfile(path)
+
     def __repr__(self):
         return f"MGRS(mission={self.mission}, product_level={self.product_level}, datatake_time={self.datatake_time}, " \
             f"processing_baseline_nr={self.processing_baseline_nr}, relative_orbit_nr={self.relative_orbit_nr}, " \
@@ -246,30 +668,15 @@ class ImageSet:
 
 
 
-def fill_features(feature_layer, feature_table, cols, rows, xform, proj, filename):
-    """Fill an image with cathegorical values.
-
-     Parameters
-     ----------
-     feature_layer: gdal layer
-        Database or vector data file
-    feature_table: [("SQL query", "Description", int), ...]
-        Table of tuples of (query, description, category ix value)
-    cols, rows: int
-        Output image dimensions
-    xform: [x0, x_scale, 0, y0, 0, y_scale]
-        Affine transform relating image coordinate system and world coordinate system.
-        Similar to transform used in geotiff, world files etc...
-    proj: str
-        WKT description of world coordinate system
-    filename: str(path)
-        Output filemname
-     """
-    # Create image
-    target_ds = gdal.GetDriverByName('GTiff').Create(filename, cols, rows, 1, gdal.GDT_Byte, ['COMPRESS=LZW', 'PREDICTOR=2'])
-    target_ds.SetGeoTransform(xform)
-    target_ds.SetProjection(proj)
+def set_extent_filter(feature_layer, cols, rows, xform, proj):
+    """Set spatial filter of a feature layer to the extent of an image
 
+    Parameters
+    ----------
+    feature_layer: gdal layer
+    cols, rows, xform, proj:
+        See :func:'training_data.fill_features()'
+    """
     # Set geographic search values
     x_min = xform[0]
     y_max = xform[3]
@@ -295,6 +702,97 @@ def fill_features(feature_layer, feature_table, cols, rows, xform, proj, filenam
     # set spatial filter
     feature_layer.SetSpatialFilter(poly)
 
+
+def layer_version(feature_layer, version=None):
+    """Version of the data in a feature layer, part of the label cache keys
+
+    Parameters
+    ----------
+    feature_layer: gdal layer
+    version: str
+        Explicit version, e.g. the date of a data delivery or a database snapshot id. Should be given for layers
+        that may be edited in place, as the derived version only changes when features are added or removed.
+
+    Returns
+    -------
+    str
+        The explicit version, otherwise a fingerprint of layer name, feature count and extent
+    """
+    if version is not None:
+        return str(version)
+    feature_layer.SetSpatialFilter(None)
+    feature_layer.SetAttributeFilter(None)
+    return f"{feature_layer.GetName()}:{feature_layer.GetFeatureCount()}:{feature_layer.GetExtent()}"
+
+
+def label_key(xform, cols, rows, proj, feature_table, version):
+    """Content key of a categorical image, see :func:'training_data.fill_features()'
+
+    The image depends only on its bounds and coordinate system, the feature table and the version of the feature
+    layer (see :func:'training_data.layer_version()'), not on the satelite image it is used with.
+    """
+    content = repr((tuple(xform), cols, rows, proj, [tuple(feature) for feature in feature_table], version))
+    return hashlib.sha1(content.encode()).hexdigest()
+
+
+class LabelCache:
+    """Content addressed store of categorical images, see :func:'training_data.label_key()'
+
+    Parameters
+    ----------
+    path: str (path)
+        Cache directory, images are stored as "<key[:2]>/<key>.tif"
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def filename(self, key):
+        return os.path.join(self.path, key[:2], key + ".tif")
+
+    def get(self, key):
+        """Cached image as an array, None if not in cache"""
+        img = gdal.Open(self.filename(key)) if os.path.exists(self.filename(key)) else None
+        return img.GetRasterBand(1).ReadAsArray() if img else None
+
+    def put(self, key, array, xform, proj):
+        """Store an image, written to a temporary file and renamed so readers never see a partial image"""
+        fn = self.filename(key)
+        os.makedirs(os.path.dirname(fn), exist_ok=True)
+        tmp_fn = f"{fn}.{os.getpid()}.{threading.get_ident()}.tmp"
+        write_patch(tmp_fn, [array], xform, proj, gdal.GDT_Byte)
+        os.replace(tmp_fn, fn)
+
+
+def fill_features(feature_layer, feature_table, cols, rows, xform, proj, filename, driver='GTiff'):
+    """Fill an image with cathegorical values.
+
+     Parameters
+     ----------
+     feature_layer: gdal layer
+        Database or vector data file
+    feature_table: [("SQL query", "Description", int), ...]
+        Table of tuples of (query, description, category ix value)
+    cols, rows: int
+        Output image dimensions
+    xform: [x0, x_scale, 0, y0, 0, y_scale]
+        Affine transform relating image coordinate system and world coordinate system.
+        Similar to transform used in geotiff, world files etc...
+    proj: str
+        WKT description of world coordinate system
+    filename: str(path)
+        Output filemname
+    driver: str
+        GDAL driver, 'MEM' for an image in memory only
+     """
+    # Create image
+    options = ['COMPRESS=LZW', 'PREDICTOR=2'] if driver == 'GTiff' else []
+    target_ds = gdal.GetDriverByName(driver).Create(filename, cols, rows, 1, gdal.GDT_Byte, options)
+    target_ds.SetGeoTransform(xform)
+    target_ds.SetProjection(proj)
+
+    # set spatial filter
+    set_extent_filter(feature_layer, cols, rows, xform, proj)
+
     # Fill raster
     for feature in feature_table:
         # Rasterize
@@ -307,8 +805,8 @@ def fill_features(feature_layer, feature_table, cols, rows, xform, proj, filenam
     return target_ds
 
 
-def image_set_load(image_path_list):
-    """Load a set of images of identical dimension and coordinate system
+def image_set_open(image_path_list):
+    """Open a set of images of identical dimension and coordinate system without reading any pixels
 
     Parmeters
     ---------
@@ -317,7 +815,7 @@ def image_set_load(image_path_list):
 
     Returns
     -------
-    np_bands: list(ndarray(rows, cols))
+    datasets: list(gdal.Dataset)
     cols, rows: int
     xform: [x0, x_scale, 0, y0, 0, y_scale]
         Affine transform relating image coordinate system and world coordinate system.
@@ -325,7 +823,7 @@ def image_set_load(image_path_list):
     projstr
         WKT description of world coordinate system
     """
-    np_bands = []
+    datasets = []
 
     xform = None
     proj = None
@@ -358,121 +856,692 @@ def image_set_load(image_path_list):
             print(f"Bilde {image_path} har annen størrelse ({img.RasterYSize}) enn de andre ({rows})")
             continue
 
-        band = img.GetRasterBand(1)
-        np_band = band.ReadAsArray()
-        np_bands.append(np_band)
+        datasets.append(img)
+    return datasets, cols, rows, xform, proj
+
+
+def image_set_read(datasets, xoff, yoff, xsize, ysize):
+    """Read the same window from a set of images opened by :func:'training_data.image_set_open()'
+
+    Parameters
+    ----------
+    datasets: list(gdal.Dataset)
+    xoff, yoff, xsize, ysize: int
+        Pixel window to read
+
+    Returns
+    -------
+    list(ndarray(ysize, xsize))
+    """
+    return [ds.GetRasterBand(1).ReadAsArray(xoff, yoff, xsize, ysize) for ds in datasets]
+
+
+def image_set_load(image_path_list):
+    """Load a set of images of identical dimension and coordinate system
+
+    Parmeters
+    ---------
+    image_path_list: list(str)
+        List of image file names
+
+    Returns
+    -------
+    np_bands: list(ndarray(rows, cols))
+    cols, rows: int
+    xform: [x0, x_scale, 0, y0, 0, y_scale]
+        Affine transform relating image coordinate system and world coordinate system.
+        Similar to transform used in geotiff, world files etc...
+    projstr
+        WKT description of world coordinate system
+    """
+    datasets, cols, rows, xform, proj = image_set_open(image_path_list)
+    np_bands = [ds.GetRasterBand(1).ReadAsArray() for ds in datasets]
     return np_bands, cols, rows, xform, proj
 
 
-def generate_training_data_from_image(image_set, feature_layer, feature_table, patch_sz, out_path):
-    """Save data from large satelite image into smaller files more well suited for machine learning
+def patch_grid(tile, xform, cols, rows, patch_sz, stride=None, ground_res=10):
+    """Positions of the patches covering the 100x100km part of an MGRS tile
+
+    Parameters
+    ----------
+    tile: MGRS
+    xform: [x0, x_scale, 0, y0, 0, y_scale]
+        Transform of the 10m images
+    cols, rows: int
+        Size of the 10m images
+    patch_sz: int
+        Size of patches (pixels at base resolution)
+    stride: int
+        Distance between patches (pixels at base resolution), default patch_sz
+
+    Returns
+    -------
+    n, e: ndarray(int)
+        World coordinates of the upper left corner of each patch row and column, rows from north to south
+    j, i: ndarray(int)
+        Pixel position of each patch row and column in the 10m images
+    """
+    step = (stride or patch_sz) * ground_res
+    n = np.arange(int(m.floor((tile.n + 100000) / step)) * step, tile.n, -step)
+    e = np.arange(int(m.ceil(tile.e / step)) * step, tile.e + 100000, step)
+    j = ((n - xform[3]) // xform[5]).astype(int)
+    i = ((e - xform[0]) // xform[1]).astype(int)
+
+    # Only patches completely inside the image
+    row_ok = (j >= 0) & (j + patch_sz <= rows)
+    col_ok = (i >= 0) & (i + patch_sz <= cols)
+    return n[row_ok], e[col_ok], j[row_ok], i[col_ok]
+
+
+def window_sums(array, y0, y1, x0, x1):
+    """Sum of an array over many rectangular windows, using an integral image
+
+    Parameters
+    ----------
+    array: ndarray(rows, cols)
+    y0, y1, x0, x1: ndarray(int)
+        Window limits (upper limits exclusive), broadcast against each other
+
+    Returns
+    -------
+    ndarray
+        Sum of each window
+    """
+    integral = np.zeros((array.shape[0] + 1, array.shape[1] + 1))
+    integral[1:, 1:] = np.cumsum(np.cumsum(array, axis=0, dtype=np.float64), axis=1)
+    y0, y1 = np.clip(y0, 0, array.shape[0]), np.clip(y1, 0, array.shape[0])
+    x0, x1 = np.clip(x0, 0, array.shape[1]), np.clip(x1, 0, array.shape[1])
+    return integral[y1, x1] - integral[y0, x1] - integral[y1, x0] + integral[y0, x0]
+
+
+def grid_window_means(array, scale, j, i, patch_sz):
+    """Mean of a low resolution image over each patch of a grid
+
+    Parameters
+    ----------
+    array: ndarray(rows, cols)
+        Low resolution image covering the same area as the 10m images
+    scale: float
+        Pixel size of array relative to the 10m images
+    j, i: ndarray(int)
+        Pixel position of patch rows and columns in the 10m images
+    patch_sz: int
+        Size of patches (pixels at base resolution)
+
+    Returns
+    -------
+    ndarray(len(j), len(i))
+    """
+    y0 = np.floor(j / scale).astype(int)[:, None]
+    y1 = np.maximum(np.ceil((j + patch_sz) / scale).astype(int), y0[:, 0] + 1)[:, None]
+    x0 = np.floor(i / scale).astype(int)[None, :]
+    x1 = np.maximum(np.ceil((i + patch_sz) / scale).astype(int), x0[0, :] + 1)[None, :]
+    return window_sums(array, y0, y1, x0, x1) / ((y1 - y0) * (x1 - x0))
+
+
+def feature_presence(feature_layer, feature_table, cols, rows, xform, proj):
+    """Rasterize where there are labelled features (category > 0) of a feature table
+
+    Parameters
+    ----------
+    feature_layer, feature_table, cols, rows, xform, proj:
+        See :func:'training_data.fill_features()'
+
+    Returns
+    -------
+    ndarray(rows, cols)
+        1 where there are features, 0 elsewhere
+    """
+    target_ds = gdal.GetDriverByName('MEM').Create("", cols, rows, 1, gdal.GDT_Byte)
+    target_ds.SetGeoTransform(xform)
+    target_ds.SetProjection(proj)
+
+    queries = [f"({feature[0]})" for feature in feature_table if feature[2] > 0]
+    set_extent_filter(feature_layer, cols, rows, xform, proj)
+    feature_layer.SetAttributeFilter(" OR ".join(queries) if queries else None)
+    if gdal.RasterizeLayer(target_ds, [1], feature_layer, burn_values=[1], options=['ALL_TOUCHED=TRUE']) != 0:
+        raise Exception("error rasterizing feature presence")
+    feature_layer.SetAttributeFilter(None)
+    return target_ds.GetRasterBand(1).ReadAsArray()
+
+
+def screen_layers(image_set, feature_layer, feature_table, xform, cols, rows, proj):
+    """Low resolution layers used for screening patches, see :func:'training_data.screen_patch_grid()'
+
+    Uses the 60m cloud and snow probability masks (20m if 60m is missing), a reduced resolution read of the
+    first 10m band (served from JP2 resolution levels or overviews) and a 60m rasterization of the feature layer.
+    The layers are independent of patch size and stride, and can be shared by several patch grids.
 
     Parameters
     ----------
     image_set: ImageSet
-        The satelite 100x100km tile
     feature_layer, feature_table:
         See :func:'training_data.fill_features()'
+    xform, cols, rows, proj:
+        Transform, size and projection of the 10m images
+
+    Returns
+    -------
+    dict
+        {name: (array, pixel size relative to the 10m images)} for "cloud", "snow" and "nodata" shares,
+        and "presence" of features
+    """
+    layers = {}
+
+    # Cloud and snow cover
+    qi_masks = []
+    for qi_name in ("MSK_CLDPRB", "MSK_SNWPRB"):
+        try:
+            qi_masks.append(image_set.get_qi_filename(qi_name + "_60m.jp2"))
+        except ValueError:
+            qi_masks.append(image_set.get_qi_filename(qi_name + "_20m.jp2"))
+    (cld_array, snw_array), qi_cols, qi_rows, qi_xform, qi_proj = image_set_load(qi_masks)
+    qi_scale = qi_xform[1] / xform[1]
+    layers["cloud"] = (np.minimum(cld_array / 50, 1.0), qi_scale)
+    layers["snow"] = (np.minimum(snw_array / 50, 1.0), qi_scale)
+
+    # Nodata outside the orbit swath, from a low resolution read
+    scale = 6
+    ds = gdal.Open(image_set.get_channel_image_filename(ImageSet.ch10m[0]))
+    low_res = ds.GetRasterBand(1).ReadAsArray(0, 0, cols, rows, buf_xsize=cols // scale, buf_ysize=rows // scale)
+    layers["nodata"] = (low_res == 0, cols / (cols // scale))
+
+    # Labelled features
+    if feature_layer is not None:
+        low_xform = (xform[0], xform[1] * scale, xform[2], xform[3], xform[4], xform[5] * scale)
+        presence = feature_presence(feature_layer, feature_table, cols // scale, rows // scale, low_xform, proj)
+        layers["presence"] = (presence, scale)
+    return layers
+
+
+def screen_patch_grid(image_set, feature_layer, feature_table, xform, cols, rows, proj, j, i, patch_sz,
+                      max_cloud=0.1, max_snow=0.1, max_nodata=0.5, layers=None):
+    """Find patches worth producing from low resolution data
+
+    Parameters
+    ----------
+    image_set, feature_layer, feature_table, xform, cols, rows, proj:
+        See :func:'training_data.screen_layers()'
+    j, i: ndarray(int)
+        Pixel position of patch rows and columns, see :func:'training_data.patch_grid()'
     patch_sz: int
         Size of patches (pixels at base resolution)
-    out_path: str
-        Path to root of training data
+    max_cloud, max_snow: float
+        Maximum share of cloud and snow, pixel probabilities above 50% count as fully covered
+    max_nodata: float
+        Maximum share of nodata pixels
+    layers: dict
+        Result of :func:'training_data.screen_layers()', computed if not given
+
+    Returns
+    -------
+    ndarray(str) (len(j), len(i))
+        Reason for rejecting each patch, empty for patches worth producing
     """
-    # Prepare output directory
-    out_path = os.path.join(out_path, f"{image_set.tile.zone:02}{'S' if band_code_to_nr[image_set.tile.band] < 0 else 'N'}")
-    out_path = os.path.join(out_path, f"{image_set.tile.n // 100000:02}_{image_set.tile.e // 100000:01}")
-    os.makedirs(out_path, exist_ok=True)
+    if layers is None:
+        layers = screen_layers(image_set, feature_layer, feature_table, xform, cols, rows, proj)
+    reasons = np.full((len(j), len(i)), "", dtype="U16")
 
-    # Make list of lienames
-    image_path_list_10m = [image_set.get_channel_image_filename(ch) for ch in ImageSet.ch10m]
-    image_path_list_20m = [image_set.get_channel_image_filename(ch) for ch in ImageSet.ch20m]
+    def means(name):
+        array, scale = layers[name]
+        return grid_window_means(array, scale, j, i, patch_sz)
 
-    # Load data
-    np_bands_10m, cols_10m, rows_10m, xform_10m, proj_10m = image_set_load(image_path_list_10m)
-    np_bands_20m, cols_20m, rows_20m, xform_20m, proj_20m = image_set_load(image_path_list_20m)
-
-    # Load [Cloudcover, Snowcover] images
-    bands_cld_snw, cols_cld_snw, rows_cld_snw, xform_cld_snw, proj_cld_snw = \
-        image_set_load([os.path.join(image_set.get_qi_path(), "MSK_CLDPRB_20m.jp2"),
-                        os.path.join(image_set.get_qi_path(), "MSK_SNWPRB_20m.jp2")])
-
-    cld_array = bands_cld_snw[0]
-    snw_array = bands_cld_snw[1]
-
-    # Image patch position
-    ground_res = 10
-    n = int(m.floor((image_set.tile.n + 100000) / (patch_sz * ground_res))) * patch_sz * ground_res
-    while n > image_set.tile.n:
-        e = int(m.ceil(image_set.tile.e / (patch_sz * ground_res))) * patch_sz * ground_res
-        while e < image_set.tile.e + 100000:
-            i = int((e - xform_10m[0]) //  xform_10m[1])
-            j = int((n - xform_10m[3]) //  xform_10m[5])
-
-            # Check cloud and snowcover
-            cld_cover = 0
-            snw_cover = 0
-            for ci in range(i // 2, (i +  patch_sz) // 2):
-                for cj in range(j // 2, (j + patch_sz) // 2):
-                    cld_cover = min(cld_array[cj, ci] / 50, 1.0)
-                    snw_cover = min(snw_array[cj, ci] / 50, 1.0)
-
-            if cld_cover >= (patch_sz/2)**2 * 0.1 or snw_cover >= (patch_sz/2)**2 * 0.1:
-                continue
+    reasons[(reasons == "") & (means("cloud") >= max_cloud)] = "cloud"
+    reasons[(reasons == "") & (means("snow") >= max_snow)] = "snow"
+    reasons[(reasons == "") & (means("nodata") > max_nodata)] = "nodata"
 
+    # Only patches containing labelled features
+    if "presence" in layers:
+        reasons[(reasons == "") & (means("presence") <= 0)] = "no_features"
 
+    return reasons
 
-            # Create output directory
-            img_out_path = os.path.join(out_path, f"{n // 10000 % 10}_{e // 10000 % 10}")
-            os.makedirs(img_out_path, exist_ok=True)
 
-            # Compute image transform
-            img_xform_10m = (e, xform_10m[1], xform_10m[2],
-                             n, xform_10m[4], xform_10m[5])
-            img_xform_20m = (e, xform_20m[1], xform_20m[2],
-                             n, xform_20m[4], xform_20m[5])
+def patch_statistics(np_bands_10m, np_bands_20m, labels, i, patch_sz, saturation=2 ** 16 - 1):
+    """Validity statistics for a row of patches
 
-            # Create colorimage for ML source
-            # 10m images
-            fn = os.path.join(img_out_path, f"{n}_{e}_{patch_sz}_10_{image_set.image_set_name}_B02B03B04B08.tif")
-            ds = gdal.GetDriverByName('GTiff').Create(fn,
-                                                      patch_sz, patch_sz, len(np_bands_10m), gdal.GDT_UInt16,
-                                                      ['COMPRESS=LZW', 'PREDICTOR=2'])
-            ds.SetGeoTransform(img_xform_10m)
-            ds.SetProjection(proj_10m)
+    Parameters
+    ----------
+    np_bands_10m, np_bands_20m: list(ndarray)
+        Strips of 10m and 20m bands covering the patch row
+    labels: ndarray
+        Strip of the categorical target image covering the patch row
+    i: ndarray(int)
+        Pixel column of each patch in the 10m strips
+    patch_sz: int
+        Size of patches (pixels at base resolution)
+    saturation: int
+        Pixel value of saturated pixels
 
-            # Fill with data
-            for band_nr, array in enumerate(np_bands_10m):
-                patch = array[j:j + patch_sz, i:i +  patch_sz]
-                ds.GetRasterBand(band_nr + 1).WriteArray(patch)
+    Returns
+    -------
+    nodata, saturated, unknown: ndarray(len(i))
+        Share of nodata pixels (0 in any band), saturated pixels (in any band) and unknown category (0) pixels
+    """
+    def shares(mask, scale):
+        sz = patch_sz // scale
+        x0 = i // scale
+        return window_sums(mask, np.array(0), np.array(sz), x0, x0 + sz) / sz ** 2
+
+    nodata = np.maximum(shares(np.any([b == 0 for b in np_bands_10m], axis=0), 1),
+                        shares(np.any([b == 0 for b in np_bands_20m], axis=0), 2))
+    saturated = np.maximum(shares(np.any([b >= saturation for b in np_bands_10m], axis=0), 1),
+                           shares(np.any([b >= saturation for b in np_bands_20m], axis=0), 2))
+    unknown = shares(labels == 0, 1)
+    return nodata, saturated, unknown
+
+
+def write_patch(filename, arrays, xform, proj, data_type=gdal.GDT_UInt16):
+    """Write a list of equally sized arrays as bands of a compressed GeoTIFF"""
+    ds = gdal.GetDriverByName('GTiff').Create(filename, arrays[0].shape[1], arrays[0].shape[0], len(arrays),
+                                              data_type, ['COMPRESS=LZW', 'PREDICTOR=2'])
+    ds.SetGeoTransform(xform)
+    ds.SetProjection(proj)
+
+    # Fill with data
+    for band_nr, array in enumerate(arrays):
+        ds.GetRasterBand(band_nr + 1).WriteArray(array)
+    ds = None
+
+
+class StripBuffer:
+    """Read horizontal strips of a set of images, limited to a fixed column range
+
+    Rows are kept between reads, so a sequence of overlapping strips with increasing row numbers decodes each row
+    only once. Rows above the last requested strip are released.
+
+    Parameters
+    ----------
+    datasets: list(gdal.Dataset)
+        See :func:'training_data.image_set_open()'
+    col0, col1: int
+        Column range to read
+    """
+    def __init__(self, datasets, col0, col1):
+        self.datasets = datasets
+        self.col0 = col0
+        self.col1 = col1
+        self.row0 = 0
+        self.row1 = 0
+        self.arrays = None
+
+    def read(self, row0, row1):
+        """Read rows row0 to row1 (exclusive)
+
+        Returns
+        -------
+        list(ndarray(row1 - row0, col1 - col0))
+        """
+        if self.arrays is None or row0 < self.row0 or row0 >= self.row1:
+            self.arrays = image_set_read(self.datasets, self.col0, row0, self.col1 - self.col0, row1 - row0)
+            self.row0, self.row1 = row0, row1
+        elif row1 > self.row1:
+            # Keep the overlap, read the new rows only
+            new_rows = image_set_read(self.datasets, self.col0, self.row1, self.col1 - self.col0, row1 - self.row1)
+            self.arrays = [np.concatenate((old[row0 - self.row0:], new)) for old, new in zip(self.arrays, new_rows)]
+            self.row0, self.row1 = row0, row1
+        return [array[row0 - self.row0:row1 - self.row0] for array in self.arrays]
+
+
+PatchConfig = collections.namedtuple("PatchConfig", ["patch_sz", "stride"])
+PatchConfig.__doc__ = """Patch size and stride (pixels at base resolution) of one patch grid"""
+
+
+def patch_config_dir(config):
+    """Output directory name of a patch configuration, e.g. p128_s64"""
+    return f"p{config.patch_sz}_s{config.stride or config.patch_sz}"
 
-            # 20m images
-            fn = os.path.join(img_out_path, f"{n}_{e}_{patch_sz//2}_20_{image_set.image_set_name}_B05B06B07B8AB11B12.tif")
-            ds = gdal.GetDriverByName('GTiff').Create(fn,
-                                                      patch_sz // 2, patch_sz // 2, len(np_bands_20m), gdal.GDT_UInt16,
-                                                      ['COMPRESS=LZW', 'PREDICTOR=2'])
-            ds.SetGeoTransform(img_xform_20m)
-            ds.SetProjection(proj_20m)
 
-            # Fill with data
-            for band_nr, array in enumerate(np_bands_20m):
-                patch = array[j // 2: (j + patch_sz) // 2, i // 2: (i + patch_sz) // 2]
-                ds.GetRasterBand(band_nr + 1).WriteArray(patch)
-            ds = None
+def prefetch(iterable, queue_sz=4):
+    """Iterate in a background thread, at most queue_sz items ahead of the consumer
 
-            # Create categorical image of feature layers
-            fn = os.path.join(img_out_path, f"{n}_{e}_{patch_sz}_10_AR5.tif")
-            if not os.path.exists(fn):
-                # Create only if it doesn't exist
-                fill_features(feature_layer, feature_table, patch_sz, patch_sz, img_xform_10m, proj_10m, fn)
+    Exceptions raised by the iteration are raised in the consumer.
+    """
+    items = queue.Queue(queue_sz)
+    done = object()
+
+    def produce():
+        try:
+            for item in iterable:
+                items.put((item, None))
+        except Exception as ex:
+            items.put((done, ex))
+            return
+        items.put((done, None))
+
+    threading.Thread(target=produce, daemon=True).start()
+    while True:
+        item, error = items.get()
+        if error is not None:
+            raise error
+        if item is done:
+            return
+        yield item
+
+
+def read_patch_key(filename):
+    """Content key of a patch written by :class:'training_data.PatchWriter', None if missing"""
+    try:
+        with open(filename + ".key") as file:
+            return file.read().strip()
+    except OSError:
+        return None
+
+
+class PatchWriter:
+    """Write patch images with a pool of threads, fed through a bounded queue
+
+    GDAL releases the GIL while compressing and writing, so the writers run in parallel with reading and slicing.
+    :meth:'PatchWriter.write' blocks when the queue is full, which bounds the memory held by pending patches.
+
+    Parameters
+    ----------
+    workers: int
+        Number of writer threads
+    queue_sz: int
+        Maximum number of pending patches
+    """
+    def __init__(self, workers=4, queue_sz=64):
+        self.queue = queue.Queue(queue_sz)
+        self.errors = []
+        self.threads = [threading.Thread(target=self._work, daemon=True) for _ in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def _work(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            filename, arrays, xform, proj, data_type, key = job
+            try:
+                write_patch(filename, arrays, xform, proj, data_type)
+                if key is not None:
+                    with open(filename + ".key", "w") as file:
+                        file.write(key)
+            except Exception as ex:
+                self.errors.append(ex)
+
+    def write(self, filename, arrays, xform, proj, data_type=gdal.GDT_UInt16, key=None):
+        """Queue a patch, see :func:'training_data.write_patch()'
+
+        A content key is written to a "<filename>.key" sidecar file after the image, see
+        :func:'training_data.read_patch_key()'
+        """
+        if self.errors:
+            raise self.errors[0]
+        self.queue.put((filename, arrays, xform, proj, data_type, key))
 
-            e += patch_sz * ground_res
-        n -= patch_sz * ground_res
+    def close(self):
+        """Wait for all pending patches to be written"""
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        if self.errors:
+            raise self.errors[0]
+
+
+class LabelRaster:
+    """Categorical target image, rasterized block by block in a background thread
+
+    Rows can be used as soon as their block is rasterized, so database queries overlap band reads. Blocks are
+    full rows of the image at fixed positions, so cached blocks (see :class:'training_data.LabelCache') are
+    reused by all satelite images of the tile.
+
+    Parameters
+    ----------
+    feature_layer, feature_table, cols, rows, xform, proj:
+        See :func:'training_data.fill_features()'
+    block_rows: int
+        Number of rows rasterized at a time
+    row0, row1: int
+        Rows needed, default all
+    cache: LabelCache
+        Cache of rasterized blocks
+    version: str
+        Version of feature layer, see :func:'training_data.layer_version()'
+    """
+    def __init__(self, feature_layer, feature_table, cols, rows, xform, proj, block_rows=1024, row0=0, row1=None,
+                 cache=None, version=None):
+        self.start = row0 // block_rows * block_rows
+        row1 = rows if row1 is None else row1
+        self.labels = np.zeros((row1 - self.start, cols), dtype=np.uint8)
+        self.done_rows = self.start
+        self.error = None
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self._rasterize, daemon=True,
+                                       args=(feature_layer, feature_table, rows, xform, proj, block_rows, row1,
+                                             cache, version))
+        self.thread.start()
+
+    def _rasterize(self, feature_layer, feature_table, rows, xform, proj, block_rows, row1, cache, version):
+        cols = self.labels.shape[1]
+        try:
+            for block0 in range(self.start, row1, block_rows):
+                block1 = min(block0 + block_rows, rows)
+                block_xform = (xform[0], xform[1], xform[2], xform[3] + block0 * xform[5], xform[4], xform[5])
+                key = label_key(block_xform, cols, block1 - block0, proj, feature_table, version)
+                block = cache.get(key) if cache else None
+                if block is None:
+                    block = fill_features(feature_layer, feature_table, cols, block1 - block0, block_xform, proj,
+                                          "", driver='MEM').GetRasterBand(1).ReadAsArray()
+                    if cache:
+                        cache.put(key, block, block_xform, proj)
+                self.labels[block0 - self.start:block1 - self.start] = block[:row1 - block0]
+                with self.cond:
+                    self.done_rows = block1
+                    self.cond.notify_all()
+        except Exception as ex:
+            with self.cond:
+                self.error = ex
+                self.cond.notify_all()
+
+    def read(self, row0, row1):
+        """Rows row0 to row1 (exclusive), waits until they are rasterized"""
+        with self.cond:
+            self.cond.wait_for(lambda: self.done_rows >= row1 or self.error is not None)
+        if self.error is not None:
+            raise self.error
+        return self.labels[row0 - self.start:row1 - self.start]
+
+
+def training_tile_dir(tile):
+    """Output directory of the training patches of an MGRS tile, relative to the root of the training data"""
+    return os.path.join(f"{tile.zone:02}{'S' if band_code_to_nr[tile.band] < 0 else 'N'}",
+                        f"{tile.n // 100000:02}_{tile.e // 100000:01}")
+
+
+def generate_training_data_from_image(image_set, feature_layer, feature_table, patch_sz, out_path,
+                                      max_cloud=0.1, max_snow=0.1, max_nodata=0.01, max_saturated=0.01,
+                                      max_unknown=0.5, read_ahead=4, writers=4, write_queue=64,
+                                      label_block_rows=1024, label_name="AR5", version=None, label_cache_path=None):
+    """Save data from large satelite image into smaller files more well suited for machine learning
+
+    The patch grid is first screened with low resolution data (see :func:'training_data.screen_patch_grid()'),
+    and full resolution data are only read for the rows and columns of surviving patches. Patches with too much
+    nodata, saturated pixels or unknown category are then dropped before any files are written, see
+    :func:'training_data.patch_statistics()'. The categorical target image is rasterized once for the whole
+    area of surviving patches. Rejected patches and the reasons are appended to "rejected_patches.csv" in the
+    tile output directory.
+
+    Several patch sizes and strides can be produced in one run. The bands are decoded, and the screening layers
+    and target image computed, only once for all of them.
+
+    Reading, rasterization of the target image, slicing and writing run as a pipeline: band strips are read by
+    a background thread (see :func:'training_data.prefetch()'), the target image is rasterized block by block
+    by another thread (see :class:'training_data.LabelRaster') and patches are written by a pool of threads
+    (see :class:'training_data.PatchWriter'). The queues between the stages are bounded, so memory use is
+    limited when a stage falls behind.
+
+    Target images are identified by a content key of bounds, coordinate system, feature table and feature layer
+    version (see :func:'training_data.label_key()'). Rasterized blocks of the tile are cached, and a patch target
+    image is only rewritten when its key differs from the key of the existing file, so labels are reused across
+    satelite images and refreshed when the feature data or table change.
+
+    Parameters
+    ----------
+    image_set: ImageSet
+        The satelite 100x100km tile
+    feature_layer, feature_table:
+        See :func:'training_data.fill_features()'
+    patch_sz: int or list(PatchConfig)
+        Size of patches (pixels at base resolution), stored directly in out_path. Or a list of patch
+        configurations, each stored in a subdirectory of out_path, see :func:'training_data.patch_config_dir()'
+    out_path: str
+        Path to root of training data
+    max_cloud, max_snow, max_nodata: float
+        See :func:'training_data.screen_patch_grid()'
+    max_saturated, max_unknown: float
+        Maximum share of saturated pixels and pixels of unknown category (0)
+    read_ahead: int
+        Number of patch rows read ahead of slicing
+    writers, write_queue: int
+        Number of writer threads and maximum number of patches waiting to be written
+    label_block_rows: int
+        Number of target image rows rasterized at a time
+    label_name: str
+        Name of the target images, "{n}_{e}_{patch_sz}_10_{label_name}.tif"
+    version: str
+        Version of feature layer, see :func:'training_data.layer_version()'
+    label_cache_path: str (path)
+        Cache of rasterized target image blocks, default "label_cache" in out_path
+    """
+    version = layer_version(feature_layer, version)
+    label_cache = LabelCache(label_cache_path or os.path.join(out_path, "label_cache"))
+
+    if isinstance(patch_sz, int):
+        configs = [(PatchConfig(patch_sz, patch_sz), out_path)]
+    else:
+        configs = [(PatchConfig(config.patch_sz, config.stride or config.patch_sz),
+                    os.path.join(out_path, patch_config_dir(config))) for config in patch_sz]
+
+    tile_dir = training_tile_dir(image_set.tile)
+
+    # Make list of lienames
+    image_path_list_10m = [image_set.get_channel_image_filename(ch) for ch in ImageSet.ch10m]
+    image_path_list_20m = [image_set.get_channel_image_filename(ch) for ch in ImageSet.ch20m]
+
+    # Open data, pixels are read later
+    ds_10m, cols_10m, rows_10m, xform_10m, proj_10m = image_set_open(image_path_list_10m)
+    ds_20m, cols_20m, rows_20m, xform_20m, proj_20m = image_set_open(image_path_list_20m)
+
+    # Image patch positions and the patches worth producing, for each configuration
+    layers = screen_layers(image_set, feature_layer, feature_table, xform_10m, cols_10m, rows_10m, proj_10m)
+    grids = []
+    for config, config_path in configs:
+        grid_n, grid_e, grid_j, grid_i = patch_grid(image_set.tile, xform_10m, cols_10m, rows_10m,
+                                                    config.patch_sz, config.stride)
+        reasons = screen_patch_grid(image_set, feature_layer, feature_table, xform_10m, cols_10m, rows_10m,
+                                    proj_10m, grid_j, grid_i, config.patch_sz, max_cloud, max_snow, max_nodata,
+                                    layers)
+        keep = reasons == ""
+        rejected = [(int(grid_n[r]), int(grid_e[c]), reasons[r, c], "") for r, c in zip(*np.nonzero(~keep))]
+        grids.append((grid_n, grid_e, grid_j, grid_i, keep, rejected))
+
+    # Rows and column span of surviving patches of all configurations
+    events = []
+    col0, col1 = cols_10m, 0
+    for config_ix, ((config, config_path), (grid_n, grid_e, grid_j, grid_i, keep, rejected)) in \
+            enumerate(zip(configs, grids)):
+        for row_ix in np.flatnonzero(np.any(keep, axis=1)):
+            events.append((int(grid_j[row_ix]), config_ix, row_ix))
+        keep_cols = np.flatnonzero(np.any(keep, axis=0))
+        if len(keep_cols):
+            col0 = min(col0, int(grid_i[keep_cols[0]]))
+            col1 = max(col1, int(grid_i[keep_cols[-1]]) + config.patch_sz)
+    # Patch rows from north to south, so that each band row is decoded once
+    events.sort()
+
+    if events:
+        row0 = events[0][0]
+        row1 = max(j + configs[config_ix][0].patch_sz for j, config_ix, row_ix in events)
+        reader_10m = StripBuffer(ds_10m, col0, col1)
+        reader_20m = StripBuffer(ds_20m, col0 // 2, col1 // 2)
+
+        # Categorical image of feature layers for the rows of surviving patches, in memory
+        labels = LabelRaster(feature_layer, feature_table, cols_10m, rows_10m, xform_10m, proj_10m,
+                             label_block_rows, row0, row1, label_cache, version)
+
+    def read_strips():
+        for j, config_ix, row_ix in events:
+            size = configs[config_ix][0].patch_sz
+            yield j, config_ix, row_ix, reader_10m.read(j, j + size), reader_20m.read(j // 2, (j + size) // 2)
+
+    writer = PatchWriter(writers, write_queue)
+    try:
+        for j, config_ix, row_ix, np_bands_10m, np_bands_20m in prefetch(read_strips(), read_ahead):
+            (config, config_path), (grid_n, grid_e, grid_j, grid_i, keep, rejected) = \
+                configs[config_ix], grids[config_ix]
+            size = config.patch_sz
+            n = int(grid_n[row_ix])
+            label_strip = labels.read(j, j + size)
+
+            # Drop degenerate patches of the row
+            col_ixs = np.flatnonzero(keep[row_ix])
+            nodata, saturated, unknown = patch_statistics(np_bands_10m, np_bands_20m, label_strip[:, col0:col1],
+                                                          grid_i[col_ixs] - col0, size)
+            for name, values, limit in (("nodata", nodata, max_nodata), ("saturated", saturated, max_saturated),
+                                        ("unknown", unknown, max_unknown)):
+                for col_ix, value in zip(col_ixs[values > limit], values[values > limit]):
+                    if keep[row_ix, col_ix]:
+                        keep[row_ix, col_ix] = False
+                        rejected.append((n, int(grid_e[col_ix]), name, f"{value:.4f}"))
+
+            for col_ix in np.flatnonzero(keep[row_ix]):
+                e = int(grid_e[col_ix])
+                i = int(grid_i[col_ix]) - col0
+
+                # Create output directory
+                img_out_path = os.path.join(config_path, tile_dir, f"{n // 10000 % 10}_{e // 10000 % 10}")
+                os.makedirs(img_out_path, exist_ok=True)
+
+                # Compute image transform
+                img_xform_10m = (e, xform_10m[1], xform_10m[2],
+                                 n, xform_10m[4], xform_10m[5])
+                img_xform_20m = (e, xform_20m[1], xform_20m[2],
+                                 n, xform_20m[4], xform_20m[5])
+
+                # Create colorimage for ML source
+                # 10m images
+                fn = os.path.join(img_out_path, f"{n}_{e}_{size}_10_{image_set.image_set_name}_B02B03B04B08.tif")
+                writer.write(fn, [array[:, i:i + size] for array in np_bands_10m], img_xform_10m, proj_10m)
+
+                # 20m images
+                fn = os.path.join(img_out_path,
+                                  f"{n}_{e}_{size//2}_20_{image_set.image_set_name}_B05B06B07B8AB11B12.tif")
+                writer.write(fn, [array[:, i // 2: (i + size) // 2] for array in np_bands_20m], img_xform_20m,
+                             proj_20m)
+
+                # Create categorical image of feature layers
+                fn = os.path.join(img_out_path, f"{n}_{e}_{size}_10_{label_name}.tif")
+                key = label_key(img_xform_10m, size, size, proj_10m, feature_table, version)
+                if read_patch_key(fn) != key:
+                    # Create only if missing or outdated
+                    writer.write(fn, [label_strip[:, col0 + i:col0 + i + size]], img_xform_10m, proj_10m,
+                                 gdal.GDT_Byte, key)
+    finally:
+        writer.close()
+
+    # Record rejected patches
+    for (config, config_path), (grid_n, grid_e, grid_j, grid_i, keep, rejected) in zip(configs, grids):
+        os.makedirs(os.path.join(config_path, tile_dir), exist_ok=True)
+        rejected_fn = os.path.join(config_path, tile_dir, "rejected_patches.csv")
+        new_file = not os.path.exists(rejected_fn)
+        with open(rejected_fn, "a", newline="") as file:
+            writer = csv.writer(file)
+            if new_file:
+                writer.writerow(["image_set", "n", "e", "patch_sz", "reason", "value"])
+            for n, e, reason, value in rejected:
+                writer.writerow([image_set.image_set_name, n, e, config.patch_sz, reason, value])
 
 
 data_path = "data"
 
-def generate_training_data_ar5(image_sets):
-    patch_sz = 128
+# Label file suffix of each label source, see :func:'training_data.generate_training_data_from_image()'
+label_names = {"ar5": "AR5", "ldir": "LDir"}
+
+def generate_training_data_ar5(image_sets, patch_sz=128, version=None):
 
     # Postgres stuff
     pg_server = "pgdvhro.webdmz.no"
@@ -502,13 +1571,14 @@ def generate_training_data_ar5(image_sets):
         ("artype >= 10 and artype < 12", "Bebygd", 13),
     ]
 
+    # Same version for all images, the layer is only counted once
+    version = layer_version(feature_layer, version)
     for image_set in image_sets:
         generate_training_data_from_image(ImageSet(data_path, image_set),
                                           feature_layer, feature_table,
-                                          patch_sz, os.path.join(data_path, "training"))
+                                          patch_sz, os.path.join(data_path, "training"), version=version)
 
-def generate_training_data_ldir(image_sets):
-    patch_sz = 128
+def generate_training_data_ldir(image_sets, patch_sz=128, version=None):
 
     # Postgres stuff
     pg_server = "beistet"
@@ -526,20 +1596,37 @@ def generate_training_data_ldir(image_sets):
         ("prod = 'Korn'", "Korn", 2),
     ]
 
+    # Same version for all images, the layer is only counted once
+    version = layer_version(feature_layer, version)
     for image_set in image_sets:
         generate_training_data_from_image(ImageSet(data_path, image_set),
                                           feature_layer, feature_table,
-                                          patch_sz, os.path.join(data_path, "training"))
+                                          patch_sz, os.path.join(data_path, "training"),
+                                          # Only parcels are labeled, everything else is unknown (0)
+                                          max_unknown=1.0, label_name="LDir", version=version)
 
 
-def generate_training_data(image_sets):
-    generate_training_data_ar5(image_sets)
+def generate_training_data(image_sets, patch_sz=128):
+    generate_training_data_ar5(image_sets, patch_sz)
 
-def mix_training_data():
-    train_sz = 4000
-    valid_sz = 200
-    test_sz = 200
-    target_data_set = glob.glob(os.path.join(data_path, "training", "*", "*", "*", "*_AR5.tif"))
+def select_training_data(training_path=None, label_name="AR5"):
+    """Find training patches with a useful mix of categories
+
+    Parameters
+    ----------
+    training_path: str (path)
+        Root of training data, or of one patch configuration, default "training" in data_path
+    label_name: str
+        Label file suffix, see :func:'training_data.generate_training_data_from_image()'. The AR5 patches must have a
+        mix of open land, roads, buildings or water and not too much forest, other patches some labeled pixels
+
+    Returns
+    -------
+    list((str, str, str))
+        10m image, 20m image and label file names of each patch
+    """
+    training_path = training_path or os.path.join(data_path, "training")
+    target_data_set = glob.glob(os.path.join(training_path, "*", "*", "*", f"*_{label_name}.tif"))
 
     data_set = []
     for fn in target_data_set:
@@ -548,32 +1635,50 @@ def mix_training_data():
         if not img:
             continue
         arr = img.GetRasterBand(1).ReadAsArray()
-        sum_type = np.zeros(14)
-        for i in range(arr.shape[0]):
-            for j in range(arr.shape[1]):
-                sum_type[arr[i,j]] += 1
-        sum_type /= arr.shape[0] * arr.shape[1]
-
-        # Mye dyrka og annen åpen mark
-        if sum_type[5] + sum_type[4] < 0.15:
-            continue
-        # Noe vei, bygg eller vann
-        if sum_type[10] + sum_type[11] + sum_type[12] + sum_type[13] < 0.05:
-            continue
-        # Men ikke for mye vann
-        if sum_type[10] > 0.4:
-            continue
-        # og ikke for mye skog
-        if sum_type[1] + sum_type[2] + sum_type[3] > 0.6:
+        sum_type = np.bincount(arr.ravel(), minlength=14)[:14] / arr.size
+
+        if label_name == "AR5":
+            # Mye dyrka og annen åpen mark
+            if sum_type[5] + sum_type[4] < 0.15:
+                continue
+            # Noe vei, bygg eller vann
+            if sum_type[10] + sum_type[11] + sum_type[12] + sum_type[13] < 0.05:
+                continue
+            # Men ikke for mye vann
+            if sum_type[10] > 0.4:
+                continue
+            # og ikke for mye skog
+            if sum_type[1] + sum_type[2] + sum_type[3] > 0.6:
+                continue
+        elif sum_type[0] >= 1.0:
+            # Other labels (e.g. LDir parcels) only need some labeled pixels
             continue
 
         # Use images
-        src_10m_list = glob.glob(fn[:-7] + "*_B02B03B04B08.tif")
+        src_10m_list = glob.glob(fn[:-len(f"{label_name}.tif")] + "*_B02B03B04B08.tif")
         for src_10m in src_10m_list:
             src_20m = src_10m[:-16] + "B05B06B07B8AB11B12.tif"
-            src_20m = src_20m.replace("_128_10_", "_64_20_")
+            src_20m = os.path.join(os.path.dirname(src_20m),
+                                   re.sub(r"^(\d+_\d+)_(\d+)_10_",
+                                          lambda mt: f"{mt.group(1)}_{int(mt.group(2)) // 2}_20_",
+                                          os.path.basename(src_20m)))
             if os.path.isfile(src_20m):
                 data_set.append((src_10m, src_20m, fn))
+    return data_set
+
+
+def write_data_set(data_set, filename):
+    """Write a split, one patch per line, see :func:'training_data.select_training_data()'"""
+    with open(filename, "w") as file:
+        for fn in data_set:
+            print(fn, file=file)
+
+
+def mix_training_data(training_path=None, label_name="AR5"):
+    train_sz = 4000
+    valid_sz = 200
+    test_sz = 200
+    data_set = select_training_data(training_path, label_name)
 
     # If we have less than the requested number of training files, adjust numbers of training, validation and test images
     if train_sz + valid_sz + test_sz > len(data_set):
@@ -587,17 +1692,9 @@ def mix_training_data():
     rn.shuffle(data_set)
 
     # Split into training, validation and test set
-    with open(os.path.join(data_path, "train_set.txt"), "w") as file:
-        for fn in data_set[:train_sz]:
-            print(fn, file=file)
-
-    with open(os.path.join(data_path, "valid_set.txt"), "w") as file:
-        for fn in data_set[train_sz:train_sz+valid_sz]:
-            print(fn, file=file)
-
-    with open(os.path.join(data_path, "test_set.txt"), "w") as file:
-        for fn in data_set[train_sz+valid_sz:train_sz+valid_sz+test_sz]:
-            print(fn, file=file)
+    write_data_set(data_set[:train_sz], os.path.join(data_path, "train_set.txt"))
+    write_data_set(data_set[train_sz:train_sz+valid_sz], os.path.join(data_path, "valid_set.txt"))
+    write_data_set(data_set[train_sz+valid_sz:train_sz+valid_sz+test_sz], os.path.join(data_path, "test_set.txt"))
 
 def main():
     image_sets = [